@@ -1,110 +1,263 @@
+import logging
+
+import joblib
 import numpy as np
 import scipy.signal
 
-from ma4m4.constants import LOW_PASS_CUTOFF, LOW_PASS_BUTTER_ORDER, SST_ICE_VAL
-from ma4m4.utils import log_duration, safe_unmask_array
+from ma4m4.compute_correlations import block_slices, unmask_by_reshaping
+from ma4m4.constants import (
+    ANOMALY_BAND_LATITUDES,
+    ANOMALY_BLOCK_SIZE,
+    LOW_PASS_CUTOFF,
+    LOW_PASS_BUTTER_ORDER,
+    SEASONAL_REFERENCE_PERIOD,
+    SST_ICE_VAL,
+)
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
 
 
 @log_duration("generate anomaly series")
-def generate_anomaly_series(data):
+def generate_anomaly_series(
+    grid,
+    load_band,
+    open_output,
+    band_latitudes=ANOMALY_BAND_LATITUDES,
+    block_size=ANOMALY_BLOCK_SIZE,
+    n_jobs=-1,
+):
     """ Generate the SST anomaly time-series
 
     This involves removing seasonality, detrending and low-pass filtering.
-    """
 
-    with log_duration("remove ice values"):
-        sst = mask_ice_in_sst(data["sst"])
+    Land and ice locations are masked for the whole series, so after masking them the
+    data is packed into a dense txk matrix with one column for each of the k remaining
+    spatial locations. All further processing is done on this matrix, in tiles of
+    block_size columns processed in parallel (see process_anomaly_tiles).
 
-    with log_duration("de-trend sst"):
-        sst = detrend(data["time_days"], sst)
+    The raw data is only read band_latitudes rows of the grid at a time, so the whole
+    SST cube is never held in memory. It is read twice: first to find the k locations,
+    so that the matrix can be created with open_output, and then to compute the
+    anomalies for each band, which are written straight into its columns.
 
-    with log_duration("remove seasonality"):
-        sst = remove_seasonal(sst)
+    Args:
+        grid: Dictionary with the "time_days", "time", "latitude" and "longitude" of
+            the raw data (see data_catalog.load_raw_sst_grid).
+        load_band: Function taking a slice of the rows of the latitude grid and
+            returning the masked SST data for those rows.
+        open_output: Function taking the shape (t, k) and returning a writable array
+            (e.g. a memmap) of that shape to hold the anomaly series.
 
-    with log_duration("low pass filter"):
-        mask = sst.mask.any(axis=0)
-        sst[:, ~mask] = butter_lowpass_filter(
-            sst[:, ~mask].filled(),
-            cutoff=LOW_PASS_CUTOFF,
-            order=LOW_PASS_BUTTER_ORDER,
-            sample_freq=1,
-            axis=0,
+    Returns:
+        Tuple: (result, meta) where result contains the "latitude" and "longitude" grid
+            vectors, the k-element "lat_index" and "lon_index" vectors giving the
+            position of each location on that grid, and the txk "sst_anomaly" matrix
+            returned by open_output.
+    """
+    latitude, longitude = grid["latitude"], grid["longitude"]
+    bands = block_slices(len(latitude), band_latitudes)
+
+    with log_duration("find ocean locations"):
+        is_ocean = np.concatenate(
+            [~mask_ice_in_sst(load_band(rows)).mask.any(axis=0) for rows in bands]
         )
+    lat_index, lon_index = np.nonzero(is_ocean)
 
+    sst_anomaly = open_output((len(grid["time_days"]), len(lat_index)))
+    logger.info(
+        f"Generating anomaly series for {len(lat_index):,} locations in "
+        f"{len(bands):,} bands of latitudes"
+    )
+    start = 0
+    for rows in bands:
+        sst = mask_ice_in_sst(load_band(rows))
+        _, _, sst = unmask_by_reshaping(latitude[rows], longitude, sst)
+        process_anomaly_tiles(
+            grid["time_days"], grid["time"], sst, block_size=block_size, n_jobs=n_jobs
+        )
+        sst_anomaly[:, start : start + sst.shape[1]] = sst
+        start += sst.shape[1]
+
+    result = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "lat_index": lat_index,
+        "lon_index": lon_index,
+        "sst_anomaly": sst_anomaly,
+    }
     meta = {
         "low_pass_cutoff": LOW_PASS_CUTOFF,
         "low_pass_butter_order": LOW_PASS_BUTTER_ORDER,
+        "seasonal_reference_period": SEASONAL_REFERENCE_PERIOD,
     }
 
-    return sst, meta
+    return result, meta
 
 
 def mask_ice_in_sst(sst: np.ma.MaskedArray):
     """ Mask locations where there is ever full ice cover in the SST data
 
     This adds to the current mask, which has masked out values corresponding to land
-    locations.
+    locations. The data itself is not copied.
     """
     is_ice = (sst == SST_ICE_VAL).filled(False)
     ever_ice = is_ice.any(axis=0)  # Time is in first axis
-    sst_no_ice = np.ma.masked_where(*np.broadcast_arrays(ever_ice, sst, subok=True))
-    return sst_no_ice
+    ever_ice = np.broadcast_to(ever_ice, sst.shape)
+    return np.ma.masked_array(sst, mask=ever_ice, copy=False)
 
 
-def detrend(t: np.array, y: np.ma.MaskedArray):
-    """ Remove a linear trend from masked data.
+def process_anomaly_tiles(t, time, y, block_size=ANOMALY_BLOCK_SIZE, n_jobs=-1):
+    """ De-trend, deseasonalise and low-pass filter each column of y (in place)
+
+    Each column is independent, so the columns are split into tiles which are processed
+    in parallel using joblib threads (numpy and scipy release the GIL for the heavy
+    lifting). Each tile is copied to a contiguous array while it is processed and joblib
+    only dispatches a bounded number of tiles ahead of the workers, so the extra memory
+    used is a few tiles per worker.
 
     Args:
         t: Time (in days or other unit, but not datetimes) for each point
-        y: Masked array of y-values to de-trend
+        time: Datetime64 time for each point
+        y: A txk matrix containing a time series in each column
+        block_size: Number of columns in each tile
+        n_jobs: Number of worker threads (as interpreted by joblib)
     """
-    if not y.ndim == 3:
-        raise ValueError(f"Expected 'y' to be three dimensional. Got {y.ndim=}.")
 
-    has_masked_values = y.mask.any(axis=0)
-    all_masked_values = y.mask.all(axis=0)
+    def process_tile(cols):
+        tile = y[:, cols].copy()
+        tile = detrend(t, tile)
+        tile = remove_seasonal(
+            tile, time=time, reference_period=SEASONAL_REFERENCE_PERIOD
+        )
+        y[:, cols] = butter_lowpass_filter(
+            tile,
+            cutoff=LOW_PASS_CUTOFF,
+            order=LOW_PASS_BUTTER_ORDER,
+            sample_freq=1,
+            axis=0,
+        )
 
-    if (has_masked_values & ~all_masked_values).any():
-        # Assuming this simplifies the detrending method. It is also necessary for other
-        # parts of the pipeline so we may as well assume it here.
+    tiles = block_slices(y.shape[1], block_size)
+    logger.info(f"Processing {len(tiles):,} anomaly tiles with joblib")
+    joblib.Parallel(n_jobs=n_jobs, prefer="threads", pre_dispatch="2*n_jobs")(
+        joblib.delayed(process_tile)(cols) for cols in tiles
+    )
+
+    return y
+
+
+def detrend(t: np.array, y: np.array):
+    """ Remove a linear trend from each column of y (in place).
+
+    The least-squares line is found in closed form, from the covariance of each column
+    with the (centred) time.
+
+    Args:
+        t: Time (in days or other unit, but not datetimes) for each point
+        y: A txk matrix containing a time series in each column
+    """
+    if not y.ndim == 2:
+        raise ValueError(f"Expected 'y' to be two dimensional. Got {y.ndim=}.")
+
+    t_mean, y_mean, slope = linear_trend(t, y)
+    y -= y_mean
+    y -= np.outer(t - t_mean, slope)
+
+    return y
+
+
+def linear_trend(t: np.array, y: np.array):
+    """ Fit a least-squares line to each column of y (in closed form).
+
+    Returns:
+        Tuple: (t_mean, y_mean, slope) such that the line for column j passes through
+            (t_mean, y_mean[j]) with gradient slope[j].
+    """
+    t_mean = t.mean()
+    t_centered = t - t_mean
+    slope = (t_centered @ y) / (t_centered @ t_centered)
+    return t_mean, y.mean(axis=0), slope
+
+
+def remove_seasonal(y, time=None, reference_period=None):
+    """ Remove annual seasonality from data (in place).
+
+    Assumes that the first axis indexes one data point per month. The series does not
+    need to cover a whole number of years.
+
+    Args:
+        y: Array with time along the first axis.
+        time: Datetime64 array with the time of each point. Only used to find the
+            reference period.
+        reference_period: Optional tuple (first_year, last_year) giving the (inclusive)
+            range of years over which to compute the average for each month, e.g.
+            (1961, 1990). By default the whole series is used.
+    """
+    seas_avg = seasonal_climatology(y, time=time, reference_period=reference_period)
+    return subtract_climatology(y, seas_avg)
+
+
+def seasonal_climatology(y, time=None, reference_period=None):
+    """ Compute the average for each month over the reference period.
+
+    The arguments are as for remove_seasonal. See monthly_climatology for the return
+    value.
+    """
+    if reference_period is None:
+        reference = slice(0, len(y))
+    else:
+        if time is None:
+            raise ValueError("The time of each point is needed for a reference period")
+        first_year, last_year = reference_period
+        year = time.astype("datetime64[Y]").astype("int64") + 1970
+        ix = np.flatnonzero((year >= first_year) & (year <= last_year))
+        reference = slice(ix[0] if len(ix) else 0, ix[-1] + 1 if len(ix) else 0)
+
+    if reference.stop - reference.start < 12:
         raise ValueError(
-            "Expected each spatial location to have a time-series with either no "
-            "masked values or all masked values."
+            f"Expected at least 12 months in the reference period. Got {reference}."
         )
 
-    t_mat = np.stack([t, np.ones_like(t)], axis=-1)
-    y_not_masked = safe_unmask_array(y[:, ~has_masked_values])
-    beta, _, _, _ = np.linalg.lstsq(t_mat, y_not_masked, rcond=None)
+    return monthly_climatology(y[reference], first_month=reference.start)
 
-    y_detrend = y.copy()
-    y_detrend[:, ~has_masked_values] -= t_mat @ beta
 
-    return y_detrend
+def subtract_climatology(y, climatology, first_month=0):
+    """ Subtract the average for each month (from monthly_climatology) in place.
 
+    Args:
+        y: Array with one data point per month along the first axis.
+        climatology: Array with the average for each month index along the first axis.
+        first_month: The month index of the first point of y (e.g. if y continues a
+            series which has already been deseasonalised).
+    """
+    for i in range(12):
+        y[i::12] -= climatology[(first_month + i) % 12]
+    return y
+
+
+def monthly_climatology(y, first_month=0):
+    """ Compute the average of data for each month.
 
-def remove_seasonal(y):
-    """ Remove annual seasonality from masked data.
+    Args:
+        y: Array with one data point per month along the first axis.
+        first_month: The month index (0-11) of the first point, relative to the start
+            of the series being deseasonalised.
 
-    Assumes that the first axis indexes one data point per month.
+    Returns:
+        An array whose first axis has length 12, with the average for month index m in
+        position m.
     """
-    n_pts = len(y)
-    y_bymonth = [[] for _ in range(12)]
-    for i in range(n_pts):
-        y_bymonth[i % 12].append(y[i])
-
-    # The following can result in underflow when dividing. I don't _know_ why but
-    # suspect that it is numbers which are close to zero being set to zero during the
-    # multiply. At any rate, it doesn't seem to make a difference!
-    # Interestingly this is only a problem when the data is represented as float64.
-    # Using float32 would make it go away.
-    with np.errstate(under="ignore"):
-        seas_avg = [sum(y_) / len(y_) for y_ in y_bymonth]
+    climatology = np.empty((12, *y.shape[1:]), dtype=y.dtype)
 
-    y_noseas = y.copy()
-    for i in range(n_pts):
-        y_noseas[i] -= seas_avg[i % 12]
+    # Averaging can result in underflow for values close to zero. It doesn't make a
+    # difference, so we ignore it.
+    with np.errstate(under="ignore"):
+        for i in range(12):
+            climatology[(first_month + i) % 12] = y[i::12].mean(axis=0)
 
-    return y_noseas
+    return climatology
 
 
 def butter_lowpass_filter(y, cutoff, order, sample_freq, axis=-1):
@@ -1,42 +1,357 @@
+import joblib
 import networkx as nx
 import numpy as np
 
-from ma4m4.constants import CORRELATION_THRESHOLD
+from ma4m4.compute_correlations import (
+    beyond_threshold,
+    block_slices,
+    threshold_tile,
+)
+from ma4m4.constants import (
+    CORRELATION_BLOCK_SIZE,
+    CORRELATION_MEMORY_BUDGET,
+    CORRELATION_THRESHOLD,
+    TOP_K_NEIGHBOURS,
+    TOP_K_SYMMETRISE,
+)
+from ma4m4.correlation_store import CorrelationStore
+from ma4m4.csr_graph import CSRGraph
 from ma4m4.utils import log_duration
 
 
 @log_duration("build network")
 def build_network(
-    latitude, longitude, correlation, threshold=CORRELATION_THRESHOLD, two_sided=True
+    latitude,
+    longitude,
+    correlation,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    as_csr=False,
 ):
-    if two_sided:
-        adj_mat = np.abs(correlation) >= threshold
+    """ Build the network from a dense correlation matrix or a CorrelationStore
+
+    The matrix is scanned in blocks of rows (see scan_correlation_edges), so it may be
+    a memmap.
+
+    Args:
+        as_csr: If true then return a CSRGraph rather than a networkx graph.
+    """
+    edges = scan_correlation_edges(correlation, threshold, two_sided)
+    graph = CSRGraph.from_edges(
+        latitude, longitude, edges["row"], edges["col"], np.abs(edges["value"])
+    )
+    if not as_csr:
+        graph = graph.to_networkx()
+
+    meta = {"corr_threshold": threshold, "corr_two_sided": two_sided}
+
+    return graph, meta
+
+
+def scan_correlation_edges(correlation, threshold, two_sided=True):
+    """ Extract the correlations beyond a threshold from a dense correlation matrix
+
+    The matrix is scanned in blocks of rows (so it may be a memmap) and only the
+    entries above the diagonal are considered. If a CorrelationStore is passed instead
+    then the correlations are computed tile by tile from it, so the dense matrix is
+    never formed.
+
+    Returns:
+        A dict with the "row", "col" and "value" arrays of the edges in COO format.
+    """
+    if isinstance(correlation, CorrelationStore):
+        return correlation.edges(threshold, two_sided)
+
+    n_nodes = correlation.shape[0]
+    edges = []
+    for rows in block_slices(n_nodes, CORRELATION_BLOCK_SIZE):
+        cols = slice(rows.start, n_nodes)
+        edges.append(
+            threshold_tile(rows, cols, correlation[rows, cols], threshold, two_sided)
+        )
+
+    return {
+        key: np.concatenate([e[key] for e in edges]) for key in ["row", "col", "value"]
+    }
+
+
+@log_duration("build top-k network")
+def build_top_k_network(
+    latitude,
+    longitude,
+    correlation,
+    k=TOP_K_NEIGHBOURS,
+    two_sided=True,
+    symmetrise=TOP_K_SYMMETRISE,
+    as_csr=False,
+):
+    """ Build the network in which each node is joined to its k most correlated nodes
+
+    Unlike a global threshold, this gives every node a similar degree. See
+    top_k_edges.
+
+    Args:
+        correlation: A dense correlation matrix (which may be a memmap) or a
+            CorrelationStore.
+        k: Number of neighbours chosen by each node.
+        two_sided: Whether nodes are ranked by abs(r) (rather than r).
+        symmetrise: Either "union", to join two nodes if either chooses the other
+            (so every degree is at least k), or "mutual", to join them only if both
+            choose each other (so every degree is at most k).
+        as_csr: If true then return a CSRGraph rather than a networkx graph.
+    """
+    edges = top_k_edges(correlation, k, two_sided, symmetrise)
+    graph = CSRGraph.from_edges(
+        latitude, longitude, edges["row"], edges["col"], np.abs(edges["value"])
+    )
+    if not as_csr:
+        graph = graph.to_networkx()
+
+    meta = {
+        "network_mode": "top_k",
+        "top_k": k,
+        "top_k_symmetrise": symmetrise,
+        "corr_two_sided": two_sided,
+    }
+
+    return graph, meta
+
+
+def top_k_edges(
+    correlation,
+    k=TOP_K_NEIGHBOURS,
+    two_sided=True,
+    symmetrise=TOP_K_SYMMETRISE,
+    block_size=CORRELATION_BLOCK_SIZE,
+    n_jobs=-1,
+    memory_budget=CORRELATION_MEMORY_BUDGET,
+):
+    """ Find the k most strongly correlated partners of each node
+
+    The correlation matrix is processed in blocks of rows (in parallel joblib threads),
+    keeping only the k strongest entries of each row by partial selection with
+    argpartition, so the full matrix is never held in memory. With a CorrelationStore
+    each row block is computed on demand. The block size and number of threads are
+    reduced if necessary so that the blocks in flight fit in memory_budget (see
+    top_k_block_size).
+
+    The diagonal and any NaN correlations are never chosen, so a row with fewer than k
+    valid entries gives fewer than k edges.
+
+    Returns:
+        A dict with the "row", "col" and "value" arrays of the symmetrised edges in COO
+        format, each given once (with row < col) and sorted by row then column.
+    """
+    if symmetrise not in ("union", "mutual"):
+        raise ValueError(f"Unknown symmetrisation: {symmetrise!r}")
+
+    if isinstance(correlation, CorrelationStore):
+        n_nodes = correlation.number_of_nodes()
     else:
-        adj_mat = correlation >= threshold
-    np.fill_diagonal(adj_mat, 0)
-
-    graph = nx.from_numpy_array(adj_mat)
-    nx.set_node_attributes(graph, {i: x for i, x in enumerate(latitude)}, "latitude")
-    nx.set_node_attributes(graph, {i: x for i, x in enumerate(longitude)}, "longitude")
-    nx.set_edge_attributes(
-        graph,
-        {
-            (i, j): np.abs(correlation[i, j])
-            for i, j in np.ndindex(correlation.shape)
-            if adj_mat[i, j]
-        },
-        name="abs_corr",
+        n_nodes = correlation.shape[0]
+    k = min(k, n_nodes - 1)
+
+    def process_rows(rows):
+        if isinstance(correlation, CorrelationStore):
+            tile = correlation.block(rows, slice(None))
+        else:
+            tile = np.array(correlation[rows])
+
+        # The strength is negated (in place), so the strongest entries are the smallest
+        strength = np.abs(tile) if two_sided else tile.copy()
+        np.negative(strength, out=strength)
+        strength[np.isnan(strength)] = np.inf
+        strength[np.arange(tile.shape[0]), np.arange(rows.start, rows.stop)] = np.inf
+
+        col = np.argpartition(strength, k - 1, axis=1)[:, :k]
+        valid = np.isfinite(np.take_along_axis(strength, col, axis=1)).ravel()
+        row = np.repeat(np.arange(rows.start, rows.stop), k)
+        value = np.take_along_axis(tile, col, axis=1).ravel()
+        return row[valid], col.ravel()[valid], value[valid]
+
+    if k < 1:
+        empty = np.array([], dtype="int32")
+        return {"row": empty, "col": empty, "value": empty.astype("float32")}
+
+    block_size, n_workers = top_k_block_size(n_nodes, block_size, n_jobs, memory_budget)
+    chosen = joblib.Parallel(n_jobs=n_workers, prefer="threads")(
+        joblib.delayed(process_rows)(rows)
+        for rows in block_slices(n_nodes, block_size)
+    )
+    row, col, value = (np.concatenate([c[i] for c in chosen]) for i in range(3))
+
+    # Each edge chosen by one or both of its nodes is identified by its lower-upper
+    # pair of nodes
+    lower, upper = np.minimum(row, col), np.maximum(row, col)
+    pair, first, n_chosen = np.unique(
+        lower.astype("int64") * n_nodes + upper, return_index=True, return_counts=True
     )
+    keep = n_chosen == 2 if symmetrise == "mutual" else np.ones(len(pair), dtype=bool)
+    first = first[keep]
+
+    return {
+        "row": lower[first].astype("int32"),
+        "col": upper[first].astype("int32"),
+        "value": value[first].astype("float32"),
+    }
+
+
+def top_k_block_size(
+    n_nodes,
+    block_size=CORRELATION_BLOCK_SIZE,
+    n_jobs=-1,
+    memory_budget=CORRELATION_MEMORY_BUDGET,
+):
+    """ Choose the block size and number of threads for top_k_edges
+
+    Each block of rows in flight holds the correlations, their (negated) strengths and
+    the argpartition indices, i.e. three 8 byte values for each of its entries. The
+    number of threads is reduced first, and then the block size, until the blocks in
+    flight fit in the memory budget. At least one row is always processed at a time.
+
+    Returns:
+        Tuple: (block_size, n_workers)
+    """
+    row_bytes = 3 * 8 * n_nodes
+    max_rows = max(memory_budget // row_bytes, 1)
+
+    n_workers = joblib.effective_n_jobs(n_jobs)
+    n_workers = max(min(n_workers, max_rows // block_size), 1)
+    block_size = max(min(block_size, max_rows // n_workers), 1)
+
+    return block_size, n_workers
+
+
+@log_duration("build network from edges")
+def build_network_from_edges(
+    latitude,
+    longitude,
+    row,
+    col,
+    value,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    as_csr=False,
+):
+    """ Build the network from a sparse list of correlations
+
+    The edge list (see compute_correlation_edges) must have been computed with a
+    threshold no greater than the one passed here, since correlations below that
+    threshold are missing from it.
+
+    Args:
+        as_csr: If true then return a CSRGraph rather than a networkx graph.
+    """
+    is_edge = beyond_threshold(value, threshold, two_sided) & (row != col)
+
+    graph = CSRGraph.from_edges(
+        latitude, longitude, row[is_edge], col[is_edge], np.abs(value[is_edge])
+    )
+    if not as_csr:
+        graph = graph.to_networkx()
 
     meta = {"corr_threshold": threshold, "corr_two_sided": two_sided}
 
     return graph, meta
 
 
+@log_duration("build lagged network")
+def build_lagged_network(
+    latitude,
+    longitude,
+    row,
+    col,
+    value,
+    lag,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    directed=False,
+):
+    """ Build a network from a sparse list of lagged correlations
+
+    See compute_lagged_correlation_edges, which must have been called with a threshold
+    no greater than the one passed here. Each edge has an abs_corr weight (as in
+    build_network) and a lag attribute giving the (absolute) lag in months.
+
+    Args:
+        directed: If true then return a networkx DiGraph with an edge from the
+            leading location to the lagging one (or edges in both directions, for a
+            lag of zero). Otherwise return an undirected networkx graph.
+    """
+    is_edge = beyond_threshold(value, threshold, two_sided)
+    row, col, value, lag = row[is_edge], col[is_edge], value[is_edge], lag[is_edge]
+
+    if directed:
+        # A positive lag means that the row location leads the column location
+        source = np.concatenate([np.where(lag >= 0, row, col), col[lag == 0]])
+        target = np.concatenate([np.where(lag >= 0, col, row), row[lag == 0]])
+        value = np.concatenate([value, value[lag == 0]])
+        lag = np.concatenate([lag, lag[lag == 0]])
+        graph = nx.DiGraph()
+    else:
+        source, target = row, col
+        graph = nx.Graph()
+
+    graph.add_nodes_from(
+        (i, {"latitude": lat, "longitude": long})
+        for i, (lat, long) in enumerate(zip(latitude.tolist(), longitude.tolist()))
+    )
+    graph.add_edges_from(
+        (s, t, {"abs_corr": abs_corr, "lag": abs_lag})
+        for s, t, abs_corr, abs_lag in zip(
+            source.tolist(),
+            target.tolist(),
+            np.abs(value).tolist(),
+            np.abs(lag).tolist(),
+        )
+    )
+
+    meta = {
+        "corr_threshold": threshold,
+        "corr_two_sided": two_sided,
+        "network_directed": directed,
+    }
+
+    return graph, meta
+
+
+def graph_statistics(graph):
+    """ Summary statistics for a networkx graph or CSRGraph, as a dictionary """
+    return edge_count_statistics(graph.number_of_nodes(), graph.number_of_edges())
+
+
+def edge_count_statistics(n_nodes, n_edges):
+    """ Summary statistics of an undirected graph from its numbers of nodes and edges
+
+    Args:
+        n_nodes: Number of nodes in the graph.
+        n_edges: Number of (undirected) edges in the graph.
+
+    Returns:
+        A dictionary with the "n_nodes", "n_edges", "mean_degree" and "density" of the
+        graph (as for graph_statistics).
+    """
+    return {
+        "n_nodes": n_nodes,
+        "n_edges": n_edges,
+        "mean_degree": 2 * n_edges / n_nodes if n_nodes else 0.0,
+        "density": _density(n_nodes, n_edges),
+    }
+
+
 def print_graph_statistics(graph):
+    """ Print summary statistics for a networkx graph or CSRGraph """
+    stats = graph_statistics(graph)
+
     print("Graph statistics")
     print("----------------")
-    print(f"Number of nodes: {graph.number_of_nodes():,}")
-    print(f"Number of edges: {graph.number_of_edges():,}")
-    print(f"Average degree: {np.mean([d for _, d in graph.degree()]):.1f}")
-    print(f"Edge density: {nx.density(graph):.1%}")
+    print(f"Number of nodes: {stats['n_nodes']:,}")
+    print(f"Number of edges: {stats['n_edges']:,}")
+    print(f"Average degree: {stats['mean_degree']:.1f}")
+    print(f"Edge density: {stats['density']:.1%}")
+
+
+def _density(n_nodes, n_edges):
+    if n_nodes <= 1:
+        return 0
+    return 2 * n_edges / (n_nodes * (n_nodes - 1))
@@ -1,37 +1,158 @@
 import logging
+import time
 
+import cdlib
 import cdlib.algorithms
+import networkx as nx
+import numpy as np
 
-from ma4m4.constants import MODULARITY_MAXIMISATION_RESOLUTION
+from ma4m4.constants import (
+    COMMUNITY_SEED,
+    MODULARITY_MAXIMISATION_RESOLUTION,
+    SURPRISE_OPTIMISER,
+    SURPRISE_TIME_BUDGET,
+)
+from ma4m4.community_labels import community_labels
+from ma4m4.csr_graph import CSRGraph
+from ma4m4.surprise import asymptotic_surprise, optimise_surprise
 from ma4m4.utils import log_duration
 
 logger = logging.getLogger(__name__)
 
 
-# TODO: Specify a seed for these algorithms!!
-# TODO: Repeat and average (somehow!)
-
-
 @log_duration("detect communities via NG modularity maximisation (louvain)")
 def detect_communities_via_ngmodmax_louvain(
-    graph, resolution=MODULARITY_MAXIMISATION_RESOLUTION
+    graph, resolution=MODULARITY_MAXIMISATION_RESOLUTION, seed=COMMUNITY_SEED
 ):
-    # I think this is the same algorithm as nx.community.louvain_communities, though the
-    # implementation is different.
-    comms = cdlib.algorithms.louvain(graph, resolution=resolution)
+    # This is the same algorithm as cdlib.algorithms.louvain, but cdlib doesn't pass a
+    # seed through to python-louvain. As with cdlib, the graph is unweighted since the
+    # edges have no "weight" attribute.
+    communities = nx.community.louvain_communities(
+        graph, resolution=resolution, seed=seed
+    )
+    comms = cdlib.NodeClustering(
+        sorted((list(c) for c in communities), key=len, reverse=True),
+        graph,
+        method_name="Louvain",
+        method_parameters={"resolution": resolution, "seed": seed},
+    )
     logger.info(f"Found {len(comms.communities)} communities")
     return comms
 
 
 @log_duration("detect communities via infomap")
-def detect_communities_via_infomap(graph):
-    comms = cdlib.algorithms.infomap(graph)
+def detect_communities_via_infomap(graph, seed=COMMUNITY_SEED):
+    comms = cdlib.algorithms.infomap(graph, flags=f"--seed {seed}")
     logger.info(f"Found {len(comms.communities)} communities")
     return comms
 
 
 @log_duration("detect communities via asymptotic surprise")
-def detect_communities_via_asymptotic_surprise(graph, weight: str = None):
-    comms = cdlib.algorithms.surprise_communities(graph, weights=weight)
+def detect_communities_via_asymptotic_surprise(
+    graph,
+    weight: str = None,
+    optimiser=SURPRISE_OPTIMISER,
+    seed=COMMUNITY_SEED,
+    time_budget=SURPRISE_TIME_BUDGET,
+):
+    """ Detect communities by maximising asymptotic surprise
+
+    Args:
+        graph: A networkx graph or CSRGraph.
+        weight: Edge attribute to weight the surprise by, if any.
+        optimiser: Either "native" (see ma4m4.surprise.optimise_surprise) or "cdlib".
+        seed: Seed for the native optimiser.
+        time_budget: Time budget (in seconds) for the native optimiser, if any.
+    """
+    if optimiser == "native":
+        comms = _native_surprise_communities(graph, weight, seed, time_budget)
+    elif optimiser == "cdlib":
+        if isinstance(graph, CSRGraph):
+            graph = graph.to_networkx()
+        comms = cdlib.algorithms.surprise_communities(graph, weights=weight)
+    else:
+        raise ValueError(f"Unknown surprise optimiser: {optimiser!r}")
+
     logger.info(f"Found {len(comms.communities)} communities")
     return comms
+
+
+def benchmark_asymptotic_surprise(
+    graph, weight: str = None, seed=COMMUNITY_SEED, optimisers=("native", "cdlib")
+):
+    """ Compare the native surprise optimiser with cdlib's surprise_communities
+
+    Args:
+        optimisers: The optimisers to compare, as passed to
+            detect_communities_via_asymptotic_surprise.
+
+    Returns:
+        A dictionary with, for each of the optimisers, the time taken (in seconds), the
+        number of communities found and the asymptotic surprise of the partition.
+    """
+    csr_graph = graph if isinstance(graph, CSRGraph) else CSRGraph.from_networkx(graph)
+    adjacency = csr_graph.adjacency(weight)
+
+    results = {}
+    for optimiser in optimisers:
+        start = time.perf_counter()
+        comms = detect_communities_via_asymptotic_surprise(
+            graph, weight=weight, optimiser=optimiser, seed=seed
+        )
+        duration = time.perf_counter() - start
+
+        labels = community_labels(comms, csr_graph.number_of_nodes())
+        results[optimiser] = {
+            "seconds": duration,
+            "n_communities": len(comms.communities),
+            "surprise": asymptotic_surprise(adjacency, labels),
+        }
+        logger.info(
+            f"{optimiser} surprise optimiser: {results[optimiser]['surprise']:.6g} in "
+            f"{duration:.1f}s"
+        )
+
+    return results
+
+
+def _native_surprise_communities(graph, weight, seed, time_budget):
+    """ Run optimise_surprise and wrap the result as a cdlib NodeClustering """
+    if isinstance(graph, CSRGraph):
+        csr_graph, graph = graph, graph.to_networkx()
+    else:
+        csr_graph = CSRGraph.from_networkx(graph)
+
+    labels = optimise_surprise(
+        csr_graph.adjacency(weight), seed=seed, time_budget=time_budget
+    )
+
+    return communities_from_labels(
+        graph,
+        labels,
+        method_name="Asymptotic surprise (native)",
+        method_parameters={"weights": weight, "seed": seed, "time_budget": time_budget},
+    )
+
+
+def communities_from_labels(graph, labels, method_name, method_parameters):
+    """ Convert community labels to a cdlib NodeClustering
+
+    Args:
+        graph: The networkx graph, with nodes 0, ..., n-1.
+        labels: An n-element vector with the community label of each node.
+
+    Returns:
+        A NodeClustering whose communities are in decreasing order of size (as cdlib's
+        algorithms return them).
+    """
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    communities = [c.tolist() for c in np.split(order, boundaries)]
+    communities.sort(key=len, reverse=True)
+
+    return cdlib.NodeClustering(
+        communities,
+        graph,
+        method_name=method_name,
+        method_parameters=method_parameters,
+    )
@@ -0,0 +1,140 @@
+import logging
+
+import joblib
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from ma4m4.community_detection import (
+    communities_from_labels,
+    detect_communities_via_infomap,
+    detect_communities_via_ngmodmax_louvain,
+)
+from ma4m4.community_labels import community_labels
+from ma4m4.constants import (
+    COMMUNITY_SEED,
+    ENSEMBLE_CONSENSUS_THRESHOLD,
+    ENSEMBLE_N_RUNS,
+)
+from ma4m4.surprise import optimise_surprise
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
+
+ENSEMBLE_ALGORITHMS = ["modularity", "infomap", "surprise"]
+
+
+@log_duration("detect ensemble communities")
+def detect_ensemble_communities(
+    graph,
+    algorithm,
+    n_runs=ENSEMBLE_N_RUNS,
+    seed=COMMUNITY_SEED,
+    threshold=ENSEMBLE_CONSENSUS_THRESHOLD,
+    n_jobs=-1,
+    verbose=1,
+):
+    """ Run a community detection algorithm with many seeds and find a consensus
+
+    The runs are shared between a pool of worker processes. The graph is passed to the
+    workers as its CSR arrays, which joblib memory-maps rather than copying into each
+    task: if the arrays are already memmaps (as from load_network with mmap_mode="r")
+    then the workers open the same files, otherwise joblib dumps them to a temporary
+    file once.
+
+    Each run returns the community label of each node. These n_runs x n labels are
+    much smaller than the graph (and are returned, see below), so they are all kept
+    until the runs have finished. The number of runs in which the two ends of each edge
+    are in the same community is then counted from them, one run at a time. This
+    co-assignment matrix has the sparsity pattern of the graph, so is stored as a
+    count for each entry of its CSR indices. The consensus communities are the
+    connected components of the graph keeping only the edges co-assigned in more than
+    threshold of the runs.
+
+    Args:
+        graph: A CSRGraph.
+        algorithm: One of ENSEMBLE_ALGORITHMS.
+        n_runs: Number of runs, each with a different seed.
+        seed: Base seed from which the seed of each run is generated.
+        threshold: Fraction of the runs in which an edge must be co-assigned to be kept
+            for the consensus.
+        n_jobs: Number of worker processes (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+
+    Returns:
+        Tuple: (comms, stability, co_assignment, runs) where comms is the consensus
+            NodeClustering, stability is an n-element vector with the fraction of the
+            runs agreeing with the consensus about whether each node is in the same
+            community as its neighbours (averaged over its neighbours, and 1 for
+            isolated nodes), co_assignment is the nxn scipy CSR matrix with the
+            fraction of the runs in which each edge is co-assigned, and runs is the
+            n_runs x n int32 matrix with the community labels from each run.
+    """
+    if algorithm not in ENSEMBLE_ALGORITHMS:
+        raise ValueError(f"Unknown ensemble algorithm: {algorithm!r}")
+
+    n_nodes = graph.number_of_nodes()
+    seeds = np.random.SeedSequence(seed).generate_state(n_runs).tolist()
+    row = np.repeat(np.arange(n_nodes, dtype="int32"), np.diff(graph.indptr))
+
+    logger.info(
+        f"Running {algorithm} community detection {n_runs} times in a joblib process "
+        f"pool"
+    )
+    runs = joblib.Parallel(n_jobs=n_jobs, prefer="processes", verbose=verbose)(
+        joblib.delayed(_seeded_run)(graph, algorithm, s) for s in seeds
+    )
+
+    # Only the (small) label vector of each run is returned, and once all have finished
+    # each is added to the co-assignment counts in turn
+    co_assigned = np.zeros(len(graph.indices), dtype="int32")
+    for labels in runs:
+        co_assigned += labels[row] == labels[graph.indices]
+
+    fraction = co_assigned / n_runs
+    co_assignment = scipy.sparse.csr_matrix(
+        (fraction, graph.indices, graph.indptr), shape=(n_nodes, n_nodes)
+    )
+
+    keep = fraction > threshold
+    consensus_graph = scipy.sparse.coo_matrix(
+        (np.ones(np.count_nonzero(keep)), (row[keep], graph.indices[keep])),
+        shape=(n_nodes, n_nodes),
+    )
+    _, consensus = scipy.sparse.csgraph.connected_components(
+        consensus_graph, directed=False
+    )
+
+    same = consensus[row] == consensus[graph.indices]
+    agreement = np.where(same, fraction, 1 - fraction)
+    degree = np.diff(graph.indptr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stability = np.bincount(row, weights=agreement, minlength=n_nodes) / degree
+    stability[degree == 0] = 1
+
+    comms = communities_from_labels(
+        graph.to_networkx(),
+        consensus,
+        method_name=f"Consensus of {algorithm}",
+        method_parameters={"n_runs": n_runs, "seed": seed, "threshold": threshold},
+    )
+    logger.info(
+        f"Found {len(comms.communities)} consensus communities with mean node "
+        f"stability {stability.mean():.3f}"
+    )
+
+    return comms, stability, co_assignment, np.stack(runs)
+
+
+def _seeded_run(graph, algorithm, seed):
+    """ Run one algorithm with a seed, returning the community label of each node """
+    if algorithm == "surprise":
+        # The native optimiser works on the CSR arrays directly
+        return optimise_surprise(graph.adjacency(), seed=seed).astype("int32")
+
+    if algorithm == "modularity":
+        comms = detect_communities_via_ngmodmax_louvain(graph.to_networkx(), seed=seed)
+    else:
+        comms = detect_communities_via_infomap(graph.to_networkx(), seed=seed)
+    return community_labels(comms, graph.number_of_nodes())
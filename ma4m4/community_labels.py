@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class CommunityLabels:
+    """ A partition of the nodes of a network, stored compactly as a label per node
+
+    Unlike a cdlib NodeClustering this holds no graph, just a reference to the saved
+    network (see data_catalog.load_communities), which is only loaded when the
+    NodeClustering (or the node coordinates, for plotting) is asked for.
+
+    Args:
+        labels: An int32 n-element vector with the index of the community containing
+            each node, or -1 for nodes in no community.
+        method_name: Name of the algorithm which found the communities.
+        method_parameters: Dictionary of the parameters of the algorithm.
+        load_graph: Function (with no arguments) returning the networkx graph.
+        load_coordinates: Function (with no arguments) returning the latitude and
+            longitude vectors of the nodes.
+    """
+
+    def __init__(
+        self,
+        labels,
+        method_name,
+        method_parameters,
+        load_graph=None,
+        load_coordinates=None,
+    ):
+        self.labels = labels
+        self.method_name = method_name
+        self.method_parameters = method_parameters
+        self.load_graph = load_graph
+        self.load_coordinates = load_coordinates
+
+    @classmethod
+    def from_node_clustering(cls, comms, load_graph=None):
+        labels = community_labels(comms, comms.graph.number_of_nodes())
+        return cls(labels, comms.method_name, comms.method_parameters, load_graph)
+
+    def number_of_nodes(self):
+        return len(self.labels)
+
+    def coordinates(self):
+        """ The latitude and longitude of each node, as a tuple of vectors """
+        if self.load_coordinates is None:
+            raise ValueError("No coordinates are available for these communities")
+        return self.load_coordinates()
+
+    def number_of_communities(self):
+        return int(self.labels.max(initial=-1)) + 1
+
+    def sizes(self):
+        """ The number of nodes in each community """
+        return np.bincount(
+            self.labels[self.labels >= 0], minlength=self.number_of_communities()
+        )
+
+    def communities(self):
+        """ The nodes in each community, as a list of arrays in order of label """
+        in_community = np.flatnonzero(self.labels >= 0)
+        order = in_community[np.argsort(self.labels[in_community], kind="stable")]
+        return np.split(order, np.cumsum(self.sizes())[:-1])
+
+    def to_node_clustering(self):
+        """ Load the graph and build the equivalent cdlib NodeClustering """
+        if self.load_graph is None:
+            raise ValueError("No graph is available for these communities")
+
+        # Imported here so that loading saved communities doesn't need cdlib
+        import cdlib
+
+        return cdlib.NodeClustering(
+            [c.tolist() for c in self.communities()],
+            self.load_graph(),
+            method_name=self.method_name,
+            method_parameters=self.method_parameters,
+        )
+
+
+def community_labels(comms, n_nodes):
+    """ The index of the community containing each of the nodes 0, ..., n-1
+
+    Nodes which are in no community are labelled -1.
+    """
+    labels = np.full(n_nodes, -1, dtype="int32")
+    for index, community in enumerate(comms.communities):
+        labels[community] = index
+    return labels
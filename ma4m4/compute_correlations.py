@@ -3,6 +3,12 @@ import logging
 import joblib
 import numpy as np
 
+from ma4m4.constants import (
+    CORRELATION_BLOCK_SIZE,
+    CORRELATION_DTYPE,
+    CORRELATION_MEMORY_BUDGET,
+    CORRELATION_THRESHOLD,
+)
 from ma4m4.utils import log_duration
 
 
@@ -10,12 +16,46 @@ logger = logging.getLogger(__name__)
 
 
 @log_duration("compute correlations")
-def compute_correlations(latitude, longitude, sst_anomaly):
-    latitude, longitude, sst_anomaly = unmask_by_reshaping(
-        latitude, longitude, sst_anomaly
-    )
+def compute_correlations(
+    latitude,
+    longitude,
+    sst_anomaly,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+    out_path=None,
+    memory_budget=CORRELATION_MEMORY_BUDGET,
+):
+    """ Compute the correlation matrix between all spatial locations
+
+    Args:
+        latitude: A k-element vector with the latitude of each spatial location.
+        longitude: A k-element vector with the longitude of each spatial location.
+        sst_anomaly: A txk matrix containing the anomaly series at each location (as
+            returned by unmask_by_reshaping).
 
-    correlations = compute_correlation(sst_anomaly)
+    If out_path is given then the correlation matrix is streamed, tile by tile, into a
+    memory-mapped .npy file at that location rather than being held in memory. The
+    tile size is then chosen so that the memory used stays within memory_budget bytes.
+    """
+    if out_path is None:
+        correlations = compute_correlation(sst_anomaly, dtype=dtype, n_jobs=n_jobs)
+    else:
+        n_time, n_space = sst_anomaly.shape
+        block_size = block_size_for_memory_budget(
+            n_time, n_space, dtype=dtype, n_jobs=n_jobs, memory_budget=memory_budget
+        )
+        logger.info(f"Streaming correlations to {out_path!r} ({block_size=})")
+        correlations = np.lib.format.open_memmap(
+            out_path, mode="w+", dtype=dtype, shape=(n_space, n_space)
+        )
+        compute_correlation(
+            sst_anomaly,
+            block_size=block_size,
+            dtype=dtype,
+            n_jobs=n_jobs,
+            out=correlations,
+        )
+        correlations.flush()
 
     return {
         "latitude": latitude,
@@ -24,7 +64,34 @@ def compute_correlations(latitude, longitude, sst_anomaly):
     }
 
 
-def unmask_by_reshaping(lat, long, y):
+@log_duration("compute correlation edges")
+def compute_correlation_edges(
+    latitude,
+    longitude,
+    sst_anomaly,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+):
+    """ Compute only those correlations which will become edges in the network
+
+    This avoids ever storing the full correlation matrix, so that the memory used
+    scales with the number of edges rather than the square of the number of nodes.
+    The arguments are as for compute_correlations. See compute_thresholded_correlation
+    for details of the returned edge list.
+    """
+    edges = compute_thresholded_correlation(
+        sst_anomaly, threshold, two_sided=two_sided, dtype=dtype, n_jobs=n_jobs
+    )
+    logger.info(f"Found {len(edges['value']):,} correlations beyond the threshold")
+
+    result = {"latitude": latitude, "longitude": longitude, **edges}
+    meta = {"corr_threshold": threshold, "corr_two_sided": two_sided}
+    return result, meta
+
+
+def unmask_by_reshaping(lat, long, y, return_index=False):
     """ Convert a 3D masked array to 2D regular array by removing masked values.
 
     The time dimension is assume to be the first dimension. It is asserted that either
@@ -36,11 +103,15 @@ def unmask_by_reshaping(lat, long, y):
         y: A txmxn 3D masked array containing a times series of length t at each of the
             mn spatial locations. Each time series should be either fully masked (e.g.
             for a land location) or never masked.
+        return_index: If true then also return the indices into lat and long of each
+            unmasked spatial location.
 
     Returns:
         Tuple: (lat, long, y) A tuple containing the "unmasked" versions of lat, long
             and y. Letting k represent the number of spacial locations which aren't
             masked, lat and long are k-element vectors while y is a txk element matrix.
+            If return_index is true then the k-element index vectors (ix_lat, ix_long)
+            are appended to the tuple.
     """
     if (y.mask.any(axis=0) != y.mask.all(axis=0)).any():
         num_offenders = (y.mask.any(axis=0) != y.mask.all(axis=0)).sum()
@@ -51,43 +122,238 @@ def unmask_by_reshaping(lat, long, y):
         )
     mask = y.mask.any(axis=0)
 
-    y_unmask = y[:, ~mask].filled(np.nan)
+    # No unmasked location has any masked values (checked above) so we can take the
+    # underlying data directly, which avoids copying the mask as well
+    y_unmask = np.ma.getdata(y)[:, ~mask]
     if np.isnan(y_unmask).any():
-        # Really this is an internal sanity check that we didn't need to fill anywhere
-        # with NaN. However, it is possible that this would get triggered if y contains
-        # a NaN to begin with.
         raise ValueError("Did not expect nan values in data!")
 
     ix_lat, ix_long = np.nonzero(~mask)
     lat_unmask = lat[ix_lat]
     long_unmask = long[ix_long]
 
+    if return_index:
+        return lat_unmask, long_unmask, y_unmask, ix_lat, ix_long
     return lat_unmask, long_unmask, y_unmask
 
 
-def compute_correlation(y, verbose=1):
+def compute_correlation(
+    y,
+    block_size=CORRELATION_BLOCK_SIZE,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+    verbose=1,
+    out=None,
+):
     """ Compute the Pearson correlation between all columns at lag 0.
 
-    Computation is done in parallel using joblib.
+    The columns are standardised once, after which the correlation matrix is filled in
+    square tiles using one matrix multiply per tile. Only the tiles on or above the
+    diagonal are computed; the others are filled in by symmetry. Tiles are computed in
+    parallel using joblib threads (numpy releases the GIL during the multiply).
+
+    Args:
+        y: A txn matrix containing a time series of length t in each column.
+        block_size: Number of columns along each side of a tile.
+        dtype: Floating point type used to accumulate and return the correlations.
+        n_jobs: Number of worker threads (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+        out: Optional nxn array (e.g. a np.memmap) to write the result into.
 
     Warning:
         NaN is returned when one of the time-series is constant.
     """
+    z = standardise(y, dtype=dtype)
+    n_space = z.shape[1]
+    if out is None:
+        r = np.empty((n_space, n_space), dtype=dtype)
+    else:
+        r = out
+
+    def fill_tile(rows, cols, tile):
+        r[rows, cols] = tile
+        r[cols, rows] = tile.T
+
+    map_correlation_tiles(
+        z, fill_tile, block_size=block_size, n_jobs=n_jobs, verbose=verbose
+    )
+
+    return r
+
+
+def compute_thresholded_correlation(
+    y,
+    threshold,
+    two_sided=True,
+    block_size=CORRELATION_BLOCK_SIZE,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+    verbose=1,
+):
+    """ Compute the sparse set of Pearson correlations beyond a threshold
+
+    The correlations are computed tile by tile (as in compute_correlation) and only
+    those with abs(r) >= threshold (or r >= threshold if not two_sided) are kept. Only
+    pairs above the diagonal (row < col) are returned.
+
+    Returns:
+        A dict with int32 arrays "row" and "col" and a float32 array "value" describing
+        the correlations in COO format, sorted by row and then column.
+    """
+    z = standardise(y, dtype=dtype)
+
+    tiles = map_correlation_tiles(
+        z,
+        lambda rows, cols, tile: threshold_tile(rows, cols, tile, threshold, two_sided),
+        block_size=block_size,
+        n_jobs=n_jobs,
+        verbose=verbose,
+    )
+
+    return concatenate_edges(tiles)
+
+
+def threshold_tile(rows, cols, tile, threshold, two_sided=True):
+    """ Extract the entries of a correlation tile beyond the threshold as COO arrays
+
+    The tile covers the given (not necessarily equal length) row and column slices of
+    the full correlation matrix. Entries on or below its diagonal are dropped.
+    """
+    # The threshold is applied in the dtype of the tile (CORRELATION_DTYPE), before
+    # the values are rounded to float32 for storage
+    is_edge = beyond_threshold(tile, threshold, two_sided)
+    if cols.start < rows.stop:
+        is_edge = np.triu(is_edge, k=rows.start - cols.start + 1)
+
+    i, j = np.nonzero(is_edge)
+    return {
+        "row": (i + rows.start).astype("int32"),
+        "col": (j + cols.start).astype("int32"),
+        "value": tile[i, j].astype("float32"),
+    }
+
+
+def beyond_threshold(value, threshold, two_sided=True):
+    """ Whether each correlation is at or beyond the threshold
+
+    The threshold is rounded to the dtype of the values first. Stored edge values are
+    selected in CORRELATION_DTYPE and then rounded to float32, which can take a value
+    just beyond the threshold to just below it. Since rounding preserves order, every
+    stored value selected at a threshold is still selected here at that threshold.
+    """
+    strength = np.abs(value) if two_sided else value
+    return strength >= value.dtype.type(threshold)
+
+
+def concatenate_edges(tiles, keys=("row", "col", "value")):
+    """ Concatenate the COO arrays from several tiles, sorting by row then column """
+    edges = {key: np.concatenate([t[key] for t in tiles]) for key in keys}
+    order = np.lexsort((edges["col"], edges["row"]))
+    return {key: arr[order] for key, arr in edges.items()}
+
+
+def standardise(y, dtype=CORRELATION_DTYPE):
+    """ Standardise the columns of y so that correlations are given by z.T @ z
+
+    Each column is centred and scaled to have unit norm (i.e. unit standard deviation,
+    divided by the square root of the number of time points).
+    """
+    n_time = y.shape[0]
     y_centered = y - y.mean(axis=0)
     y_std = np.sqrt(np.mean(y_centered ** 2, axis=0))
-    n_time, n_space = y.shape
 
-    def compute_cov(x, y):
-        return np.mean(x * y, axis=-1)
+    # Dividing values close to zero can underflow, which we don't care about here
+    with np.errstate(under="ignore"):
+        y_centered /= y_std * np.sqrt(n_time)
+
+    return y_centered.astype(dtype, copy=False)
+
+
+def block_size_for_memory_budget(
+    n_time,
+    n_space,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+    memory_budget=CORRELATION_MEMORY_BUDGET,
+):
+    """ Choose a tile size so that the correlation computation fits in a memory budget
+
+    The budget must cover the standardised txn data matrix plus one tile (and a copy,
+    for diagonal tiles) per worker. It excludes the data passed in by the caller.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    n_workers = joblib.effective_n_jobs(n_jobs)
+
+    tiles_budget = memory_budget - n_time * n_space * itemsize
+    block_size = int(np.sqrt(max(tiles_budget, 0) / (2 * n_workers * itemsize)))
+    if block_size < 1:
+        raise ValueError(
+            f"Memory budget of {memory_budget:,} bytes is too small for correlations "
+            f"between {n_space:,} time series of length {n_time:,}."
+        )
+
+    return min(block_size, CORRELATION_BLOCK_SIZE, n_space)
+
+
+def map_correlation_tiles(
+    z, func, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1, verbose=0
+):
+    """ Compute the tiles on or above the diagonal of the correlation matrix z.T @ z
+
+    Each tile is passed to func(rows, cols, tile), where rows and cols are the slices
+    of the correlation matrix covered by the tile. The function is called from a
+    worker thread, so it must only write to parts of shared arrays covered by its
+    own tile.
 
-    logger.info(f"Processing {n_space:,} tasks with joblib")
-    cov = joblib.Parallel(n_jobs=-1, prefer="threads", verbose=verbose)(
-        joblib.delayed(compute_cov)(y_centered.T, y_centered.T[i])
-        for i in range(n_space)
+    Args:
+        z: A standardised txn matrix, as returned by standardise.
+        func: Function to call with each tile.
+        block_size: Number of columns along each side of a tile.
+        n_jobs: Number of worker threads (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+
+    Returns:
+        A list containing the return value of func for each tile.
+    """
+
+    def process_tile(rows, cols):
+        return func(rows, cols, correlation_tile(z, rows, cols))
+
+    return map_tile_slices(
+        z.shape[1], process_tile, block_size=block_size, n_jobs=n_jobs, verbose=verbose
+    )
+
+
+def map_tile_slices(n, func, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1, verbose=0):
+    """ Call func(rows, cols) for each tile on or above the diagonal of an nxn matrix
+
+    The calls are made in parallel using joblib threads. See map_correlation_tiles.
+
+    Returns:
+        A list containing the return value of func for each tile.
+    """
+    blocks = block_slices(n, block_size)
+    tiles = [(rows, cols) for i, rows in enumerate(blocks) for cols in blocks[i:]]
+
+    logger.info(f"Processing {len(tiles):,} tiles with joblib")
+    return joblib.Parallel(n_jobs=n_jobs, prefer="threads", verbose=verbose)(
+        joblib.delayed(func)(rows, cols) for rows, cols in tiles
     )
-    cov = np.array(cov)
-    r = cov / np.outer(y_std, y_std)
+
+
+def correlation_tile(z, rows, cols):
+    """ Compute the correlations between two slices of columns of standardised data """
+    tile = z[:, rows].T @ z[:, cols]
+    if rows == cols:
+        # Make diagonal tiles exactly symmetric
+        tile += tile.T
+        tile /= 2
 
     # We clip the result for numerical stability. The correlation can be slightly
     # greater than 1 before doing this thanks to numerical instability.
-    return np.clip(r, -1, 1)
+    return np.clip(tile, -1, 1, out=tile)
+
+
+def block_slices(n, block_size):
+    """ Split range(n) into consecutive slices of length (at most) block_size """
+    return [slice(i, min(i + block_size, n)) for i in range(0, n, block_size)]
@@ -11,7 +11,15 @@ DOWNSAMPLE_DEGREES = 2
 Default number of degrees of latitude and longitude for grid of down-sampled data.
 
 If we do not down-sample then the matrices are huge and we hit both memory and cpu time
-issues.
+issues. Setting this to 1 runs at the native resolution, in which case the correlation
+matrix is only ever held on disk (see CORRELATION_MEMORY_BUDGET).
+"""
+
+SEASONAL_REFERENCE_PERIOD = None
+"""
+Optional (first_year, last_year) over which to average each month to remove seasonality.
+
+If None then the whole series is used. A typical alternative is (1961, 1990).
 """
 
 LOW_PASS_CUTOFF = 1/13
@@ -19,13 +27,141 @@ LOW_PASS_CUTOFF = 1/13
 LOW_PASS_BUTTER_ORDER = 8
 """Order of the low-pass Butterworth filter used when generating the anomaly series"""
 
+ANOMALY_BLOCK_SIZE = 256
+"""Number of spatial locations processed together when generating the anomaly series"""
+ANOMALY_BAND_LATITUDES = 10
+"""Number of latitudes of the raw SST data read at a time to generate anomaly series"""
+
+CORRELATION_BLOCK_SIZE = 1024
+"""Number of spatial locations along each side of a tile of the correlation matrix"""
+CORRELATION_DTYPE = "float64"
+"""Floating point type used to accumulate (and store) the correlations"""
+CORRELATION_MEMORY_BUDGET = 4 * 1024 ** 3
+"""Approximate bound (in bytes) on RAM used when streaming correlations to disk"""
+CORRELATION_STORE_RANK = None
+"""
+Number of singular vectors kept in the correlation store, or None to keep them all.
+
+With None the store holds the standardised anomaly series and the correlations computed
+from it are exact. Otherwise the largest error in any correlation is logged and saved.
+"""
+
+INCREMENTAL_FILTER_TOLERANCE = 1e-6
+"""
+Relative size below which the low-pass filter's impulse response is treated as zero.
+
+This determines how much of the end of the anomaly series is re-filtered when new months
+are appended by an incremental update.
+"""
+INCREMENTAL_DRIFT_SAMPLE_SIZE = 200
+"""Number of spatial locations recomputed from scratch to check incremental updates"""
+
 CORRELATION_THRESHOLD = 0.4
 """Threshold above which a correlation will be converted to an edge in the network"""
 
+TOP_K_NEIGHBOURS = 20
+"""Number of most strongly correlated partners kept by each node in top-k networks"""
+TOP_K_SYMMETRISE = "union"
+"""How top-k choices become undirected edges: "union" or "mutual" (both must choose)"""
+
+SIGNIFICANCE_N_SURROGATES = 200
+"""Number of phase-randomised surrogates used to test the significance of each edge"""
+SIGNIFICANCE_MIN_CORRELATION = 0.2
+"""Correlations weaker than this are not tested for significance (nor used as edges)"""
+SIGNIFICANCE_P_VALUE_METHOD = "gaussian"
+"""
+How p-values are computed from the surrogates: "empirical" or "gaussian".
+
+Empirical p-values cannot be smaller than 1 / (1 + SIGNIFICANCE_N_SURROGATES), which is
+too coarse when correcting for millions of tests, so by default a normal approximation
+to the Fisher z-transformed null distribution of each correlation is used instead.
+"""
+SIGNIFICANCE_FDR = 0.05
+"""False discovery rate used to select significant correlations as edges"""
+SIGNIFICANCE_SEED = 0
+"""Base seed from which the surrogates for each block of locations are seeded"""
+SIGNIFICANCE_BLOCK_SIZE = 256
+"""Number of spatial locations along each side of a tile when testing significance"""
+SIGNIFICANCE_BATCH_SIZE = 16
+"""Number of surrogates generated and correlated together within each tile"""
+
+LAGGED_MAX_LAG = 12
+"""Largest lag (in months, in either direction) considered for lagged correlations"""
+LAGGED_BLOCK_SIZE = 64
+"""
+Number of spatial locations along each side of a tile of the lagged correlations.
+
+Each tile holds the cross-correlations at every lag, so uses memory proportional to the
+length of the series times the square of this.
+"""
+
+THRESHOLD_SWEEP_VALUES = [0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6, 0.65, 0.7, 0.8, 0.9]
+"""Correlation thresholds at which to compute graph statistics in the threshold sweep"""
+THRESHOLD_SWEEP_NETWORKS = [0.3, 0.5]
+"""Thresholds (no lower than those swept) whose networks are saved by the sweep"""
+
+WINDOW_LENGTH_MONTHS = 360
+"""Number of months in each window of the sliding window (time-evolving) networks"""
+WINDOW_STEP_MONTHS = 12
+"""Number of months between the starts of consecutive sliding windows"""
+
+ANALYTICS_BLOCK_SIZE = 512
+"""Number of nodes whose triangles are counted together when computing clustering"""
+ANALYTICS_DENSE_DENSITY = 0.05
+"""
+Edge density above which triangles are counted with dense (BLAS) rather than sparse
+matrix products when computing clustering.
+
+The dense products hold the adjacency matrix as float32, using 4 n^2 bytes, so they
+are only used if this (and a block of the product) fits in CORRELATION_MEMORY_BUDGET.
+"""
+ANALYTICS_LINK_LENGTH_BINS = 100
+"""Number of bins in the histogram of great circle link lengths"""
+EARTH_RADIUS_KM = 6371
+"""Mean radius of the Earth, used for great circle distances"""
+
 
 MODULARITY_MAXIMISATION_RESOLUTION = 1
 """Default resolution for detecting communities via modularity maximisation"""
 
+COMMUNITY_SEED = 0
+"""Seed for the community detection algorithms (and the base seed for ensembles)"""
+ENSEMBLE_N_RUNS = 20
+"""Number of seeded runs of each algorithm in ensemble community detection"""
+ENSEMBLE_CONSENSUS_THRESHOLD = 0.5
+"""
+Fraction of the runs of an ensemble in which two adjacent nodes must be in the same
+community for them to be in the same consensus community.
+"""
+
+PARTITION_COMPARISON_PARALLEL_PAIRS = 100
+"""
+Minimum number of pairs of partitions for which they are compared in a process pool
+(rather than one after another in this process)
+"""
+
+SURPRISE_OPTIMISER = "cdlib"
+"""
+Implementation used to maximise asymptotic surprise.
+
+Either "cdlib", for cdlib.algorithms.surprise_communities (which requires leidenalg),
+or "native", for the optimiser in ma4m4.surprise. The native optimiser should only be
+made the default once community_detection.benchmark_asymptotic_surprise shows that it
+finds partitions with surprise close to those from cdlib (see the README for the
+results so far).
+"""
+SURPRISE_TIME_BUDGET = None
+"""Time (in seconds) after which the native surprise optimiser stops, if not None"""
+
 
 PLOT_MAX_COMMUNITIES = 20
 """The maximum number of communities to show in plots"""
+FIGURE_EXPORT_WORKERS = None
+"""
+Number of worker processes which save figures in the background (one format of one
+figure each), or None for the number of CPUs.
+"""
+
+
+STEP_CACHE_MAX_BYTES = 50 * 1024 ** 3
+"""Maximum size (in bytes) of the pipeline step cache before old entries are evicted"""
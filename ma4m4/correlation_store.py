@@ -0,0 +1,167 @@
+import numpy as np
+
+from ma4m4.compute_correlations import (
+    block_slices,
+    concatenate_edges,
+    correlation_tile,
+    map_correlation_tiles,
+    standardise,
+    threshold_tile,
+)
+from ma4m4.constants import (
+    CORRELATION_BLOCK_SIZE,
+    CORRELATION_DTYPE,
+    CORRELATION_STORE_RANK,
+    CORRELATION_THRESHOLD,
+)
+from ma4m4.utils import log_duration
+
+
+class CorrelationStore:
+    """ The correlations between n locations, stored as a factor rather than an nxn
+    matrix
+
+    The correlation between locations i and j is factor[:, i] @ factor[:, j], where the
+    mxn factor is either the standardised anomaly series (so m is the number of months
+    and the correlations are exact) or a truncated SVD of them (so m is the rank). Any
+    row, block or thresholded neighbourhood of the correlation matrix can then be
+    computed on demand, using memory proportional to its size rather than n^2.
+
+    Args:
+        factor: An mxn matrix (which may be a memmap).
+        latitude: An n-element vector with the latitude of each location.
+        longitude: An n-element vector with the longitude of each location.
+        residual: An n-element vector with 1 - factor[:, i] @ factor[:, i] for each
+            location, i.e. the variance lost by any truncation. The error in the
+            correlation between locations i and j is at most sqrt(residual[i] *
+            residual[j]).
+    """
+
+    def __init__(self, factor, latitude, longitude, residual):
+        self.factor = factor
+        self.latitude = latitude
+        self.longitude = longitude
+        self.residual = residual
+
+    @classmethod
+    def from_anomaly_series(
+        cls,
+        latitude,
+        longitude,
+        sst_anomaly,
+        rank=CORRELATION_STORE_RANK,
+        dtype=CORRELATION_DTYPE,
+    ):
+        """ Build the store from the txn anomaly series
+
+        Args:
+            rank: If given then keep only this many singular vectors of the
+                standardised series, otherwise keep the series themselves.
+            dtype: Floating point type of the stored factor.
+        """
+        z = standardise(sst_anomaly, dtype="float64")
+        if rank is not None and rank < min(z.shape):
+            # z = U S V^T, so z^T z = (S V^T)^T (S V^T)
+            _, s, vt = np.linalg.svd(z, full_matrices=False)
+            z = s[:rank, np.newaxis] * vt[:rank]
+
+        residual = np.maximum(1 - np.einsum("ij,ij->j", z, z), 0)
+        return cls(z.astype(dtype, copy=False), latitude, longitude, residual)
+
+    def number_of_nodes(self):
+        return self.factor.shape[1]
+
+    def error_bound(self):
+        """ Upper bound on the absolute error in any correlation """
+        return float(np.max(self.residual, initial=0))
+
+    def row(self, i):
+        """ The correlations between location i and every location """
+        return self.block([i], slice(None))[0]
+
+    def block(self, rows, cols):
+        """ The block of the correlation matrix with the given rows and columns
+
+        Args:
+            rows: A slice or array of location indices.
+            cols: A slice or array of location indices.
+        """
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            return correlation_tile(self.factor, rows, cols)
+
+        tile = self.factor[:, rows].T @ self.factor[:, cols]
+        return np.clip(tile, -1, 1, out=tile)
+
+    def neighbours(self, i, threshold=CORRELATION_THRESHOLD, two_sided=True):
+        """ The locations whose correlation with location i is beyond the threshold
+
+        Returns:
+            Tuple: (indices, correlations), excluding location i itself.
+        """
+        row = self.row(i)
+        strength = np.abs(row) if two_sided else row
+        is_neighbour = strength >= threshold
+        is_neighbour[i] = False
+
+        [indices] = np.nonzero(is_neighbour)
+        return indices, row[indices]
+
+    @log_duration("threshold stored correlations")
+    def edges(
+        self,
+        threshold=CORRELATION_THRESHOLD,
+        two_sided=True,
+        block_size=CORRELATION_BLOCK_SIZE,
+        n_jobs=-1,
+    ):
+        """ The correlations beyond the threshold above the diagonal, in COO format
+
+        See compute_thresholded_correlation, which gives the same result from the
+        anomaly series.
+        """
+        tiles = map_correlation_tiles(
+            self.factor,
+            lambda rows, cols, tile: threshold_tile(
+                rows, cols, tile, threshold, two_sided
+            ),
+            block_size=block_size,
+            n_jobs=n_jobs,
+        )
+        return concatenate_edges(tiles)
+
+    @log_duration("histogram stored correlations")
+    def histogram(self, bins=100, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1):
+        """ Histogram of the correlations above the diagonal
+
+        Args:
+            bins: Number of equal width bins between -1 and 1, or the bin edges.
+
+        Returns:
+            Tuple: (counts, bin_edges) as for np.histogram.
+        """
+        bin_edges = np.histogram_bin_edges([], bins=bins, range=(-1, 1))
+
+        def count_tile(rows, cols, tile):
+            if cols.start < rows.stop:
+                tile = tile[np.triu(np.ones(tile.shape, dtype=bool), k=1)]
+            return np.histogram(tile, bins=bin_edges)[0]
+
+        tiles = map_correlation_tiles(
+            self.factor, count_tile, block_size=block_size, n_jobs=n_jobs
+        )
+        return np.sum(tiles, axis=0), bin_edges
+
+
+def dense_correlation_histogram(correlation, bins=100):
+    """ Histogram of the entries above the diagonal of a dense correlation matrix
+
+    The matrix is read in blocks of rows, so it may be a memmap.
+    """
+    bin_edges = np.histogram_bin_edges([], bins=bins, range=(-1, 1))
+    n_nodes = correlation.shape[0]
+    counts = np.zeros(len(bin_edges) - 1, dtype="int64")
+    for rows in block_slices(n_nodes, CORRELATION_BLOCK_SIZE):
+        tile = correlation[rows, rows.start:]
+        upper = np.triu(np.ones(tile.shape, dtype=bool), k=1)
+        counts += np.histogram(tile[upper], bins=bin_edges)[0]
+    return counts, bin_edges
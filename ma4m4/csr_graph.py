@@ -0,0 +1,116 @@
+import hashlib
+
+import networkx as nx
+import numpy as np
+import scipy.sparse
+
+
+class CSRGraph:
+    """ A lightweight, undirected graph stored as a symmetric CSR adjacency matrix
+
+    This holds the same information as the networkx graphs produced by build_network
+    (node latitudes and longitudes, and an abs_corr attribute on each edge) but in
+    flat arrays, so that it can be built, saved and analysed without any per-node or
+    per-edge Python objects. Nodes are identified by their index 0, ..., n-1.
+
+    Args:
+        indptr: CSR index pointer array of length n+1.
+        indices: CSR column indices. Each edge appears twice (once for each endpoint).
+        abs_corr: The abs_corr weight for each entry in indices.
+        latitude: An n-element vector of node latitudes.
+        longitude: An n-element vector of node longitudes.
+    """
+
+    def __init__(self, indptr, indices, abs_corr, latitude, longitude):
+        self.indptr = indptr
+        self.indices = indices
+        self.abs_corr = abs_corr
+        self.latitude = latitude
+        self.longitude = longitude
+
+    @classmethod
+    def from_edges(cls, latitude, longitude, row, col, abs_corr):
+        """ Build the graph from a list of edges, each of which is given once """
+        n_nodes = len(latitude)
+        adj = scipy.sparse.csr_matrix(
+            (
+                np.concatenate([abs_corr, abs_corr]),
+                (np.concatenate([row, col]), np.concatenate([col, row])),
+            ),
+            shape=(n_nodes, n_nodes),
+        )
+        return cls(adj.indptr, adj.indices, adj.data, latitude, longitude)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """ Convert a networkx graph from build_network, with nodes 0, ..., n-1 """
+        n_nodes = graph.number_of_nodes()
+        if set(graph.nodes) != set(range(n_nodes)):
+            raise ValueError("Expected the graph nodes to be labelled 0, ..., n-1")
+
+        nodes = graph.nodes
+        latitude = np.array([nodes[n]["latitude"] for n in range(n_nodes)])
+        longitude = np.array([nodes[n]["longitude"] for n in range(n_nodes)])
+        edges = np.array(list(graph.edges(data="abs_corr")), dtype="float64")
+        edges = edges.reshape(-1, 3)
+        row, col = edges[:, 0].astype("int32"), edges[:, 1].astype("int32")
+        return cls.from_edges(latitude, longitude, row, col, edges[:, 2])
+
+    def number_of_nodes(self):
+        return len(self.indptr) - 1
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def fingerprint(self):
+        """ A hash of the nodes and edges (but not the edge weights) of the graph """
+        digest = hashlib.sha256()
+        for arr in [self.indptr, self.indices, self.latitude, self.longitude]:
+            digest.update(np.ascontiguousarray(arr))
+        return digest.hexdigest()
+
+    def degrees(self):
+        """ The degree of each node, as an array """
+        return np.diff(self.indptr)
+
+    def adjacency(self, weight=None):
+        """ The adjacency matrix as a scipy CSR matrix
+
+        Args:
+            weight: Either None, for a binary adjacency matrix, or "abs_corr".
+        """
+        if weight is None:
+            data = np.ones(len(self.indices), dtype="int8")
+        elif weight == "abs_corr":
+            data = self.abs_corr
+        else:
+            raise ValueError(f"Unknown edge weight: {weight!r}")
+
+        n_nodes = self.number_of_nodes()
+        return scipy.sparse.csr_matrix(
+            (data, self.indices, self.indptr), shape=(n_nodes, n_nodes)
+        )
+
+    def edges(self):
+        """ The edges (each given once, with row < col) as COO arrays
+
+        Returns:
+            Tuple: (row, col, abs_corr)
+        """
+        upper = scipy.sparse.triu(self.adjacency("abs_corr"), k=1).tocoo()
+        return upper.row, upper.col, upper.data
+
+    def to_networkx(self):
+        """ Convert to a networkx graph with the attributes used by build_network """
+        graph = nx.Graph()
+        graph.add_nodes_from(
+            (i, {"latitude": lat, "longitude": long})
+            for i, (lat, long) in enumerate(
+                zip(self.latitude.tolist(), self.longitude.tolist())
+            )
+        )
+        row, col, abs_corr = self.edges()
+        graph.add_weighted_edges_from(
+            zip(row.tolist(), col.tolist(), abs_corr.tolist()), weight="abs_corr"
+        )
+        return graph
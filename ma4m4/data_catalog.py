@@ -1,3 +1,4 @@
+import csv
 import logging
 import os
 import pickle
@@ -5,6 +6,10 @@ import pickle
 import netCDF4 as nc
 import numpy as np
 
+from ma4m4.community_labels import CommunityLabels
+from ma4m4.correlation_store import CorrelationStore
+from ma4m4.csr_graph import CSRGraph
+from ma4m4.figure_export import export_figure
 from ma4m4.utils import log_duration, safe_unmask_array
 
 
@@ -16,17 +21,57 @@ RAW_DIR = os.path.join(DATA_DIR, "01_raw")
 INTERMEDIATES_DIR = os.path.join(DATA_DIR, "02_intermediates")
 OUTPUTS_DIR = os.path.join(DATA_DIR, "03_outputs")
 REPORTING_DIR = os.path.join(DATA_DIR, "04_reporting")
+CACHE_DIR = os.path.join(DATA_DIR, "05_cache")
 
 FILE_PATHS = {
     "raw_hadisst": os.path.join(RAW_DIR, "HadISST_sst.nc"),
-    "correlations": os.path.join(INTERMEDIATES_DIR, "correlations.npz"),
-    "network": os.path.join(INTERMEDIATES_DIR, "network.pkl"),
-    "communities": os.path.join(OUTPUTS_DIR, "communities_{name}.pkl"),
+    "anomaly": os.path.join(INTERMEDIATES_DIR, "anomaly", "{key}.npy"),
+    "anomaly_meta": os.path.join(INTERMEDIATES_DIR, "anomaly", "meta.pkl"),
+    "correlations": os.path.join(INTERMEDIATES_DIR, "correlations", "{key}.npy"),
+    "correlations_meta": os.path.join(INTERMEDIATES_DIR, "correlations", "meta.pkl"),
+    "correlation_store": os.path.join(
+        INTERMEDIATES_DIR, "correlation_store", "{key}.npy"
+    ),
+    "correlation_store_meta": os.path.join(
+        INTERMEDIATES_DIR, "correlation_store", "meta.pkl"
+    ),
+    "correlation_stats": os.path.join(
+        INTERMEDIATES_DIR, "correlation_stats", "{key}.npy"
+    ),
+    "correlation_stats_meta": os.path.join(
+        INTERMEDIATES_DIR, "correlation_stats", "meta.pkl"
+    ),
+    "correlation_edges": os.path.join(INTERMEDIATES_DIR, "correlation_edges.npz"),
+    "correlation_significance": os.path.join(
+        INTERMEDIATES_DIR, "correlation_significance.npz"
+    ),
+    "lagged_correlation_edges": os.path.join(
+        INTERMEDIATES_DIR, "lagged_correlation_edges.npz"
+    ),
+    "network_windows": os.path.join(INTERMEDIATES_DIR, "network_windows.npz"),
+    "network": os.path.join(INTERMEDIATES_DIR, "network", "{key}.npy"),
+    "network_meta": os.path.join(INTERMEDIATES_DIR, "network", "meta.pkl"),
+    "threshold_network": os.path.join(
+        INTERMEDIATES_DIR, "threshold_networks", "{threshold}_{key}.npy"
+    ),
+    "threshold_network_meta": os.path.join(
+        INTERMEDIATES_DIR, "threshold_networks", "{threshold}_meta.pkl"
+    ),
+    "threshold_sweep": os.path.join(OUTPUTS_DIR, "threshold_sweep.csv"),
+    "network_analytics": os.path.join(OUTPUTS_DIR, "network_analytics.npz"),
+    "communities": os.path.join(OUTPUTS_DIR, "communities_{name}.npz"),
+    "partition_comparison": os.path.join(OUTPUTS_DIR, "partition_comparison.npz"),
+    "ensemble_runs": os.path.join(OUTPUTS_DIR, "ensemble_runs_{name}.npy"),
+    "community_stability": os.path.join(
+        OUTPUTS_DIR, "community_stability_{name}.npy"
+    ),
     "correlations_plot_pdf": os.path.join(REPORTING_DIR, "correlations.pdf"),
     "correlations_plot_jpg": os.path.join(REPORTING_DIR, "correlations.jpg"),
     "community_comparison_plot_eps": os.path.join(REPORTING_DIR, "community_comparison.eps"),
     "community_comparison_plot_jpg": os.path.join(REPORTING_DIR, "community_comparison.jpg"),
     "community_plot": os.path.join(REPORTING_DIR, "communities_{name}.{fmt}"),
+    "network_analytics_plot": os.path.join(REPORTING_DIR, "network_analytics.{fmt}"),
+    "step_cache": os.path.join(CACHE_DIR, "{step}-{key}"),
 }
 
 
@@ -46,9 +91,60 @@ def setup_directory_structure():
 
 
 @log_duration("load raw sst data")
-def load_raw_sst_data():
-    """Load the raw SST data and perform low-level type conversions"""
+def load_raw_sst_data(
+    min_latitude=None,
+    max_latitude=None,
+    min_longitude=None,
+    max_longitude=None,
+    stride=1,
+    time_slice=None,
+    latitude_rows=None,
+):
+    """Load the raw SST data and perform low-level type conversions
+
+    Only the hyperslab of the grid within the given latitude and longitude bounds (all
+    optional and inclusive) is read from the file. If stride is greater than one then
+    only every stride-th grid point is read along each axis, aligned so that the points
+    kept are the same as those kept by downsample_anomaly_series with
+    downsample_degrees=stride (this assumes the 1 degree HadISST grid). Similarly, if
+    time_slice is given then only that slice of the time axis is read, and if
+    latitude_rows is given then only that slice of the rows of the latitude grid is read
+    (ignoring the latitude bounds and stride).
+    """
+    ds = _open_raw_sst_data()
+    if time_slice is None:
+        time_slice = slice(None)
+
+    data = _read_raw_sst_grid(ds, time_slice)
+    latitude, longitude = data["latitude"], data["longitude"]
+
+    if latitude_rows is None:
+        lat_slice = _hyperslab(latitude, min_latitude, max_latitude, stride)
+    else:
+        lat_slice = latitude_rows
+    long_slice = _hyperslab(longitude, min_longitude, max_longitude, stride)
+    logger.info(f"Reading sst hyperslab: {lat_slice=}, {long_slice=}")
+
+    sst = ds["sst"][time_slice, lat_slice, long_slice].astype("float64")
 
+    return {
+        **data,
+        "latitude": latitude[lat_slice],
+        "longitude": longitude[long_slice],
+        "sst": sst,
+    }
+
+
+def load_raw_sst_grid():
+    """ Load the times and the latitude and longitude grid of the raw SST data
+
+    The result is as from load_raw_sst_data, but without the sst itself.
+    """
+    with _open_raw_sst_data() as ds:
+        return _read_raw_sst_grid(ds, slice(None))
+
+
+def _open_raw_sst_data():
     if not os.path.isfile(FILE_PATHS["raw_hadisst"]):
         raise FileNotFoundError(
             f"Expected raw data at: {FILE_PATHS['raw_hadisst']!r}. This can be "
@@ -57,9 +153,11 @@ def load_raw_sst_data():
             f"and should be unzipped in the expected location."
         )
 
-    ds = nc.Dataset(FILE_PATHS["raw_hadisst"])
+    return nc.Dataset(FILE_PATHS["raw_hadisst"])
+
 
-    time_days = safe_unmask_array(ds["time"][:], "time").astype("float64")
+def _read_raw_sst_grid(ds, time_slice):
+    time_days = safe_unmask_array(ds["time"][time_slice], "time").astype("float64")
 
     times = nc.num2date(time_days, ds["time"].units, ds["time"].calendar)
     times = times.astype("datetime64[us]")
@@ -67,90 +165,723 @@ def load_raw_sst_data():
     latitude = safe_unmask_array(ds["latitude"][:], "latitude").astype("float64")
     longitude = safe_unmask_array(ds["longitude"][:], "longitude").astype("float64")
 
-    sst = ds["sst"][:].astype("float64")
-
     return {
         "time_days": time_days,
         "time": times,
         "latitude": latitude,
         "longitude": longitude,
-        "sst": sst,
     }
 
 
-@log_duration("save correlations")
-def save_correlations(latitude, longitude, correlation, meta):
-    """ Save the correlations as an intermediate dataset """
+def _hyperslab(coords, lower, upper, stride):
+    """ Find the slice of a monotonic coordinate vector within the bounds """
+    in_bounds = np.ones(coords.shape, dtype="bool")
+    if lower is not None:
+        in_bounds &= coords >= lower
+    if upper is not None:
+        in_bounds &= coords <= upper
+    if stride > 1:
+        in_bounds &= coords % stride == 0.5
+
+    ix = np.flatnonzero(in_bounds)
+    if len(ix) == 0:
+        raise ValueError(f"No grid points in the range [{lower}, {upper}]")
+
+    return slice(ix[0], ix[-1] + 1, stride)
+
+
+ANOMALY_ARRAYS = ["time", "latitude", "longitude", "lat_index", "lon_index"]
+
+
+@log_duration("save anomaly series")
+def save_anomaly_series(
+    time, latitude, longitude, lat_index, lon_index, sst_anomaly, meta
+):
+    """ Save the packed anomaly series as an intermediate dataset
+
+    The dataset is a directory of .npy files. The txk sst_anomaly matrix holds one
+    column per (unmasked) spatial location, whose indices into the latitude and
+    longitude grid vectors are given by lat_index and lon_index. It is saved in
+    column-major order, so that the time series for each location is contiguous on disk
+    and subsets of locations can be read cheaply through a memmap. If sst_anomaly is
+    already a memmap of the target file (see open_anomaly_for_writing) then it is only
+    flushed.
+    """
+    arrays = {
+        "time": time,
+        "latitude": latitude,
+        "longitude": longitude,
+        "lat_index": lat_index,
+        "lon_index": lon_index,
+    }
+    for key, arr in arrays.items():
+        _save_array(FILE_PATHS["anomaly"].format(key=key), arr)
+    if not isinstance(sst_anomaly, np.memmap):
+        sst_anomaly = np.asfortranarray(sst_anomaly)
+    _save_array(FILE_PATHS["anomaly"].format(key="sst_anomaly"), sst_anomaly)
+
+    with open(FILE_PATHS["anomaly_meta"], "wb") as f:
+        pickle.dump(meta, f)
+
+
+def open_anomaly_for_writing(shape):
+    """ Create the file for the txk sst_anomaly matrix as a writable memmap
+
+    It is in column-major order, as saved by save_anomaly_series.
+    """
+    return open_array_for_writing(
+        FILE_PATHS["anomaly"].format(key="sst_anomaly"),
+        shape=shape,
+        dtype="float64",
+        fortran_order=True,
+    )
+
+
+@log_duration("load anomaly series")
+def load_anomaly_series(mmap_mode="r"):
+    """ Load the packed anomaly series intermediate dataset
+
+    The sst_anomaly matrix is memory-mapped (unless mmap_mode is None), so is only read
+    from disk as it is accessed.
+    """
+    anomaly = {
+        key: np.load(FILE_PATHS["anomaly"].format(key=key)) for key in ANOMALY_ARRAYS
+    }
+    anomaly["sst_anomaly"] = np.load(
+        FILE_PATHS["anomaly"].format(key="sst_anomaly"), mmap_mode=mmap_mode
+    )
+    with open(FILE_PATHS["anomaly_meta"], "rb") as f:
+        meta = pickle.load(f)
+
+    logger.info(f"Loaded anomaly series with meta data: {meta}")
+
+    return anomaly, meta
+
+
+@log_duration("load correlations")
+def load_correlations(mmap_mode="r"):
+    """ Load the correlations intermediate dataset
+
+    The correlation matrix is memory-mapped (unless mmap_mode is None), so is only read
+    from disk as it is accessed.
+    """
+    correlations = {
+        "latitude": np.load(FILE_PATHS["correlations"].format(key="latitude")),
+        "longitude": np.load(FILE_PATHS["correlations"].format(key="longitude")),
+        "correlation": np.load(
+            FILE_PATHS["correlations"].format(key="correlation"), mmap_mode=mmap_mode
+        ),
+    }
+    with open(FILE_PATHS["correlations_meta"], "rb") as f:
+        meta = pickle.load(f)
+
+    logger.info(f"Loaded correlations with meta data: {meta}")
+
+    return correlations, meta
+
+
+CORRELATION_STORE_ARRAYS = ["factor", "latitude", "longitude", "residual"]
+
+
+@log_duration("save correlation store")
+def save_correlation_store(store, meta):
+    """ Save a CorrelationStore as a directory of .npy files
+
+    This holds the factor from which the correlations are computed, which is much
+    smaller than the correlation matrix itself when there are more locations than
+    months (or than the rank of the factor).
+    """
+    for key in CORRELATION_STORE_ARRAYS:
+        path = FILE_PATHS["correlation_store"].format(key=key)
+        _save_array(path, getattr(store, key))
+
+    with open(FILE_PATHS["correlation_store_meta"], "wb") as f:
+        pickle.dump(meta, f)
+
+
+@log_duration("load correlation store")
+def load_correlation_store(mmap_mode="r"):
+    """ Load the CorrelationStore saved by save_correlation_store
+
+    The factor is memory-mapped (unless mmap_mode is None).
+    """
+    arrays = {
+        key: np.load(
+            FILE_PATHS["correlation_store"].format(key=key),
+            mmap_mode=mmap_mode if key == "factor" else None,
+        )
+        for key in CORRELATION_STORE_ARRAYS
+    }
+    with open(FILE_PATHS["correlation_store_meta"], "rb") as f:
+        meta = pickle.load(f)
+
+    logger.info(f"Loaded correlation store with meta data: {meta}")
+
+    return CorrelationStore(**arrays), meta
+
+
+CORRELATION_STATS_ARRAYS = [
+    "latitude",
+    "longitude",
+    "lat_index",
+    "lon_index",
+    "time_days",
+    "trend_mean",
+    "trend_slope",
+    "climatology",
+    "unfiltered_tail",
+    "filtered_tail",
+    "sum",
+    "cross_product",
+]
+
+
+@log_duration("save incremental correlations")
+def save_incremental_correlations(correlation, stats, meta):
+    """ Save the correlations along with the statistics used to update them
+
+    Every file of both datasets is first written to a temporary path and they are only
+    renamed into place once all have been written, so a failure part way through an
+    update (e.g. in the drift check) never leaves the saved correlations and statistics
+    out of step with each other (e.g. with the new months added to the cross-products
+    but not to time_days, so that a retry adds them twice).
+
+    Args:
+        correlation: The correlation matrix. It may already be a memmap of its
+            temporary file, created by open_correlation_for_writing.
+        stats: Dictionary containing each of CORRELATION_STATS_ARRAYS (see
+            ma4m4.incremental). The cross_product matrix may already be a memmap of its
+            temporary file, created by open_cross_product_for_writing.
+        meta: Meta data dictionary, saved using pickle with both datasets.
+    """
+    arrays = {
+        FILE_PATHS["correlations"].format(key="latitude"): stats["latitude"],
+        FILE_PATHS["correlations"].format(key="longitude"): stats["longitude"],
+        FILE_PATHS["correlations"].format(key="correlation"): correlation,
+        **{
+            FILE_PATHS["correlation_stats"].format(key=key): stats[key]
+            for key in CORRELATION_STATS_ARRAYS
+        },
+    }
+    for path, arr in arrays.items():
+        _save_array(_temporary_path(path), arr)
+
+    meta_paths = [FILE_PATHS["correlations_meta"], FILE_PATHS["correlation_stats_meta"]]
+    for path in meta_paths:
+        with open(_temporary_path(path), "wb") as f:
+            pickle.dump(meta, f)
+
+    for path in [*arrays, *meta_paths]:
+        os.replace(_temporary_path(path), path)
+
+
+def open_correlation_for_writing(shape, dtype):
+    """ Create the temporary file for the correlation matrix as a writable memmap
+
+    The matrix is moved into place by save_incremental_correlations, so the saved
+    correlations are unchanged until then.
+    """
+    path = _temporary_path(FILE_PATHS["correlations"].format(key="correlation"))
+    return open_array_for_writing(path, shape=shape, dtype=dtype)
+
+
+def open_cross_product_for_writing(shape, copy_from=None, block_size=1024):
+    """ Create the temporary file for the cross_product matrix as a writable memmap
+
+    The matrix is moved into place by save_incremental_correlations, so the saved
+    statistics are unchanged until then.
+
+    Args:
+        shape: Shape of the (square) matrix.
+        copy_from: Matrix (e.g. the saved cross_product memmap) to initialise it from,
+            which is copied a block of rows at a time.
+    """
+    path = _temporary_path(FILE_PATHS["correlation_stats"].format(key="cross_product"))
+    cross_product = open_array_for_writing(path, shape=shape, dtype="float64")
+    if copy_from is not None:
+        for start in range(0, shape[0], block_size):
+            rows = slice(start, start + block_size)
+            cross_product[rows] = copy_from[rows]
+    return cross_product
+
+
+@log_duration("load correlation stats")
+def load_correlation_stats(mmap_mode="r"):
+    """ Load the statistics used to update the correlations incrementally
+
+    Only the (nxn) cross_product matrix is memory-mapped, using mmap_mode. It should not
+    be updated in place: see open_cross_product_for_writing.
+    """
+    stats = {
+        key: np.load(
+            FILE_PATHS["correlation_stats"].format(key=key),
+            mmap_mode=mmap_mode if key == "cross_product" else None,
+        )
+        for key in CORRELATION_STATS_ARRAYS
+    }
+    with open(FILE_PATHS["correlation_stats_meta"], "rb") as f:
+        meta = pickle.load(f)
+
+    logger.info(f"Loaded correlation stats with meta data: {meta}")
+
+    return stats, meta
+
+
+def open_array_for_writing(path, shape, dtype, fortran_order=False):
+    """ Create a new .npy file at path and return it as a writable memmap
+
+    Any existing file is removed first rather than overwritten, since it may be
+    hard-linked into the step cache.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    return np.lib.format.open_memmap(
+        path, mode="w+", shape=shape, dtype=dtype, fortran_order=fortran_order
+    )
+
+
+@log_duration("save correlation edges")
+def save_correlation_edges(latitude, longitude, row, col, value, meta):
+    """ Save the sparse (thresholded) correlations as an intermediate dataset """
 
     np.savez(
-        FILE_PATHS["correlations"],
+        FILE_PATHS["correlation_edges"],
         latitude=latitude,
         longitude=longitude,
-        correlation=correlation,
+        row=row,
+        col=col,
+        value=value,
         meta=meta,  # Saved using pickle
     )
 
 
-@log_duration("load correlations")
-def load_correlations():
-    """ Load the correlations intermediate dataset """
+@log_duration("load correlation edges")
+def load_correlation_edges():
+    """ Load the sparse (thresholded) correlations intermediate dataset """
 
     # We set allow_pickle=True because the metadata is a dictionary stored using pickle
-    with np.load(FILE_PATHS["correlations"], allow_pickle=True) as npz:
-        keys = ["latitude", "longitude", "correlation"]
-        correlations = {k: npz[k] for k in keys}
+    with np.load(FILE_PATHS["correlation_edges"], allow_pickle=True) as npz:
+        keys = ["latitude", "longitude", "row", "col", "value"]
+        edges = {k: npz[k] for k in keys}
         meta = npz["meta"].item()
 
-    logger.info(f"Loaded correlations with meta data: {meta}")
+    logger.info(
+        f"Loaded {len(edges['value']):,} correlation edges with meta data: {meta}"
+    )
 
-    return correlations, meta
+    return edges, meta
+
+
+@log_duration("save correlation significance")
+def save_correlation_significance(edges, meta):
+    """ Save the correlations tested against surrogates, with their p-values
+
+    Args:
+        edges: Dictionary of arrays from compute_correlation_significance.
+        meta: Meta data dictionary, saved using pickle.
+    """
+
+    np.savez(
+        FILE_PATHS["correlation_significance"],
+        **edges,
+        meta=meta,  # Saved using pickle
+    )
+
+
+@log_duration("load correlation significance")
+def load_correlation_significance():
+    """ Load the correlations tested against surrogates, with their p-values """
+
+    # We set allow_pickle=True because the metadata is a dictionary stored using pickle
+    with np.load(FILE_PATHS["correlation_significance"], allow_pickle=True) as npz:
+        edges = {k: npz[k] for k in npz.files if k != "meta"}
+        meta = npz["meta"].item()
+
+    logger.info(
+        f"Loaded {len(edges['value']):,} tested correlations with meta data: {meta}"
+    )
+
+    return edges, meta
+
+
+@log_duration("save lagged correlation edges")
+def save_lagged_correlation_edges(latitude, longitude, row, col, value, lag, meta):
+    """ Save the sparse lagged correlations and lags as an intermediate dataset """
+
+    np.savez(
+        FILE_PATHS["lagged_correlation_edges"],
+        latitude=latitude,
+        longitude=longitude,
+        row=row,
+        col=col,
+        value=value,
+        lag=lag,
+        meta=meta,  # Saved using pickle
+    )
+
+
+@log_duration("load lagged correlation edges")
+def load_lagged_correlation_edges():
+    """ Load the sparse lagged correlations intermediate dataset """
+
+    # We set allow_pickle=True because the metadata is a dictionary stored using pickle
+    with np.load(FILE_PATHS["lagged_correlation_edges"], allow_pickle=True) as npz:
+        keys = ["latitude", "longitude", "row", "col", "value", "lag"]
+        edges = {k: npz[k] for k in keys}
+        meta = npz["meta"].item()
+
+    logger.info(
+        f"Loaded {len(edges['value']):,} lagged correlation edges with meta data: "
+        f"{meta}"
+    )
+
+    return edges, meta
+
+
+NETWORK_WINDOWS_ARRAYS = [
+    "latitude",
+    "longitude",
+    "window_start",
+    "window_end",
+    "edge_ptr",
+    "row",
+    "col",
+    "value",
+    "n_nodes",
+    "n_edges",
+    "mean_degree",
+    "density",
+]
+
+
+@log_duration("save network windows")
+def save_network_windows(windows, meta):
+    """ Save the sliding window networks (see compute_window_networks) in one file """
+
+    np.savez(
+        FILE_PATHS["network_windows"],
+        **{key: windows[key] for key in NETWORK_WINDOWS_ARRAYS},
+        meta=meta,  # Saved using pickle
+    )
+
+
+@log_duration("load network windows")
+def load_network_windows():
+    """ Load the sliding window networks intermediate dataset """
+
+    # We set allow_pickle=True because the metadata is a dictionary stored using pickle
+    with np.load(FILE_PATHS["network_windows"], allow_pickle=True) as npz:
+        windows = {k: npz[k] for k in NETWORK_WINDOWS_ARRAYS}
+        meta = npz["meta"].item()
+
+    logger.info(
+        f"Loaded {len(windows['window_start']):,} sliding window networks with meta "
+        f"data: {meta}"
+    )
+
+    return windows, meta
+
+
+def _save_array(path, arr):
+    """ Save an array as .npy, or just flush it if it is a memmap of that file
+
+    Any other existing file is removed first rather than overwritten, since it may be
+    hard-linked into the step cache.
+    """
+    if isinstance(arr, np.memmap) and _is_same_file(arr.filename, path):
+        arr.flush()
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        np.save(path, arr)
+
+
+def _temporary_path(path):
+    """ Path to write a file to before renaming it to path, keeping its extension """
+    root, ext = os.path.splitext(path)
+    return f"{root}.tmp{ext}"
+
+
+def _is_same_file(path1, path2):
+    return all(os.path.exists(p) for p in [path1, path2]) and os.path.samefile(
+        path1, path2
+    )
+
+
+NETWORK_ARRAYS = ["indptr", "indices", "abs_corr", "latitude", "longitude"]
 
 
 @log_duration("save network")
-def save_network(graph, meta):
-    with open(FILE_PATHS["network"], "wb") as f:
-        pickle.dump({"graph": graph, "meta": meta}, f)
+def save_network(graph, meta, threshold=None):
+    """ Save the network as a directory of .npy files holding its CSR arrays
+
+    Args:
+        graph: Either a networkx graph (as from build_network) or a CSRGraph.
+        meta: Meta data dictionary, saved using pickle along with the fingerprint of
+            the graph (see CSRGraph.fingerprint) under "network_fingerprint".
+        threshold: If given then save the network as one of those from the threshold
+            sweep (see network_at_threshold), rather than as the main network.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_networkx(graph)
+
+    array_path, meta_path = _network_paths(threshold)
+    for key in NETWORK_ARRAYS:
+        _save_array(array_path.format(key=key), getattr(graph, key))
+
+    meta = {**meta, "network_fingerprint": graph.fingerprint()}
+    with open(meta_path, "wb") as f:
+        pickle.dump(meta, f)
 
 
 @log_duration("load network")
-def load_network():
-    with open(FILE_PATHS["network"], "rb") as f:
-        loaded = pickle.load(f)
-    logger.info(f"Loaded network with meta data: {loaded['meta']}")
-    return loaded["graph"], loaded["meta"]
+def load_network(as_networkx=True, mmap_mode="r", threshold=None):
+    """ Load the network saved by save_network
+
+    Args:
+        as_networkx: If true then return a networkx graph, otherwise return a CSRGraph
+            whose arrays are memory-mapped (unless mmap_mode is None).
+        mmap_mode: Passed to np.load for each array.
+        threshold: If given then load the network saved for this threshold by the
+            threshold sweep.
+    """
+    array_path, _ = _network_paths(threshold)
+    arrays = {
+        key: np.load(array_path.format(key=key), mmap_mode=mmap_mode)
+        for key in NETWORK_ARRAYS
+    }
+    graph = CSRGraph(**arrays)
+    if as_networkx:
+        graph = graph.to_networkx()
+
+    meta = _load_network_meta(threshold)
+    logger.info(f"Loaded network with meta data: {meta}")
+    return graph, meta
+
+
+def _load_network_meta(threshold):
+    _, meta_path = _network_paths(threshold)
+    with open(meta_path, "rb") as f:
+        return pickle.load(f)
+
+
+def _network_paths(threshold):
+    if threshold is None:
+        return FILE_PATHS["network"], FILE_PATHS["network_meta"]
+
+    # Pre-fill the threshold, leaving the key to be formatted later
+    fields = {"threshold": f"{threshold:g}", "key": "{key}"}
+    return (
+        FILE_PATHS["threshold_network"].format(**fields),
+        FILE_PATHS["threshold_network_meta"].format(**fields),
+    )
+
+
+@log_duration("save threshold sweep")
+def save_threshold_sweep(table, columns):
+    """ Save the graph statistics from the threshold sweep as a CSV table
+
+    Args:
+        table: A list with a dictionary of statistics for each threshold.
+        columns: The keys of each dictionary to save, in order.
+    """
+    with open(FILE_PATHS["threshold_sweep"], "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(table)
+
+
+def load_threshold_sweep():
+    """ Load the threshold sweep table as a list of dictionaries of numbers """
+    with open(FILE_PATHS["threshold_sweep"], newline="") as f:
+        return [
+            {key: _parse_number(v) for key, v in row.items()}
+            for row in csv.DictReader(f)
+        ]
+
+
+def _parse_number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+@log_duration("save network analytics")
+def save_network_analytics(analytics, meta):
+    """ Save the per-node network analytics (see compute_network_analytics) """
+    np.savez(
+        FILE_PATHS["network_analytics"],
+        **analytics,
+        meta=meta,  # Saved using pickle
+    )
+
+
+@log_duration("load network analytics")
+def load_network_analytics():
+    # We set allow_pickle=True because the metadata is a dictionary stored using pickle
+    with np.load(FILE_PATHS["network_analytics"], allow_pickle=True) as npz:
+        analytics = {k: npz[k] for k in npz.files if k != "meta"}
+        meta = npz["meta"].item()
+
+    logger.info(f"Loaded network analytics with meta data: {meta}")
+    return analytics, meta
 
 
 @log_duration("save communities")
-def save_communities(comms, meta, name):
-    with open(FILE_PATHS["communities"].format(name=name), "wb") as f:
-        pickle.dump({"communities": comms, "meta": meta}, f)
+def save_communities(comms, meta, name, threshold=None):
+    """ Save communities found in the network saved by save_network
+
+    Only the community label of each node is saved, along with the fingerprint of the
+    network from its meta data (rather than a copy of it).
+
+    Args:
+        comms: A cdlib NodeClustering or CommunityLabels.
+        meta: Dictionary of metadata.
+        name: Name of the communities.
+        threshold: The threshold of the network, if it is one saved by the threshold
+            sweep (see load_network).
+    """
+    if not isinstance(comms, CommunityLabels):
+        comms = CommunityLabels.from_node_clustering(comms)
+
+    np.savez(
+        FILE_PATHS["communities"].format(name=name),
+        labels=comms.labels.astype("int32"),
+        sizes=comms.sizes(),
+        network_threshold=threshold,
+        network_fingerprint=_network_fingerprint(threshold),
+        method_name=comms.method_name,
+        method_parameters=comms.method_parameters,  # Saved using pickle
+        meta=meta,  # Saved using pickle
+    )
 
 
 @log_duration("load communities")
 def load_communities(name):
-    with open(FILE_PATHS["communities"].format(name=name), "rb") as f:
-        loaded = pickle.load(f)
-    logger.info(f"Loaded communities with meta data: {loaded['meta']}")
-    return loaded["communities"], loaded["meta"]
+    """ Load communities saved by save_communities
+
+    Returns:
+        Tuple: (comms, meta) where comms is a CommunityLabels. Its to_node_clustering
+            and coordinates methods load the network (checking that it hasn't changed
+            since the communities were saved).
+    """
+    # We set allow_pickle=True because the metadata is a dictionary stored using pickle
+    with np.load(FILE_PATHS["communities"].format(name=name), allow_pickle=True) as npz:
+        labels = npz["labels"]
+        threshold = npz["network_threshold"].item()
+        fingerprint = npz["network_fingerprint"].item()
+        method_name = npz["method_name"].item()
+        method_parameters = npz["method_parameters"].item()
+        meta = npz["meta"].item()
+
+    def check_network():
+        if _network_fingerprint(threshold) != fingerprint:
+            raise ValueError(
+                f"The network has changed since the communities {name!r} were saved"
+            )
+
+    def load_graph():
+        check_network()
+        graph, _ = load_network(as_networkx=True, threshold=threshold)
+        return graph
+
+    def load_coordinates():
+        check_network()
+        array_path, _ = _network_paths(threshold)
+        return tuple(
+            np.load(array_path.format(key=key)) for key in ["latitude", "longitude"]
+        )
+
+    comms = CommunityLabels(
+        labels, method_name, method_parameters, load_graph, load_coordinates
+    )
+    logger.info(
+        f"Loaded {comms.number_of_communities():,} communities with meta data: {meta}"
+    )
+    return comms, meta
+
+
+def _network_fingerprint(threshold):
+    """ The fingerprint of a network, as stored in its meta data by save_network """
+    return _load_network_meta(threshold)["network_fingerprint"]
+
+
+@log_duration("save partition comparison")
+def save_partition_comparison(comparison):
+    """ Save the partition comparison matrices (see compare_partitions) """
+    np.savez(FILE_PATHS["partition_comparison"], **comparison)
+
+
+@log_duration("load partition comparison")
+def load_partition_comparison():
+    with np.load(FILE_PATHS["partition_comparison"]) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+def save_community_stability(stability, name):
+    """ Save the stability of each node in the consensus communities with this name """
+    np.save(FILE_PATHS["community_stability"].format(name=name), stability)
+
+
+def load_community_stability(name):
+    return np.load(FILE_PATHS["community_stability"].format(name=name))
+
+
+def save_ensemble_runs(runs, name):
+    """ Save the community labels from each run of the ensemble with this name """
+    np.save(FILE_PATHS["ensemble_runs"].format(name=name), runs)
+
+
+def load_ensemble_runs(name):
+    return np.load(FILE_PATHS["ensemble_runs"].format(name=name))
 
 
 @log_duration("save correlations plot")
 def save_correlations_plot(fig):
-    fig.savefig(FILE_PATHS["correlations_plot_pdf"])
-    fig.savefig(FILE_PATHS["correlations_plot_jpg"], dpi=240, facecolor="white")
+    return _export_plot(
+        fig, FILE_PATHS["correlations_plot_pdf"], FILE_PATHS["correlations_plot_jpg"]
+    )
 
 
 @log_duration("save community comparison plot")
 def save_community_comparison_plot(fig):
-    fig.savefig(FILE_PATHS["community_comparison_plot_eps"])
-    fig.savefig(FILE_PATHS["community_comparison_plot_jpg"], dpi=240, facecolor="white")
+    return _export_plot(
+        fig,
+        FILE_PATHS["community_comparison_plot_eps"],
+        FILE_PATHS["community_comparison_plot_jpg"],
+    )
+
+
+@log_duration("save network analytics plot")
+def save_network_analytics_plot(fig):
+    return _export_plot(
+        fig,
+        FILE_PATHS["network_analytics_plot"].format(fmt="pdf"),
+        FILE_PATHS["network_analytics_plot"].format(fmt="jpg"),
+    )
 
 
 @log_duration("save community plot")
 def save_community_plot(fig, name):
-    fig.savefig(FILE_PATHS["community_plot"].format(name=name, fmt="eps"))
-    fig.savefig(
+    return _export_plot(
+        fig,
+        FILE_PATHS["community_plot"].format(name=name, fmt="eps"),
         FILE_PATHS["community_plot"].format(name=name, fmt="jpg"),
-        dpi=240,
-        facecolor="white",
+    )
+
+
+def _export_plot(fig, vector_path, jpg_path):
+    """ Start saving a figure as a vector file and a jpg (see export_figure)
+
+    Returns:
+        The futures for the two files, which are written by background processes.
+    """
+    # The dpi also sets the resolution of the rasterised scatter layers in vector files
+    return export_figure(
+        fig,
+        [
+            (vector_path, {"dpi": 240}),
+            (jpg_path, {"dpi": 240, "facecolor": "white"}),
+        ],
     )
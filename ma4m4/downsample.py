@@ -8,34 +8,47 @@ from ma4m4.utils import log_duration
 def downsample_anomaly_series(
     latitude,
     longitude,
+    lat_index,
+    lon_index,
     sst_anomaly,
     downsample_degrees=DOWNSAMPLE_DEGREES,
     min_latitude=MIN_LATITUDE,
     max_latitude=MAX_LATITUDE,
+    return_index=False,
 ):
     """ Downsample the data
 
+    The anomaly series is expected in the packed form saved by save_anomaly_series,
+    i.e. a txk matrix with one column for each of k (unmasked) spatial locations, whose
+    indices into the latitude and longitude grid vectors are given by lat_index and
+    lon_index. Only the selected columns are read, so sst_anomaly may be a memmap.
+
     WARNING: This method assumes that the input is equally spaced data on a
     latitude-longitude grid, and that the data contains every half-integer grid point.
+
+    Returns:
+        Tuple: (result, meta) where result contains k'-element vectors with the
+            "latitude" and "longitude" of each spatial location kept, and the txk'
+            "sst_anomaly" matrix. If return_index is true then it also contains the
+            "lat_index" and "lon_index" vectors for the locations kept.
     """
-    latitude_mask = (latitude >= min_latitude) & (latitude <= max_latitude)
-    sst_anomaly_downsample = sst_anomaly[
-        (
-            slice(None),  # Time axis
-            *np.ix_(
-                (latitude_mask & (latitude % downsample_degrees == 0.5)),
-                (longitude % downsample_degrees == 0.5),
-            )
-        )
-    ]
-    lat_downsample = latitude[(latitude_mask & (latitude % downsample_degrees == 0.5))]
-    long_downsample = longitude[(longitude % downsample_degrees == 0.5)]
+    cell_latitude = latitude[lat_index]
+    cell_longitude = longitude[lon_index]
+    keep = (
+        (cell_latitude >= min_latitude)
+        & (cell_latitude <= max_latitude)
+        & (cell_latitude % downsample_degrees == 0.5)
+        & (cell_longitude % downsample_degrees == 0.5)
+    )
 
     result = {
-        "latitude": lat_downsample,
-        "longitude": long_downsample,
-        "sst_anomaly": sst_anomaly_downsample,
+        "latitude": cell_latitude[keep],
+        "longitude": cell_longitude[keep],
+        "sst_anomaly": np.asarray(sst_anomaly[:, np.flatnonzero(keep)]),
     }
+    if return_index:
+        result["lat_index"] = lat_index[keep]
+        result["lon_index"] = lon_index[keep]
     meta = {
         "downsample_degrees": downsample_degrees,
         "min_latitude": min_latitude,
@@ -0,0 +1,81 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import pickle
+
+import matplotlib
+from matplotlib import pyplot as plt
+from matplotlib.collections import PathCollection
+
+from ma4m4.constants import FIGURE_EXPORT_WORKERS
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def export_figure(fig, outputs):
+    """ Save a figure to several files in the background
+
+    Scatter layers are rasterised first, so that in vector formats (e.g. EPS and PDF)
+    they are embedded as an image (at the dpi passed to savefig) rather than as a path
+    for every point. The figure is then pickled and closed, and each file is rendered
+    from the pickle by a separate worker process, so that the formats are written in
+    parallel while the caller carries on.
+
+    Args:
+        fig: A matplotlib figure.
+        outputs: A list of (path, kwargs) pairs, with the keyword arguments to pass to
+            savefig for each path.
+
+    Returns:
+        A list of concurrent.futures.Future objects, one for each output, which
+        complete once the file has been written. See wait_for_exports.
+    """
+    rasterise_scatter_layers(fig)
+    pickled = pickle.dumps(fig)
+    plt.close(fig)
+
+    executor = _get_executor()
+    return [
+        executor.submit(_save_pickled_figure, pickled, path, kwargs)
+        for path, kwargs in outputs
+    ]
+
+
+def wait_for_exports(futures):
+    """ Wait for figure exports to finish, re-raising any error from a worker """
+    futures = list(futures)
+    if futures:
+        logger.info(f"Waiting for {len(futures)} figure exports to finish")
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
+
+
+def rasterise_scatter_layers(fig):
+    """ Mark every scatter layer in the figure (including subfigures) as rasterised """
+    for ax in fig.get_axes():
+        for collection in ax.collections:
+            if isinstance(collection, PathCollection):
+                collection.set_rasterized(True)
+
+
+def _get_executor():
+    """ The process pool for exporting figures, which is started when first needed """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=FIGURE_EXPORT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=matplotlib.use,
+            initargs=("Agg",),
+        )
+    return _executor
+
+
+def _save_pickled_figure(pickled, path, kwargs):
+    fig = pickle.loads(pickled)
+    fig.savefig(path, **kwargs)
+    plt.close(fig)
+    return path
@@ -0,0 +1,243 @@
+import logging
+
+import numpy as np
+import scipy.signal
+
+from ma4m4.anomaly_series import (
+    butter_lowpass_filter,
+    linear_trend,
+    seasonal_climatology,
+    subtract_climatology,
+)
+from ma4m4.compute_correlations import map_tile_slices, standardise
+from ma4m4.constants import (
+    CORRELATION_BLOCK_SIZE,
+    CORRELATION_DTYPE,
+    INCREMENTAL_FILTER_TOLERANCE,
+    LOW_PASS_BUTTER_ORDER,
+    LOW_PASS_CUTOFF,
+    SEASONAL_REFERENCE_PERIOD,
+)
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
+
+
+@log_duration("initialise correlation stats")
+def init_correlation_stats(
+    t, time, y, cross_product, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1
+):
+    """ Generate the anomaly series along with the statistics needed to update them
+
+    The anomaly series are generated as in generate_anomaly_series, but the fitted
+    trend and monthly climatology are kept so that they can be applied (unchanged) to
+    months appended later. The end of the series, which will change when it is
+    re-filtered, is kept both before and after filtering. The sums and cross-products
+    of the anomaly series are sufficient to recover their correlations.
+
+    Args:
+        t: Time (in days or other unit, but not datetimes) for each point
+        time: Datetime64 time for each point
+        y: A txk matrix containing the raw SST time series in each column. This is
+            converted to the anomaly series in place.
+        cross_product: A kxk array (e.g. a memmap) to fill with y.T @ y.
+        block_size: Number of columns along each side of a tile of cross_product.
+        n_jobs: Number of worker threads (as interpreted by joblib).
+
+    Returns:
+        Tuple: (stats, meta) containing the arrays and scalars describing the series.
+    """
+    tail_length = filter_settling_length()
+
+    t_mean, y_mean, slope = linear_trend(t, y)
+    y -= y_mean
+    y -= np.outer(t - t_mean, slope)
+
+    climatology = seasonal_climatology(
+        y, time=time, reference_period=SEASONAL_REFERENCE_PERIOD
+    )
+    subtract_climatology(y, climatology)
+    unfiltered_tail = y[-2 * tail_length:].copy()
+
+    y[:] = _lowpass_filter(y)
+
+    cross_product[:] = 0
+    update_cross_product(cross_product, y, block_size=block_size, n_jobs=n_jobs)
+
+    stats = {
+        "time_days": t,
+        "trend_mean": y_mean,
+        "trend_slope": slope,
+        "climatology": climatology,
+        "unfiltered_tail": unfiltered_tail,
+        "filtered_tail": y[-tail_length:].copy(),
+        "sum": y.sum(axis=0),
+        "cross_product": cross_product,
+    }
+    meta = {"trend_time_mean": t_mean, "tail_length": tail_length}
+
+    return stats, meta
+
+
+@log_duration("update correlation stats")
+def update_correlation_stats(
+    stats, meta, t_new, y_new, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1
+):
+    """ Update the statistics from init_correlation_stats with newly appended months
+
+    The stored trend and climatology are applied to the new months. Since the low-pass
+    filter is non-causal, appending data also changes the filtered values near the end
+    of the existing series. These (and the new months) are re-filtered using a window
+    which starts early enough for the filter to have settled, and their contributions
+    to the sums and cross-products replace the old ones. The cost is therefore
+    O(k^2 (dt + L)), where L is the settling length of the filter, rather than
+    O(k^2 t) for a full recompute.
+
+    Args:
+        stats: Statistics from init_correlation_stats. The cross_product matrix is
+            updated in place, so it should be a writable memmap (see
+            data_catalog.open_cross_product_for_writing) if it is to be saved.
+        meta: Meta data from init_correlation_stats.
+        t_new: Time (in days) for each new point.
+        y_new: A dtxk matrix containing the raw SST for each new month. This is
+            modified in place.
+        block_size: Number of columns along each side of a tile of cross_product.
+        n_jobs: Number of worker threads (as interpreted by joblib).
+
+    Returns:
+        The updated stats dictionary.
+    """
+    n_old = len(stats["time_days"])
+    tail_length = meta["tail_length"]
+
+    y_new -= stats["trend_mean"]
+    y_new -= np.outer(t_new - meta["trend_time_mean"], stats["trend_slope"])
+    subtract_climatology(y_new, stats["climatology"], first_month=n_old % 12)
+
+    # The first tail_length values of the re-filtered window are affected by the start
+    # of the window, so only the values after that are used. If the window covers the
+    # whole series then there is no such effect and every value is used.
+    window = np.concatenate([stats["unfiltered_tail"], y_new])
+    n_replace = min(tail_length, n_old) + len(y_new)
+    old_filtered = stats["filtered_tail"]
+    new_filtered = _lowpass_filter(window)[-n_replace:]
+
+    update_cross_product(
+        stats["cross_product"],
+        new_filtered,
+        subtract=old_filtered,
+        block_size=block_size,
+        n_jobs=n_jobs,
+    )
+
+    return {
+        **stats,
+        "time_days": np.concatenate([stats["time_days"], t_new]),
+        "unfiltered_tail": window[-2 * tail_length:],
+        "filtered_tail": new_filtered[-tail_length:],
+        "sum": stats["sum"] + new_filtered.sum(axis=0) - old_filtered.sum(axis=0),
+    }
+
+
+def update_cross_product(
+    cross_product, add, subtract=None, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1
+):
+    """ Add add.T @ add (and subtract subtract.T @ subtract) to cross_product in place
+
+    The update is done in tiles (as for the correlations) using symmetry.
+    """
+
+    def update_tile(rows, cols):
+        delta = add[:, rows].T @ add[:, cols]
+        if subtract is not None:
+            delta -= subtract[:, rows].T @ subtract[:, cols]
+        cross_product[rows, cols] += delta
+        if rows != cols:
+            cross_product[cols, rows] += delta.T
+
+    map_tile_slices(
+        cross_product.shape[0], update_tile, block_size=block_size, n_jobs=n_jobs
+    )
+
+
+def correlations_from_stats(
+    stats, out, block_size=CORRELATION_BLOCK_SIZE, n_jobs=-1
+):
+    """ Compute the Pearson correlations from the sums and cross-products
+
+    Args:
+        stats: Statistics from init_correlation_stats or update_correlation_stats.
+        out: A kxk array (e.g. a memmap) to write the correlations into.
+    """
+    n_time = len(stats["time_days"])
+    cross_product = stats["cross_product"]
+    mean = stats["sum"] / n_time
+    std = np.sqrt(np.diagonal(cross_product) / n_time - mean ** 2)
+
+    def fill_tile(rows, cols):
+        cov = cross_product[rows, cols] / n_time - np.outer(mean[rows], mean[cols])
+        tile = np.clip(cov / np.outer(std[rows], std[cols]), -1, 1)
+        out[rows, cols] = tile
+        out[cols, rows] = tile.T
+
+    map_tile_slices(out.shape[0], fill_tile, block_size=block_size, n_jobs=n_jobs)
+
+    return out
+
+
+def correlation_drift(correlation, cells, sst_anomaly):
+    """ Compare (a sample of) correlations against those recomputed from scratch
+
+    Args:
+        correlation: The (incrementally updated) nxn correlation matrix.
+        cells: Indices of a sample of the n spatial locations.
+        sst_anomaly: A txm matrix of the anomaly series for the m sampled locations,
+            recomputed from scratch with generate_anomaly_series.
+
+    Returns:
+        Dictionary with the maximum and mean absolute difference between the
+        correlations.
+    """
+    z = standardise(sst_anomaly, dtype=CORRELATION_DTYPE)
+    expected = np.clip(z.T @ z, -1, 1)
+    actual = correlation[np.ix_(cells, cells)]
+
+    diff = np.abs(actual - expected)
+    return {"max_abs_drift": float(diff.max()), "mean_abs_drift": float(diff.mean())}
+
+
+def filter_settling_length(
+    cutoff=LOW_PASS_CUTOFF,
+    order=LOW_PASS_BUTTER_ORDER,
+    sample_freq=1,
+    tol=INCREMENTAL_FILTER_TOLERANCE,
+):
+    """ Number of samples after which the filter's impulse response is negligible
+
+    This is the distance over which a change at one end of a series affects the
+    filtered values (in either direction, since the filter is applied forwards and
+    backwards).
+    """
+    sos = scipy.signal.butter(order, cutoff, fs=sample_freq, output="sos")
+
+    n_samples = 64
+    while True:
+        impulse = np.zeros(n_samples)
+        impulse[0] = 1
+        with np.errstate(under="ignore"):
+            response = np.abs(scipy.signal.sosfilt(sos, impulse))
+        [significant] = np.nonzero(response > tol * response.max())
+        if significant[-1] < n_samples // 2:
+            return int(significant[-1]) + 1
+        n_samples *= 2
+
+
+def _lowpass_filter(y):
+    return butter_lowpass_filter(
+        y,
+        cutoff=LOW_PASS_CUTOFF,
+        order=LOW_PASS_BUTTER_ORDER,
+        sample_freq=1,
+        axis=0,
+    )
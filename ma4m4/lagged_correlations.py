@@ -0,0 +1,167 @@
+import numpy as np
+import scipy.fft
+
+from ma4m4.compute_correlations import (
+    concatenate_edges,
+    map_tile_slices,
+    standardise,
+    threshold_tile,
+)
+from ma4m4.constants import (
+    CORRELATION_THRESHOLD,
+    LAGGED_BLOCK_SIZE,
+    LAGGED_MAX_LAG,
+)
+from ma4m4.utils import log_duration
+
+
+@log_duration("compute lagged correlation edges")
+def compute_lagged_correlation_edges(
+    latitude,
+    longitude,
+    sst_anomaly,
+    max_lag=LAGGED_MAX_LAG,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    block_size=LAGGED_BLOCK_SIZE,
+    n_jobs=-1,
+):
+    """ Compute the sparse set of lagged correlations beyond a threshold
+
+    For each pair of locations the Pearson correlation is computed at every lag from
+    -max_lag to max_lag (months), and the one largest in absolute value (or largest, if
+    not two_sided) is kept along with its lag. See compute_lagged_correlation.
+
+    Returns:
+        Tuple: (result, meta) where result contains the "latitude" and "longitude" of
+            each location and the COO arrays "row", "col", "value" and "lag" of the
+            lagged correlations beyond the threshold.
+    """
+    edges = compute_lagged_correlation(
+        sst_anomaly,
+        max_lag,
+        threshold,
+        two_sided=two_sided,
+        block_size=block_size,
+        n_jobs=n_jobs,
+    )
+
+    result = {"latitude": latitude, "longitude": longitude, **edges}
+    meta = {
+        "corr_threshold": threshold,
+        "corr_two_sided": two_sided,
+        "corr_max_lag": max_lag,
+    }
+
+    return result, meta
+
+
+def compute_lagged_correlation(
+    y,
+    max_lag,
+    threshold,
+    two_sided=True,
+    block_size=LAGGED_BLOCK_SIZE,
+    n_jobs=-1,
+    verbose=1,
+):
+    """ Compute the strongest lagged correlation between each pair of columns of y
+
+    The correlation of columns i and j at lag l is that between y[t, i] and y[t + l, j]
+    over the t for which both are defined, so a positive lag means that location i
+    leads location j. The sums of lagged products needed for every lag are computed
+    together for a tile of pairs by FFT cross-correlation (with the spectrum of each
+    column computed only once). The means and variances over each overlap come from
+    cumulative sums.
+
+    Only pairs above the diagonal (row < col) whose strongest correlation is at least
+    threshold in absolute value (or at least threshold, if not two_sided) are returned.
+
+    Args:
+        y: A txk matrix with a time series in each column.
+        max_lag: The largest lag (in either direction) to consider.
+        threshold: Correlation threshold for the returned pairs.
+        two_sided: Whether to select the lag and pairs by abs(r) or r.
+        block_size: Number of columns along each side of a tile. Each tile uses memory
+            proportional to t * block_size**2.
+        n_jobs: Number of worker threads (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+
+    Returns:
+        A dict with int32 arrays "row" and "col", a float32 array "value" and an int16
+        array "lag" describing the lagged correlations in COO format, sorted by row and
+        then column.
+    """
+    n_time, n_space = y.shape
+    if not 0 <= max_lag < n_time - 2:
+        raise ValueError(f"Invalid max_lag {max_lag} for series of length {n_time}")
+
+    # Standardising first (which doesn't change the correlations) keeps the sums below
+    # well conditioned
+    z = standardise(y, dtype="float64")
+
+    n_fft = scipy.fft.next_fast_len(n_time + max_lag, real=True)
+    spectra = scipy.fft.rfft(z, n=n_fft, axis=0)
+    cumsum = np.zeros((n_time + 1, n_space))
+    np.cumsum(z, axis=0, out=cumsum[1:])
+    cumsum_sq = np.zeros_like(cumsum)
+    np.cumsum(z ** 2, axis=0, out=cumsum_sq[1:])
+    lags = np.arange(-max_lag, max_lag + 1)
+
+    def process_tile(rows, cols):
+        tile = _lagged_correlation_tile(
+            spectra, cumsum, cumsum_sq, rows, cols, lags, n_fft
+        )
+        strength = np.abs(tile) if two_sided else tile
+        best = np.argmax(strength, axis=0)
+        value = np.take_along_axis(tile, best[np.newaxis], axis=0)[0]
+
+        edges = threshold_tile(rows, cols, value, threshold, two_sided)
+        i, j = edges["row"] - rows.start, edges["col"] - cols.start
+        edges["lag"] = lags[best[i, j]].astype("int16")
+        return edges
+
+    tiles = map_tile_slices(
+        n_space, process_tile, block_size=block_size, n_jobs=n_jobs, verbose=verbose
+    )
+
+    return concatenate_edges(tiles, keys=["row", "col", "value", "lag"])
+
+
+def _lagged_correlation_tile(spectra, cumsum, cumsum_sq, rows, cols, lags, n_fft):
+    """ The correlations at each lag for a tile of pairs, as a (lag, row, col) array """
+    n_time = cumsum.shape[0] - 1
+
+    # The circular cross-correlation doesn't wrap around since n_fft >= n_time + max_lag
+    cross = scipy.fft.irfft(
+        np.conj(spectra[:, rows, np.newaxis]) * spectra[:, np.newaxis, cols],
+        n=n_fft,
+        axis=0,
+    )
+    products = cross[lags % n_fft]
+
+    # Over the overlap at lag l, the leading series covers t in [start_i, stop_i) and
+    # the lagging one covers t + l for the same t
+    start_i = np.maximum(-lags, 0)
+    stop_i = n_time - np.maximum(lags, 0)
+    start_j, stop_j = start_i + lags, stop_i + lags
+    n_overlap = (n_time - np.abs(lags))[:, np.newaxis, np.newaxis]
+
+    def overlap_sums(cumsum, index, start, stop):
+        return (cumsum[stop][:, index] - cumsum[start][:, index])[..., np.newaxis]
+
+    sum_i = overlap_sums(cumsum, rows, start_i, stop_i)
+    sum_j = overlap_sums(cumsum, cols, start_j, stop_j).swapaxes(1, 2)
+    sum_sq_i = overlap_sums(cumsum_sq, rows, start_i, stop_i)
+    sum_sq_j = overlap_sums(cumsum_sq, cols, start_j, stop_j).swapaxes(1, 2)
+
+    cov = products - sum_i * sum_j / n_overlap
+    var_i = np.maximum(sum_sq_i - sum_i ** 2 / n_overlap, 0)
+    var_j = np.maximum(sum_sq_j - sum_j ** 2 / n_overlap, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tile = cov / np.sqrt(var_i * var_j)
+
+    # Constant overlaps have no defined correlation, so are never selected
+    tile[~np.isfinite(tile)] = 0
+
+    return np.clip(tile, -1, 1, out=tile)
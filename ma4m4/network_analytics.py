@@ -0,0 +1,184 @@
+import joblib
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from ma4m4.compute_correlations import block_slices
+from ma4m4.constants import (
+    ANALYTICS_BLOCK_SIZE,
+    ANALYTICS_DENSE_DENSITY,
+    ANALYTICS_LINK_LENGTH_BINS,
+    CORRELATION_MEMORY_BUDGET,
+    EARTH_RADIUS_KM,
+)
+from ma4m4.utils import log_duration
+
+
+NETWORK_ANALYTICS_NODE_KEYS = [
+    "degree",
+    "area_weighted_degree",
+    "mean_link_length",
+    "clustering",
+    "component",
+    "component_size",
+]
+NETWORK_ANALYTICS_KEYS = [
+    "latitude",
+    "longitude",
+    *NETWORK_ANALYTICS_NODE_KEYS,
+    "link_length_counts",
+    "link_length_bin_edges",
+]
+
+
+@log_duration("compute network analytics")
+def compute_network_analytics(
+    graph,
+    link_length_bins=ANALYTICS_LINK_LENGTH_BINS,
+    block_size=ANALYTICS_BLOCK_SIZE,
+    n_jobs=-1,
+):
+    """ Compute per-node statistics of a network directly from its CSR arrays
+
+    Args:
+        graph: A CSRGraph.
+        link_length_bins: Number of equal width bins (from 0 to half the circumference
+            of the Earth) in the histogram of link lengths.
+        block_size: Number of rows at a time used to count triangles.
+        n_jobs: Number of worker threads (as interpreted by joblib) counting triangles.
+
+    Returns:
+        A dict with the NETWORK_ANALYTICS_KEYS: the "latitude" and "longitude" of each
+        node, the NETWORK_ANALYTICS_NODE_KEYS arrays with a value for each node, and
+        the histogram ("link_length_counts" and "link_length_bin_edges", in km) of the
+        great circle length of every edge.
+    """
+    adjacency = graph.adjacency()
+    row = np.repeat(
+        np.arange(graph.number_of_nodes(), dtype="int32"), np.diff(graph.indptr)
+    )
+    degree = np.diff(graph.indptr)
+
+    length = link_lengths(graph.latitude, graph.longitude, row, graph.indices)
+    total_length = np.bincount(row, weights=length, minlength=len(degree))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_link_length = total_length / degree
+
+    bin_edges = np.linspace(0, np.pi * EARTH_RADIUS_KM, link_length_bins + 1)
+    counts, _ = np.histogram(length[row < graph.indices], bins=bin_edges)
+
+    _, component = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+
+    return {
+        "latitude": graph.latitude,
+        "longitude": graph.longitude,
+        "degree": degree,
+        "area_weighted_degree": area_weighted_degree(adjacency, graph.latitude),
+        "mean_link_length": mean_link_length,
+        "clustering": local_clustering(adjacency, block_size, n_jobs=n_jobs),
+        "component": component.astype("int32"),
+        "component_size": np.bincount(component)[component],
+        "link_length_counts": counts,
+        "link_length_bin_edges": bin_edges,
+    }
+
+
+def area_weighted_degree(adjacency, latitude):
+    """ The area weighted connectivity of each node (Tsonis et al., 2006)
+
+    Each neighbour is weighted by cos(latitude), which is proportional to the area of
+    its grid cell, and the result is normalised by the total weight of all nodes. This
+    is the fraction of the area covered by the nodes to which each node is linked.
+    """
+    weight = np.cos(np.deg2rad(latitude))
+    return adjacency @ weight / weight.sum()
+
+
+def link_lengths(latitude, longitude, row, col):
+    """ The great circle distance (in km) between the ends of each edge
+
+    This uses the haversine formula, vectorised over the arrays of edge end points.
+    """
+    lat, lon = np.deg2rad(latitude), np.deg2rad(longitude)
+    d_lat = lat[col] - lat[row]
+    d_lon = lon[col] - lon[row]
+    a = (
+        np.sin(d_lat / 2) ** 2
+        + np.cos(lat[row]) * np.cos(lat[col]) * np.sin(d_lon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def local_clustering(
+    adjacency,
+    block_size=ANALYTICS_BLOCK_SIZE,
+    dense_density=ANALYTICS_DENSE_DENSITY,
+    n_jobs=-1,
+    memory_budget=CORRELATION_MEMORY_BUDGET,
+):
+    """ The local clustering coefficient of each node in an unweighted graph
+
+    The number of triangles through each node is half the diagonal of A^3. This is
+    computed from the row sums of (A^2)[rows] * A[rows] for a block of rows at a time,
+    so that only a block of rows of A^2 (which is much denser than A) is held at once.
+
+    For sparse graphs the blocks are computed with sparse products (shared between
+    joblib threads). Their cost grows with the square of the mean degree, so for graphs
+    with density at least dense_density A is instead held as a dense float32 matrix and
+    the blocks are computed by (multi-threaded) BLAS, provided that the matrix and a
+    block of rows of A^2 fit in memory_budget.
+    """
+    adjacency = scipy.sparse.csr_matrix(adjacency, dtype="float32", copy=True)
+    adjacency.data[:] = 1
+    n_nodes = adjacency.shape[0]
+    blocks = block_slices(n_nodes, block_size)
+
+    dense_bytes = 4 * n_nodes * (n_nodes + block_size)
+    if _density(adjacency) >= dense_density and dense_bytes <= memory_budget:
+        dense = adjacency.toarray()
+        twice_triangles = np.concatenate(
+            [
+                np.einsum("ij,ij->i", dense[rows] @ dense, dense[rows], dtype="float64")
+                for rows in blocks
+            ]
+        )
+    else:
+
+        def count_block(rows):
+            block = adjacency[rows]
+            paths = (block @ adjacency).multiply(block)
+            return np.asarray(paths.sum(axis=1, dtype="float64")).ravel()
+
+        twice_triangles = np.concatenate(
+            joblib.Parallel(n_jobs=n_jobs, prefer="threads")(
+                joblib.delayed(count_block)(rows) for rows in blocks
+            )
+        )
+
+    degree = np.diff(adjacency.indptr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        clustering = twice_triangles / (degree * (degree - 1.0))
+    clustering[degree < 2] = 0
+
+    return clustering
+
+
+def _density(adjacency):
+    n_nodes = adjacency.shape[0]
+    return adjacency.nnz / (n_nodes * (n_nodes - 1)) if n_nodes > 1 else 0
+
+
+def print_network_analytics(analytics):
+    """ Print a summary of the results of compute_network_analytics """
+    degree = analytics["degree"]
+    total_length = np.nansum(analytics["mean_link_length"] * degree)
+    mean_link_length = total_length / degree.sum() if degree.sum() else np.nan
+    n_components = len(np.unique(analytics["component"]))
+
+    print("Network analytics")
+    print("-----------------")
+    print(f"Mean area weighted degree: {analytics['area_weighted_degree'].mean():.1%}")
+    print(f"Mean link length: {mean_link_length:,.0f} km")
+    print(f"Mean local clustering: {analytics['clustering'].mean():.3f}")
+    print(f"Connected components: {n_components:,}")
+    print(f"Largest component: {analytics['component_size'].max():,} nodes")
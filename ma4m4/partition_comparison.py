@@ -0,0 +1,193 @@
+import itertools
+import logging
+
+import joblib
+import numpy as np
+import scipy.sparse
+
+from ma4m4.constants import PARTITION_COMPARISON_PARALLEL_PAIRS
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
+
+PARTITION_COMPARISON_MEASURES = ["nmi", "ari", "vi"]
+
+
+@log_duration("compare partitions")
+def compare_partitions(
+    labels, n_jobs=-1, verbose=1, parallel_pairs=PARTITION_COMPARISON_PARALLEL_PAIRS
+):
+    """ Compute the NMI, ARI and VI between every pair of partitions of the same nodes
+
+    Each partition is first reduced to a compact vector of int32 labels (numbered from
+    0), and the pairs are then shared between a pool of worker processes in batches.
+    With fewer than parallel_pairs pairs the pool would cost more than it saves, so
+    they are compared one after another in this process instead.
+
+    Args:
+        labels: A dictionary mapping the name of each partition to an n-element vector
+            with the community label of each node. Nodes labelled -1 (i.e. in no
+            community) are treated as singleton communities.
+        n_jobs: Number of worker processes (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+        parallel_pairs: Minimum number of pairs to compare in the process pool.
+
+    Returns:
+        A dict with the "names" of the partitions and, for each of the
+        PARTITION_COMPARISON_MEASURES, a symmetric matrix with a row and a column for
+        each partition:
+        - "nmi": normalised mutual information (normalised by the arithmetic mean of
+          the entropies)
+        - "ari": adjusted Rand index
+        - "vi": variation of information (in nats)
+    """
+    names = list(labels)
+    compact = [compact_labels(labels[name]) for name in names]
+    if len({len(c) for c in compact}) > 1:
+        raise ValueError("Expected every partition to have the same number of nodes")
+
+    pairs = list(itertools.combinations(range(len(names)), 2))
+    if len(pairs) < parallel_pairs:
+        logger.info(f"Comparing {len(pairs):,} pairs of partitions")
+        batches = [pairs]
+        results = [_compare_batch(compact, pairs)]
+    else:
+        n_batches = max(1, min(len(pairs), joblib.effective_n_jobs(n_jobs)))
+        batches = [pairs[i::n_batches] for i in range(n_batches)]
+
+        logger.info(
+            f"Comparing {len(pairs):,} pairs of partitions in a joblib process pool"
+        )
+        results = joblib.Parallel(n_jobs=n_jobs, prefer="processes", verbose=verbose)(
+            joblib.delayed(_compare_batch)(compact, batch) for batch in batches
+        )
+
+    comparison = {
+        "names": np.array(names),
+        "nmi": np.eye(len(names)),
+        "ari": np.eye(len(names)),
+        "vi": np.zeros((len(names), len(names))),
+    }
+    for batch, measures in zip(batches, results):
+        for (i, j), pair in zip(batch, measures):
+            for key in PARTITION_COMPARISON_MEASURES:
+                comparison[key][i, j] = comparison[key][j, i] = pair[key]
+
+    return comparison
+
+
+def compare_partition_pair(a, b):
+    """ The NMI, ARI and VI between two partitions given by compact label vectors
+
+    All three are computed from the sparse contingency table, which only has an entry
+    for each pair of communities which share a node.
+    """
+    table = contingency_table(a, b).tocoo()
+    row, col, n_ij = table.row, table.col, table.data.astype("float64")
+    n_i = np.bincount(row, weights=n_ij)
+    n_j = np.bincount(col, weights=n_ij)
+    n = float(len(a))
+
+    mutual_info = np.sum(n_ij / n * np.log(n * n_ij / (n_i[row] * n_j[col])))
+    entropy_a = _entropy(n_i / n)
+    entropy_b = _entropy(n_j / n)
+    mean_entropy = (entropy_a + entropy_b) / 2
+
+    # Counts of pairs of nodes together in both partitions, or in each
+    pairs_ij = np.sum(n_ij * (n_ij - 1) / 2)
+    pairs_i = np.sum(n_i * (n_i - 1) / 2)
+    pairs_j = np.sum(n_j * (n_j - 1) / 2)
+    expected = pairs_i * pairs_j / (n * (n - 1) / 2) if n > 1 else 0
+    max_index = (pairs_i + pairs_j) / 2
+
+    # Identical trivial partitions (e.g. both all singletons) have a 0/0 NMI and ARI
+    nmi = mutual_info / mean_entropy if mean_entropy > 0 else 1.0
+    if max_index != expected:
+        ari = (pairs_ij - expected) / (max_index - expected)
+    else:
+        ari = 1.0
+
+    return {
+        "nmi": nmi,
+        "ari": ari,
+        "vi": max(entropy_a + entropy_b - 2 * mutual_info, 0.0),
+    }
+
+
+def contingency_table(a, b):
+    """ The sparse table of the number of nodes in each pair of communities
+
+    Args:
+        a: Compact label vector (see compact_labels) of the first partition.
+        b: Compact label vector of the second partition.
+
+    Returns:
+        A scipy CSR matrix with a row for each community of a and a column for each
+        community of b.
+    """
+    table = scipy.sparse.coo_matrix(
+        (np.ones(len(a), dtype="int32"), (a, b)), shape=(a.max() + 1, b.max() + 1)
+    )
+    return table.tocsr()  # Sums the duplicate entries
+
+
+def compact_labels(labels):
+    """ Renumber community labels as int32 from 0, making any -1 labels singletons """
+    labels = np.array(labels, dtype="int64")
+    missing = labels < 0
+    labels[missing] = labels.max(initial=-1) + 1 + np.arange(np.count_nonzero(missing))
+    _, compact = np.unique(labels, return_inverse=True)
+    return compact.astype("int32")
+
+
+def mean_pairwise_agreement(comparison, names):
+    """ The mean of each measure over the pairs of distinct partitions among names
+
+    This summarises the agreement between e.g. the runs of an ensemble.
+    """
+    index = np.flatnonzero(np.isin(comparison["names"], names))
+    i, j = np.triu_indices(len(index), k=1)
+    return {
+        key: float(np.mean(comparison[key][index[i], index[j]]))
+        for key in PARTITION_COMPARISON_MEASURES
+    }
+
+
+def print_partition_comparison(comparison, names=None, groups=None):
+    """ Print the partition comparison matrices as tables
+
+    Args:
+        comparison: Result of compare_partitions.
+        names: The partitions to include in the tables (by default all of them).
+        groups: Optional dictionary mapping a description to a list of partition
+            names (e.g. the runs of an ensemble), for each of which the mean pairwise
+            agreement is also printed.
+    """
+    all_names = list(comparison["names"])
+    names = all_names if names is None else list(names)
+    index = [all_names.index(name) for name in names]
+    width = max(8, *(len(name) + 2 for name in names))
+    for key in PARTITION_COMPARISON_MEASURES:
+        print(f"Partition comparison: {key.upper()}")
+        print("-" * (22 + len(key)))
+        print(" " * width + "".join(f"{name:>{width}}" for name in names))
+        for name, i in zip(names, index):
+            row = comparison[key][i, index]
+            print(f"{name:<{width}}" + "".join(f"{x:>{width}.3f}" for x in row))
+
+    for description, group in (groups or {}).items():
+        mean = mean_pairwise_agreement(comparison, group)
+        print(
+            f"Mean pairwise agreement of {description}: "
+            + ", ".join(f"{key.upper()} {mean[key]:.3f}" for key in mean)
+        )
+
+
+def _compare_batch(compact, batch):
+    return [compare_partition_pair(compact[i], compact[j]) for i, j in batch]
+
+
+def _entropy(p):
+    p = p[p > 0]
+    return -np.sum(p * np.log(p))
@@ -1,65 +1,610 @@
+import importlib
+import logging
+import os
+
+import numpy as np
+
 import ma4m4.data_catalog as dc
-from ma4m4.anomaly_series import generate_anomaly_series
-from ma4m4.build_network import build_network, print_graph_statistics
+from ma4m4 import step_cache
+from ma4m4.anomaly_series import (
+    generate_anomaly_series,
+    mask_ice_in_sst,
+    process_anomaly_tiles,
+)
+from ma4m4.build_network import (
+    build_network_from_edges,
+    build_top_k_network,
+    print_graph_statistics,
+)
 from ma4m4.community_detection import (
     detect_communities_via_asymptotic_surprise,
     detect_communities_via_infomap,
     detect_communities_via_ngmodmax_louvain,
 )
-from ma4m4.compute_correlations import compute_correlations
+from ma4m4.community_ensemble import ENSEMBLE_ALGORITHMS, detect_ensemble_communities
+from ma4m4.compute_correlations import (
+    compute_correlation_edges,
+    unmask_by_reshaping,
+)
+from ma4m4.constants import (
+    ANALYTICS_LINK_LENGTH_BINS,
+    COMMUNITY_SEED,
+    CORRELATION_DTYPE,
+    CORRELATION_STORE_RANK,
+    CORRELATION_THRESHOLD,
+    DOWNSAMPLE_DEGREES,
+    EARTH_RADIUS_KM,
+    ENSEMBLE_CONSENSUS_THRESHOLD,
+    ENSEMBLE_N_RUNS,
+    INCREMENTAL_DRIFT_SAMPLE_SIZE,
+    LAGGED_MAX_LAG,
+    LOW_PASS_BUTTER_ORDER,
+    LOW_PASS_CUTOFF,
+    MAX_LATITUDE,
+    MIN_LATITUDE,
+    MODULARITY_MAXIMISATION_RESOLUTION,
+    PLOT_MAX_COMMUNITIES,
+    SEASONAL_REFERENCE_PERIOD,
+    SIGNIFICANCE_FDR,
+    SIGNIFICANCE_MIN_CORRELATION,
+    SIGNIFICANCE_N_SURROGATES,
+    SIGNIFICANCE_P_VALUE_METHOD,
+    SIGNIFICANCE_SEED,
+    SST_ICE_VAL,
+    SURPRISE_OPTIMISER,
+    SURPRISE_TIME_BUDGET,
+    THRESHOLD_SWEEP_NETWORKS,
+    THRESHOLD_SWEEP_VALUES,
+    TOP_K_NEIGHBOURS,
+    TOP_K_SYMMETRISE,
+    WINDOW_LENGTH_MONTHS,
+    WINDOW_STEP_MONTHS,
+)
+from ma4m4.correlation_store import CorrelationStore
 from ma4m4.downsample import downsample_anomaly_series
-from ma4m4.plots import plot_communities, plot_community_comparison, plot_correlations_distribution
+from ma4m4.incremental import (
+    correlation_drift,
+    correlations_from_stats,
+    init_correlation_stats,
+    update_correlation_stats,
+)
+from ma4m4.lagged_correlations import compute_lagged_correlation_edges
+from ma4m4.network_analytics import compute_network_analytics, print_network_analytics
+from ma4m4.partition_comparison import compare_partitions, print_partition_comparison
+from ma4m4.plots import (
+    plot_communities,
+    plot_community_comparison,
+    plot_correlations_distribution,
+    plot_network_analytics,
+)
+from ma4m4.significance import (
+    SIGNIFICANCE_EDGE_KEYS,
+    compute_correlation_significance,
+    fdr_edges,
+)
+from ma4m4.sliding_window import compute_window_networks, print_window_statistics
+from ma4m4.threshold_sweep import (
+    THRESHOLD_SWEEP_COLUMNS,
+    network_at_threshold,
+    print_threshold_sweep,
+    sort_correlation_edges,
+    sweep_thresholds,
+)
+from ma4m4.utils import safe_unmask_array
+
+
+logger = logging.getLogger(__name__)
+
+COMMUNITY_NAMES = ["modularity", "infomap", "surprise", "surprise-weighted"]
+CONSENSUS_COMMUNITY_NAMES = [f"{a}-consensus" for a in ENSEMBLE_ALGORITHMS]
 
 
 def run(
-    recalculate_correlations=True,
-    rebuild_network=True,
-    rerun_community_detection=True,
-    regenerate_community_comparison_plot=True,
-    regenerate_communities_plot_for_asymptotic_surprise=True,
-    regenerate_communities_plot_for_weighted_asymptotic_surprise=True,
-    regenerate_correlations_distribution_plot=True,
+    use_cache=True,
+    sliding_window=False,
+    threshold_sweep=False,
+    lagged=False,
+    significance=False,
+    top_k=False,
+    ensemble=False,
+    analytics=False,
 ):
-    """Run the full pipeline to process the raw SST data into plots in the essay"""
+    """Run the full pipeline to process the raw SST data into plots in the essay
+
+    Each step is keyed by its inputs, the constants it uses and its code, and is skipped
+    (with its outputs restored from the step cache) if that key has not changed since it
+    was last run. Pass use_cache=False to force every step to run. Pass
+    sliding_window=True to also compute the time-evolving (sliding window) networks,
+    threshold_sweep=True to also compute graph statistics for a range of thresholds, and
+    lagged=True to also compute the lagged correlations. Pass significance=True to build
+    the network from the correlations which are significant against surrogate data, or
+    top_k=True to join each node to its TOP_K_NEIGHBOURS most correlated nodes, instead
+    of using those beyond CORRELATION_THRESHOLD. Pass ensemble=True to also find
+    consensus communities (with node stabilities) from ENSEMBLE_N_RUNS seeded runs of
+    each community detection algorithm, and analytics=True to also compute (and plot)
+    per-node statistics of the network such as area weighted degree and link length.
+
+    The figures are saved by a pool of background processes (see figure_export) while
+    the pipeline carries on, and this function waits for them to finish before it
+    returns.
+    """
+    if significance and top_k:
+        raise ValueError("At most one of significance and top_k can be used")
 
     dc.setup_directory_structure()
 
-    if recalculate_correlations:
-        run_step_calculate_correlations()
-    if rebuild_network:
-        run_step_build_network()
-    if rerun_community_detection:
-        run_step_detect_communities()
-    if regenerate_community_comparison_plot:
-        run_step_plot_community_comparison()
-    if regenerate_communities_plot_for_asymptotic_surprise:
-        run_step_plot_communities_from_asymptotic_surprise()
-    if regenerate_communities_plot_for_weighted_asymptotic_surprise:
-        run_step_plot_communities_from_weighted_asymptotic_surprise()
-    if regenerate_correlations_distribution_plot:
-        run_step_plot_correlations_distribution()
-
-
-def run_step_calculate_correlations():
-    raw_data = dc.load_raw_sst_data()
-    sst_anomaly, meta_an = generate_anomaly_series(raw_data)
+    raw_key = step_cache.file_fingerprint(dc.FILE_PATHS["raw_hadisst"])
+    anomaly_key = _run_cached_step(
+        run_step_generate_anomaly_series,
+        params={
+            "sst_ice_val": SST_ICE_VAL,
+            "seasonal_reference_period": SEASONAL_REFERENCE_PERIOD,
+            "low_pass_cutoff": LOW_PASS_CUTOFF,
+            "low_pass_butter_order": LOW_PASS_BUTTER_ORDER,
+        },
+        upstream=[raw_key],
+        code=[
+            "ma4m4.anomaly_series",
+            dc.load_raw_sst_grid,
+            dc.load_raw_sst_data,
+            unmask_by_reshaping,
+            dc.open_anomaly_for_writing,
+            dc.save_anomaly_series,
+        ],
+        outputs=[os.path.dirname(dc.FILE_PATHS["anomaly"])],
+        use_cache=use_cache,
+    )
+
+    downsample_params = {
+        "downsample_degrees": DOWNSAMPLE_DEGREES,
+        "min_latitude": MIN_LATITUDE,
+        "max_latitude": MAX_LATITUDE,
+        "correlation_dtype": CORRELATION_DTYPE,
+    }
+    correlation_code = [
+        _load_downsampled_anomaly_series,
+        "ma4m4.downsample",
+        "ma4m4.compute_correlations",
+        dc.load_anomaly_series,
+    ]
+    network_params = {"corr_threshold": CORRELATION_THRESHOLD, "corr_two_sided": True}
+
+    # The correlations are stored as a factor, from which any part of the correlation
+    # matrix can be computed, rather than as the dense matrix
+    correlations_key = _run_cached_step(
+        run_step_calculate_correlation_store,
+        params={**downsample_params, "correlation_store_rank": CORRELATION_STORE_RANK},
+        upstream=[anomaly_key],
+        code=[*correlation_code, "ma4m4.correlation_store", dc.save_correlation_store],
+        outputs=[os.path.dirname(dc.FILE_PATHS["correlation_store"])],
+        use_cache=use_cache,
+    )
+    if significance:
+        # The edges are those which are significant against surrogate data, rather
+        # than those beyond a fixed threshold
+        edges_key = _run_cached_step(
+            run_step_test_correlation_significance,
+            params={
+                **downsample_params,
+                "corr_two_sided": True,
+                "n_surrogates": SIGNIFICANCE_N_SURROGATES,
+                "min_correlation": SIGNIFICANCE_MIN_CORRELATION,
+                "p_value_method": SIGNIFICANCE_P_VALUE_METHOD,
+                "seed": SIGNIFICANCE_SEED,
+            },
+            upstream=[anomaly_key],
+            code=[
+                *correlation_code,
+                "ma4m4.significance",
+                dc.save_correlation_significance,
+            ],
+            outputs=[dc.FILE_PATHS["correlation_significance"]],
+            use_cache=use_cache,
+        )
+        build_network_step = run_step_build_significant_network
+        build_network_params = {"significance_fdr": SIGNIFICANCE_FDR}
+        build_network_code = ["ma4m4.significance", dc.load_correlation_significance]
+    elif top_k:
+        # Each node keeps its most strongly correlated partners, which are found from
+        # the correlation store
+        edges_key = correlations_key
+        build_network_step = run_step_build_top_k_network
+        build_network_params = {
+            "top_k": TOP_K_NEIGHBOURS,
+            "top_k_symmetrise": TOP_K_SYMMETRISE,
+            "corr_two_sided": True,
+        }
+        build_network_code = ["ma4m4.correlation_store", dc.load_correlation_store]
+    else:
+        edges_key = _run_cached_step(
+            run_step_calculate_correlation_edges,
+            params={**downsample_params, **network_params},
+            upstream=[anomaly_key],
+            code=[*correlation_code, dc.save_correlation_edges],
+            outputs=[dc.FILE_PATHS["correlation_edges"]],
+            use_cache=use_cache,
+        )
+        build_network_step = run_step_build_network
+        build_network_params = network_params
+        build_network_code = [dc.load_correlation_edges]
+    if threshold_sweep:
+        _run_cached_step(
+            run_step_sweep_thresholds,
+            params={
+                "corr_two_sided": True,
+                "threshold_sweep_values": THRESHOLD_SWEEP_VALUES,
+                "threshold_sweep_networks": THRESHOLD_SWEEP_NETWORKS,
+            },
+            upstream=[correlations_key],
+            code=[
+                "ma4m4.threshold_sweep",
+                "ma4m4.build_network",
+                "ma4m4.correlation_store",
+                "ma4m4.csr_graph",
+                dc.load_correlation_store,
+                dc.save_network,
+                dc.save_threshold_sweep,
+            ],
+            outputs=[
+                dc.FILE_PATHS["threshold_sweep"],
+                os.path.dirname(dc.FILE_PATHS["threshold_network"]),
+            ],
+            use_cache=use_cache,
+        )
+    if lagged:
+        _run_cached_step(
+            run_step_calculate_lagged_correlation_edges,
+            params={**downsample_params, **network_params, "max_lag": LAGGED_MAX_LAG},
+            upstream=[anomaly_key],
+            code=[
+                *correlation_code,
+                "ma4m4.lagged_correlations",
+                dc.save_lagged_correlation_edges,
+            ],
+            outputs=[dc.FILE_PATHS["lagged_correlation_edges"]],
+            use_cache=use_cache,
+        )
+    if sliding_window:
+        _run_cached_step(
+            run_step_calculate_window_networks,
+            params={
+                **downsample_params,
+                **network_params,
+                "window_length_months": WINDOW_LENGTH_MONTHS,
+                "window_step_months": WINDOW_STEP_MONTHS,
+            },
+            upstream=[anomaly_key],
+            code=[
+                *correlation_code,
+                "ma4m4.sliding_window",
+                "ma4m4.build_network",
+                dc.save_network_windows,
+            ],
+            outputs=[dc.FILE_PATHS["network_windows"]],
+            use_cache=use_cache,
+        )
+    network_key = _run_cached_step(
+        build_network_step,
+        params=build_network_params,
+        upstream=[edges_key],
+        code=[
+            "ma4m4.build_network",
+            "ma4m4.csr_graph",
+            *build_network_code,
+            dc.save_network,
+        ],
+        outputs=[os.path.dirname(dc.FILE_PATHS["network"])],
+        use_cache=use_cache,
+    )
+    if analytics:
+        analytics_key = _run_cached_step(
+            run_step_calculate_network_analytics,
+            params={
+                "analytics_link_length_bins": ANALYTICS_LINK_LENGTH_BINS,
+                "earth_radius_km": EARTH_RADIUS_KM,
+            },
+            upstream=[network_key],
+            code=[
+                "ma4m4.network_analytics",
+                dc.load_network,
+                dc.save_network_analytics,
+            ],
+            outputs=[dc.FILE_PATHS["network_analytics"]],
+            use_cache=use_cache,
+        )
+        _run_cached_step(
+            run_step_plot_network_analytics,
+            params={},
+            upstream=[analytics_key],
+            code=[
+                "ma4m4.plots",
+                dc.load_network_analytics,
+                dc.save_network_analytics_plot,
+            ],
+            outputs=[
+                dc.FILE_PATHS["network_analytics_plot"].format(fmt=fmt)
+                for fmt in ["pdf", "jpg"]
+            ],
+            use_cache=use_cache,
+        )
+    communities_key = _run_cached_step(
+        run_step_detect_communities,
+        params={
+            "modularity_resolution": MODULARITY_MAXIMISATION_RESOLUTION,
+            "surprise_optimiser": SURPRISE_OPTIMISER,
+            "community_seed": COMMUNITY_SEED,
+            "surprise_time_budget": SURPRISE_TIME_BUDGET,
+        },
+        upstream=[network_key],
+        code=[
+            "ma4m4.community_detection",
+            "ma4m4.community_labels",
+            "ma4m4.surprise",
+            dc.load_network,
+            dc.save_communities,
+        ],
+        outputs=[dc.FILE_PATHS["communities"].format(name=n) for n in COMMUNITY_NAMES],
+        use_cache=use_cache,
+    )
+    partition_names = list(COMMUNITY_NAMES)
+    partition_keys = [communities_key]
+    if ensemble:
+        ensemble_key = _run_cached_step(
+            run_step_detect_ensemble_communities,
+            params={
+                "modularity_resolution": MODULARITY_MAXIMISATION_RESOLUTION,
+                "community_seed": COMMUNITY_SEED,
+                "ensemble_n_runs": ENSEMBLE_N_RUNS,
+                "ensemble_consensus_threshold": ENSEMBLE_CONSENSUS_THRESHOLD,
+            },
+            upstream=[network_key],
+            code=[
+                "ma4m4.community_ensemble",
+                "ma4m4.community_detection",
+                "ma4m4.community_labels",
+                "ma4m4.surprise",
+                dc.load_network,
+                dc.save_communities,
+                dc.save_community_stability,
+                dc.save_ensemble_runs,
+            ],
+            outputs=[
+                dc.FILE_PATHS[path].format(name=n)
+                for n in CONSENSUS_COMMUNITY_NAMES
+                for path in ["communities", "community_stability", "ensemble_runs"]
+            ],
+            use_cache=use_cache,
+        )
+        partition_names += CONSENSUS_COMMUNITY_NAMES
+        partition_keys.append(ensemble_key)
+    _run_cached_step(
+        run_step_compare_partitions,
+        params={"partition_names": partition_names, "ensemble": ensemble},
+        upstream=partition_keys,
+        code=[
+            "ma4m4.partition_comparison",
+            "ma4m4.community_labels",
+            dc.load_communities,
+            dc.load_ensemble_runs,
+            dc.save_partition_comparison,
+        ],
+        outputs=[dc.FILE_PATHS["partition_comparison"]],
+        use_cache=use_cache,
+        args=(partition_names, ensemble),
+    )
+
+    plot_params = {"plot_max_communities": PLOT_MAX_COMMUNITIES}
+    plot_code = ["ma4m4.plots", dc.load_communities]
+    _run_cached_step(
+        run_step_plot_community_comparison,
+        params=plot_params,
+        upstream=[communities_key],
+        code=[*plot_code, dc.save_community_comparison_plot],
+        outputs=[
+            dc.FILE_PATHS["community_comparison_plot_eps"],
+            dc.FILE_PATHS["community_comparison_plot_jpg"],
+        ],
+        use_cache=use_cache,
+    )
+    community_plot_steps = {
+        "surprise": run_step_plot_communities_from_asymptotic_surprise,
+        "surprise-weighted": run_step_plot_communities_from_weighted_asymptotic_surprise,
+    }
+    for name, step in community_plot_steps.items():
+        _run_cached_step(
+            step,
+            params=plot_params,
+            upstream=[communities_key],
+            code=[*plot_code, dc.save_community_plot],
+            outputs=[
+                dc.FILE_PATHS["community_plot"].format(name=name, fmt=fmt)
+                for fmt in ["eps", "jpg"]
+            ],
+            use_cache=use_cache,
+        )
+    _run_cached_step(
+        run_step_plot_correlations_distribution,
+        params=network_params,
+        upstream=[correlations_key],
+        code=[
+            "ma4m4.plots",
+            "ma4m4.correlation_store",
+            dc.load_correlation_store,
+            dc.save_correlations_plot,
+        ],
+        outputs=[
+            dc.FILE_PATHS["correlations_plot_pdf"],
+            dc.FILE_PATHS["correlations_plot_jpg"],
+        ],
+        use_cache=use_cache,
+    )
+
+    # The plots are saved by background processes while the later steps run
+    step_cache.wait_for_pending()
+
+
+def _run_cached_step(step, params, upstream, code, outputs, use_cache, args=()):
+    """ Run a step function through the step cache, returning its key
+
+    Any args are passed to the step function, so should also be included in params.
+    Plot steps return the futures of the figures being saved in the background, which
+    step_cache.wait_for_pending waits for.
+    """
+    code = [importlib.import_module(c) if isinstance(c, str) else c for c in code]
+    key = step_cache.step_key(step.__name__, params, upstream, code=[step, *code])
+    step_cache.run_cached(
+        step.__name__, key, lambda: step(*args), outputs, use_cache=use_cache
+    )
+    return key
+
+
+def run_step_generate_anomaly_series():
+    # The anomaly series is computed on the full grid, so that it is reused when the
+    # resolution or latitude bounds change. These are only applied when it is loaded
+    # (see _load_downsampled_anomaly_series), which reads just the columns kept. The
+    # raw data is read and processed in bands of latitudes, with the anomalies written
+    # straight to the memmapped intermediate, so the whole SST cube is never loaded.
+    grid = dc.load_raw_sst_grid()
+    anomaly, meta = generate_anomaly_series(
+        grid,
+        load_band=lambda rows: dc.load_raw_sst_data(latitude_rows=rows)["sst"],
+        open_output=dc.open_anomaly_for_writing,
+    )
+    dc.save_anomaly_series(grid["time"], **anomaly, meta=meta)
+
+
+def run_step_calculate_correlation_store():
+    downsampled, meta = _load_downsampled_anomaly_series()
+    store = CorrelationStore.from_anomaly_series(**downsampled)
+
+    error_bound = store.error_bound()
+    logger.info(f"Correlation store error bound: {error_bound:.3g}")
+    meta = {
+        **meta,
+        "correlation_store_rank": CORRELATION_STORE_RANK,
+        "correlation_store_error_bound": error_bound,
+    }
+    dc.save_correlation_store(store, meta)
+
+
+def run_step_calculate_correlation_edges():
+    downsampled, meta = _load_downsampled_anomaly_series()
+    edges, meta_edges = compute_correlation_edges(**downsampled)
+    dc.save_correlation_edges(**edges, meta={**meta, **meta_edges})
+
+
+def run_step_calculate_lagged_correlation_edges():
+    downsampled, meta = _load_downsampled_anomaly_series()
+    edges, meta_edges = compute_lagged_correlation_edges(**downsampled)
+    dc.save_lagged_correlation_edges(**edges, meta={**meta, **meta_edges})
+
+
+def run_step_sweep_thresholds():
+    store, meta = dc.load_correlation_store()
+
+    # The correlations are only computed once, after which the network at each
+    # threshold is a prefix of the sorted edges
+    sorted_edges = sort_correlation_edges(
+        store, min_threshold=min(THRESHOLD_SWEEP_VALUES)
+    )
+    table = sweep_thresholds(
+        store.number_of_nodes(), sorted_edges, THRESHOLD_SWEEP_VALUES
+    )
+    dc.save_threshold_sweep(table, THRESHOLD_SWEEP_COLUMNS)
+    print_threshold_sweep(table)
+
+    for threshold in THRESHOLD_SWEEP_NETWORKS:
+        graph, meta_net = network_at_threshold(
+            store.latitude, store.longitude, sorted_edges, threshold, as_csr=True
+        )
+        dc.save_network(graph, {**meta, **meta_net}, threshold=threshold)
+
+
+def run_step_calculate_window_networks():
+    downsampled, meta = _load_downsampled_anomaly_series()
+    anomaly, _ = dc.load_anomaly_series()
+
+    windows, meta_windows = compute_window_networks(
+        **downsampled, time=anomaly["time"]
+    )
+    dc.save_network_windows(windows, {**meta, **meta_windows})
+
+    print_window_statistics(windows)
+
+
+def _load_downsampled_anomaly_series():
+    anomaly, meta_an = dc.load_anomaly_series()
     downsampled, meta_ds = downsample_anomaly_series(
-        raw_data["latitude"], raw_data["longitude"], sst_anomaly
+        anomaly["latitude"],
+        anomaly["longitude"],
+        anomaly["lat_index"],
+        anomaly["lon_index"],
+        anomaly["sst_anomaly"],
     )
-    correlations = compute_correlations(**downsampled)
-    meta = dict(**meta_an, **meta_ds)
-    dc.save_correlations(**correlations, meta=meta)
+    return downsampled, {**meta_an, **meta_ds}
 
 
 def run_step_build_network():
-    correlations, meta_corr = dc.load_correlations()
+    edges, meta_corr = dc.load_correlation_edges()
+
+    graph, meta_net = build_network_from_edges(**edges)
+    dc.save_network(graph, {**meta_corr, **meta_net})
+
+    print_graph_statistics(graph)
+
+
+def run_step_test_correlation_significance():
+    downsampled, meta = _load_downsampled_anomaly_series()
+    edges, meta_sig = compute_correlation_significance(**downsampled)
+    dc.save_correlation_significance(edges, meta={**meta, **meta_sig})
+
+
+def run_step_build_significant_network():
+    edges, meta_sig = dc.load_correlation_significance()
+
+    significant = fdr_edges(
+        {key: edges[key] for key in SIGNIFICANCE_EDGE_KEYS},
+        n_tests=meta_sig["significance_n_tests"],
+    )
+    graph, meta_net = build_network_from_edges(
+        edges["latitude"],
+        edges["longitude"],
+        significant["row"],
+        significant["col"],
+        significant["value"],
+        threshold=0,
+        two_sided=meta_sig["corr_two_sided"],
+    )
+    meta = {**meta_sig, **meta_net, "significance_fdr": SIGNIFICANCE_FDR}
+    dc.save_network(graph, meta)
+
+    print_graph_statistics(graph)
 
-    graph, meta_net = build_network(**correlations)
-    dc.save_network(graph, dict(**meta_corr, **meta_net))
+
+def run_step_build_top_k_network():
+    store, meta_corr = dc.load_correlation_store()
+
+    graph, meta_net = build_top_k_network(
+        store.latitude, store.longitude, store, as_csr=True
+    )
+    dc.save_network(graph, {**meta_corr, **meta_net})
 
     print_graph_statistics(graph)
 
 
+def run_step_calculate_network_analytics():
+    graph, meta = dc.load_network(as_networkx=False)
+    analytics = compute_network_analytics(graph)
+    print_network_analytics(analytics)
+    dc.save_network_analytics(analytics, meta)
+
+
+def run_step_plot_network_analytics():
+    analytics, meta = dc.load_network_analytics()
+    fig = plot_network_analytics(analytics)
+    return dc.save_network_analytics_plot(fig)
+
+
 def run_step_detect_communities():
     graph, meta = dc.load_network()
 
@@ -80,6 +625,44 @@ def run_step_detect_communities():
     dc.save_communities(comms_surprise, meta_surprise, name="surprise-weighted")
 
 
+def run_step_detect_ensemble_communities():
+    graph, meta = dc.load_network(as_networkx=False, mmap_mode="r")
+
+    for algorithm, name in zip(ENSEMBLE_ALGORITHMS, CONSENSUS_COMMUNITY_NAMES):
+        comms, stability, _, runs = detect_ensemble_communities(graph, algorithm)
+        meta_consensus = {
+            **meta,
+            "community_algo": name,
+            "community_seed": COMMUNITY_SEED,
+            "ensemble_n_runs": ENSEMBLE_N_RUNS,
+            "ensemble_consensus_threshold": ENSEMBLE_CONSENSUS_THRESHOLD,
+        }
+        dc.save_communities(comms, meta_consensus, name=name)
+        dc.save_community_stability(stability, name=name)
+        dc.save_ensemble_runs(runs, name=name)
+
+
+def run_step_compare_partitions(names, ensemble=False):
+    labels = {}
+    for name in names:
+        comms, meta = dc.load_communities(name)
+        labels[name] = comms.labels
+
+    # Each run of the ensembles is compared too (with the others and the named
+    # partitions), which shows how much the partitions vary between seeds
+    run_groups = {}
+    if ensemble:
+        for algorithm, name in zip(ENSEMBLE_ALGORITHMS, CONSENSUS_COMMUNITY_NAMES):
+            runs = dc.load_ensemble_runs(name)
+            run_names = [f"{algorithm}-run-{i:02d}" for i in range(len(runs))]
+            labels.update(zip(run_names, runs))
+            run_groups[f"{algorithm} runs"] = run_names
+
+    comparison = compare_partitions(labels)
+    print_partition_comparison(comparison, names=names, groups=run_groups)
+    dc.save_partition_comparison(comparison)
+
+
 def run_step_plot_community_comparison():
     communities = {}
     meta = {}
@@ -87,23 +670,189 @@ def run_step_plot_community_comparison():
         communities[alg], meta[alg] = dc.load_communities(alg)
 
     fig = plot_community_comparison(communities)
-    dc.save_community_comparison_plot(fig)
+    return dc.save_community_comparison_plot(fig)
 
 
 def run_step_plot_communities_from_asymptotic_surprise():
     # The generated figure is used in the presentation
     communities, meta = dc.load_communities("surprise")
     fig = plot_communities(communities)
-    dc.save_community_plot(fig, "surprise")
+    return dc.save_community_plot(fig, "surprise")
 
 
 def run_step_plot_communities_from_weighted_asymptotic_surprise():
     communities, meta = dc.load_communities("surprise-weighted")
     fig = plot_communities(communities, title="asymptotic surprise (weighted)")
-    dc.save_community_plot(fig, "surprise-weighted")
+    return dc.save_community_plot(fig, "surprise-weighted")
 
 
 def run_step_plot_correlations_distribution():
-    correlations, meta_corr = dc.load_correlations()
-    fig = plot_correlations_distribution(correlations["correlation"])
-    dc.save_correlations_plot(fig)
+    store, meta = dc.load_correlation_store()
+    fig = plot_correlations_distribution(store)
+    return dc.save_correlations_plot(fig)
+
+
+def run_incremental_init():
+    """Compute the correlations along with the statistics needed to update them
+
+    This replaces the correlations intermediate dataset. Once new months have been
+    appended to the raw data it can be brought up to date with run_incremental_update.
+    """
+    dc.setup_directory_structure()
+
+    raw_data = dc.load_raw_sst_data(
+        min_latitude=MIN_LATITUDE, max_latitude=MAX_LATITUDE, stride=DOWNSAMPLE_DEGREES
+    )
+    cells, meta = _raw_correlation_cells(raw_data)
+    n_cells = len(cells["latitude"])
+
+    cross_product = dc.open_cross_product_for_writing(shape=(n_cells, n_cells))
+    stats, meta_stats = init_correlation_stats(
+        raw_data["time_days"], raw_data["time"], cells.pop("sst"), cross_product
+    )
+    stats.update(cells)
+    meta = {**meta, **meta_stats, "incremental_updates": 0}
+
+    correlation = _correlations_from_stats(stats)
+    dc.save_incremental_correlations(correlation, stats, meta)
+
+
+def run_incremental_update(check_drift=True):
+    """Update the correlations with months appended to the raw data since the last run
+
+    The correlations must first have been computed by run_incremental_init (and then
+    possibly updated by earlier calls to this function). Only the new months are read
+    from the raw data. If check_drift is true then a sample of the correlations is
+    compared to a full recompute, and the differences are logged and saved in the meta
+    data.
+
+    Returns:
+        Dictionary describing the drift from a full recompute (or None).
+    """
+    dc.setup_directory_structure()
+
+    stats, meta = dc.load_correlation_stats()
+    n_old = len(stats["time_days"])
+
+    new_data = dc.load_raw_sst_data(
+        min_latitude=MIN_LATITUDE,
+        max_latitude=MAX_LATITUDE,
+        stride=DOWNSAMPLE_DEGREES,
+        time_slice=slice(n_old, None),
+    )
+    if len(new_data["time_days"]) == 0:
+        logger.info("No new months to add to the correlations")
+        return None
+    logger.info(f"Adding {len(new_data['time_days'])} new months to the correlations")
+
+    # The saved correlations and stats are left unchanged until everything else has
+    # succeeded, so the cross-products are updated in a copy (and the correlations are
+    # written to a new file) which save_incremental_correlations moves into place
+    stats["cross_product"] = dc.open_cross_product_for_writing(
+        shape=stats["cross_product"].shape, copy_from=stats["cross_product"]
+    )
+    y_new = _raw_sst_at_cells(new_data, stats)
+    stats = update_correlation_stats(stats, meta, new_data["time_days"], y_new)
+    meta = {**meta, "incremental_updates": meta["incremental_updates"] + 1}
+
+    correlation = _correlations_from_stats(stats)
+
+    drift = None
+    if check_drift:
+        drift = _correlation_drift_from_sample(stats, correlation)
+        logger.info(f"Drift from a full recompute of the correlations: {drift}")
+        meta["drift"] = drift
+
+    dc.save_incremental_correlations(correlation, stats, meta)
+
+    return drift
+
+
+def _raw_correlation_cells(raw_data):
+    """ Mask ice, pack and downsample the raw SST data (without computing anomalies) """
+    sst = mask_ice_in_sst(raw_data["sst"])
+    _, _, sst, lat_index, lon_index = unmask_by_reshaping(
+        raw_data["latitude"], raw_data["longitude"], sst, return_index=True
+    )
+    downsampled, meta_ds = downsample_anomaly_series(
+        raw_data["latitude"],
+        raw_data["longitude"],
+        lat_index,
+        lon_index,
+        sst,
+        return_index=True,
+    )
+    cells = {
+        "latitude": downsampled["latitude"],
+        "longitude": downsampled["longitude"],
+        "lat_index": downsampled["lat_index"],
+        "lon_index": downsampled["lon_index"],
+        "sst": downsampled["sst_anomaly"],
+    }
+    meta = {
+        "low_pass_cutoff": LOW_PASS_CUTOFF,
+        "low_pass_butter_order": LOW_PASS_BUTTER_ORDER,
+        "seasonal_reference_period": SEASONAL_REFERENCE_PERIOD,
+        "load_stride": DOWNSAMPLE_DEGREES,
+        **meta_ds,
+    }
+    return cells, meta
+
+
+def _raw_sst_at_cells(raw_data, stats):
+    """ Extract the raw SST at the locations used for the correlation stats """
+    latitude = raw_data["latitude"][stats["lat_index"]]
+    longitude = raw_data["longitude"][stats["lon_index"]]
+    if not (
+        np.array_equal(latitude, stats["latitude"])
+        and np.array_equal(longitude, stats["longitude"])
+    ):
+        raise ValueError("The grid of the raw data has changed. Please recompute.")
+
+    sst = safe_unmask_array(
+        raw_data["sst"][:, stats["lat_index"], stats["lon_index"]], "new sst"
+    )
+    if (sst == SST_ICE_VAL).any():
+        # A full recompute would exclude these locations entirely
+        raise ValueError(
+            "New months contain ice at locations used for the correlations. Please "
+            "recompute from scratch with run_incremental_init."
+        )
+
+    return sst
+
+
+def _correlations_from_stats(stats):
+    n_cells = len(stats["latitude"])
+    correlation = dc.open_correlation_for_writing(
+        shape=(n_cells, n_cells), dtype=CORRELATION_DTYPE
+    )
+    return correlations_from_stats(stats, correlation)
+
+
+def _correlation_drift_from_sample(
+    stats, correlation, n_cells=INCREMENTAL_DRIFT_SAMPLE_SIZE, seed=0
+):
+    """ Compare a sample of the correlations with those from a full recompute
+
+    The anomaly series for the sampled locations are recomputed from scratch. The raw
+    data is read one latitude at a time, so that only the rows of the grid containing
+    sampled locations are read.
+    """
+    rng = np.random.default_rng(seed)
+    n_total = len(stats["latitude"])
+    cells = np.sort(rng.choice(n_total, size=min(n_cells, n_total), replace=False))
+
+    sst = np.empty((len(stats["time_days"]), len(cells)))
+    for latitude in np.unique(stats["latitude"][cells]):
+        in_row = stats["latitude"][cells] == latitude
+        row_data = dc.load_raw_sst_data(
+            min_latitude=latitude, max_latitude=latitude, stride=DOWNSAMPLE_DEGREES
+        )
+        sst[:, in_row] = safe_unmask_array(
+            row_data["sst"][:, 0, stats["lon_index"][cells[in_row]]], "sst"
+        )
+
+    process_anomaly_tiles(row_data["time_days"], row_data["time"], sst)
+
+    return correlation_drift(correlation, cells, sst)
@@ -1,10 +1,15 @@
+import functools
+
 import cartopy.crs as ccrs
+import cartopy.feature as cfeature
 import matplotlib as mpl
 import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
 
+from ma4m4.community_labels import CommunityLabels, community_labels
 from ma4m4.constants import CORRELATION_THRESHOLD, PLOT_MAX_COMMUNITIES
+from ma4m4.correlation_store import CorrelationStore, dense_correlation_histogram
 from ma4m4.utils import log_duration
 
 
@@ -16,7 +21,8 @@ def plot_correlations_distribution(
 
     Args:
         correlations: A symmetric nxn numpy array of correlations with one row and one
-            column for each (unmasked) spatial location
+            column for each (unmasked) spatial location, or a CorrelationStore. In
+            either case the correlations are counted a block at a time.
         threshold: A threshold to plot on top of the distribution
         two_sided: If true then both the positive and negative of the threshold will be
             drawn, else only the threshold passed will be drawn
@@ -24,11 +30,18 @@ def plot_correlations_distribution(
     Returns:
         The matplotlib figure generated
     """
+    if isinstance(correlations, CorrelationStore):
+        counts, bin_edges = correlations.histogram(bins=100)
+    else:
+        counts, bin_edges = dense_correlation_histogram(correlations, bins=100)
+
     fig, ax = plt.subplots(figsize=(6, 3), constrained_layout=True)
-    upper_entries = correlations[np.triu_indices(correlations.shape[0], k=1)]
     sns.histplot(
-        x=upper_entries,
-        bins=100,
+        data={"correlation": (bin_edges[:-1] + bin_edges[1:]) / 2, "count": counts},
+        x="correlation",
+        weights="count",
+        bins=len(counts),
+        binrange=(bin_edges[0], bin_edges[-1]),
         color="tab:blue",
         alpha=0.25,
         element="step",
@@ -75,6 +88,43 @@ def plot_communities(communities, title=None):
     return fig
 
 
+@log_duration("plot network analytics")
+def plot_network_analytics(analytics):
+    """ Plot maps of the per-node network analytics and the link length distribution
+
+    Args:
+        analytics: The result of compute_network_analytics.
+
+    Returns:
+        The matplotlib figure generated
+    """
+    fields = {
+        "area_weighted_degree": "(a) area weighted degree",
+        "mean_link_length": "(b) mean link length (km)",
+        "clustering": "(c) local clustering",
+    }
+
+    fig = plt.figure(figsize=(12, 7), constrained_layout=True)
+    gs = fig.add_gridspec(2, 2)
+    for i, (key, title) in enumerate(fields.items()):
+        ax = _add_map_axes(fig, gs[i // 2, i % 2], central_longitude=180)
+        x, y = _project(analytics["latitude"], analytics["longitude"], 180)
+        h = ax.scatter(x, y, s=1, c=analytics[key], cmap="viridis")
+        fig.colorbar(h, ax=ax, shrink=0.8)
+        ax.set_title(title)
+
+    ax = fig.add_subplot(gs[1, 1])
+    bin_edges = analytics["link_length_bin_edges"]
+    ax.stairs(analytics["link_length_counts"], bin_edges, fill=True, alpha=0.25)
+    ax.yaxis.set_major_formatter("{x:,.0f}")
+    ax.spines[["top", "right"]].set_visible(False)
+    ax.set_xlabel("Link length (km)")
+    ax.set_ylabel("Edges")
+    ax.set_title("(d) link length distribution")
+
+    return fig
+
+
 def _plot_communities(comms, fig=None, central_longitudes=(180, 0)):
     if not fig:
         fig = plt.figure(figsize=(6, 5), constrained_layout=True)
@@ -83,41 +133,28 @@ def _plot_communities(comms, fig=None, central_longitudes=(180, 0)):
     gs = fig.add_gridspec(2)
     axs = np.squeeze(np.empty(gs.get_geometry(), dtype="object"))
     for i in range(axs.size):
-        proj = ccrs.Mollweide(central_longitude=central_longitudes[i])
-        ax = fig.add_subplot(gs[i], projection=proj)
-        ax.coastlines()
-        ax.set_global()
-        axs[i] = ax
+        axs[i] = _add_map_axes(fig, gs[i], central_longitudes[i])
 
     # Extract community info (membership, truncation, ...)
-    nodes = comms.graph.nodes
-    communities = comms.communities
+    labels, latitude, longitude = _community_arrays(comms)
+    sizes = np.bincount(labels[labels >= 0])
 
-    if len(communities) > PLOT_MAX_COMMUNITIES:
-        tail_community = set().union(
-            *[c for c in communities[PLOT_MAX_COMMUNITIES - 1:]]
-        )
-        communities = communities[:PLOT_MAX_COMMUNITIES - 1] + [tail_community]
-        truncated_community_list = True
-    else:
-        truncated_community_list = False
-
-    community_membership = {
-        n: _singleton([i for i, c in enumerate(communities) if n in c])
-        for n in nodes
-    }
-
-    # Plot communities on axes
-    cmap, norm = _get_cmap_and_norm(communities)
+    truncated_community_list = len(sizes) > PLOT_MAX_COMMUNITIES
+    if truncated_community_list:
+        tail = PLOT_MAX_COMMUNITIES - 1
+        labels = np.minimum(labels, tail)
+        sizes = np.append(sizes[:tail], sizes[tail:].sum())
 
-    node_ids = list(nodes)  # Fix the order (shouldn't be necessary, but just in case!)
-    for ax in axs.flat:
+    # Plot communities on axes (skipping any nodes in no community)
+    cmap, norm = _get_cmap_and_norm(sizes)
+    in_community = labels >= 0
+    for ax, central_longitude in zip(axs.flat, central_longitudes):
+        x, y = _project(latitude, longitude, central_longitude)
         h = ax.scatter(
-            [nodes[n]["longitude"] for n in node_ids],
-            [nodes[n]["latitude"] for n in node_ids],
+            x[in_community],
+            y[in_community],
             s=1,
-            c=[community_membership[n] for n in node_ids],
-            transform=ccrs.PlateCarree(),
+            c=labels[in_community],
             cmap=cmap,
             norm=norm,
         )
@@ -125,24 +162,86 @@ def _plot_communities(comms, fig=None, central_longitudes=(180, 0)):
     cbar = fig.colorbar(
         h,
         label="Community: index (size)",
-        ticks=np.arange(len(communities)),
+        ticks=np.arange(len(sizes)),
         ax=axs.ravel().tolist(),
         shrink=0.8,
     )
-    cbar_tick_labels = [f"{i} ({len(c)})" for i, c in enumerate(communities)]
+    cbar_tick_labels = [f"{i} ({size})" for i, size in enumerate(sizes)]
     if truncated_community_list:
-        cbar_tick_labels[-1] = f"Other ({len(communities[-1])})"
+        cbar_tick_labels[-1] = f"Other ({sizes[-1]})"
     cbar.ax.set_yticklabels(cbar_tick_labels)
 
     return fig, axs, cbar
 
 
-def _singleton(l):
-    [x] = l
-    return x
+def _community_arrays(comms):
+    """ The community label, latitude and longitude of each node, as arrays
+
+    Args:
+        comms: A CommunityLabels or a cdlib NodeClustering.
+    """
+    if isinstance(comms, CommunityLabels):
+        return (comms.labels, *comms.coordinates())
+
+    nodes = comms.graph.nodes
+    n_nodes = len(nodes)
+    labels = community_labels(comms, n_nodes)
+    latitude = np.array([nodes[n]["latitude"] for n in range(n_nodes)])
+    longitude = np.array([nodes[n]["longitude"] for n in range(n_nodes)])
+    return labels, latitude, longitude
+
+
+def _add_map_axes(fig, subplot_spec, central_longitude):
+    """ Add Mollweide axes with coastlines, drawn from cached projected geometries """
+    proj = _mollweide(central_longitude)
+    ax = fig.add_subplot(subplot_spec, projection=proj)
+    ax.add_geometries(
+        _coastlines(central_longitude), crs=proj, facecolor="none", edgecolor="black"
+    )
+    ax.set_global()
+    return ax
+
+
+def _project(latitude, longitude, central_longitude):
+    """ Project coordinates onto the Mollweide projection, as arrays (x, y)
+
+    The result is cached, so that plotting many maps of the same locations (e.g.
+    different partitions of the same network) only projects them once.
+    """
+    return _project_cached(
+        central_longitude,
+        np.asarray(latitude, dtype="float64").tobytes(),
+        np.asarray(longitude, dtype="float64").tobytes(),
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _project_cached(central_longitude, latitude_bytes, longitude_bytes):
+    points = _mollweide(central_longitude).transform_points(
+        ccrs.PlateCarree(),
+        np.frombuffer(longitude_bytes, dtype="float64"),
+        np.frombuffer(latitude_bytes, dtype="float64"),
+    )
+    return points[:, 0], points[:, 1]
+
+
+@functools.lru_cache(maxsize=None)
+def _mollweide(central_longitude):
+    return ccrs.Mollweide(central_longitude=central_longitude)
+
+
+@functools.lru_cache(maxsize=None)
+def _coastlines(central_longitude):
+    """ The coastline geometries, projected once for each projection """
+    proj = _mollweide(central_longitude)
+    return [
+        proj.project_geometry(geometry, ccrs.PlateCarree())
+        for geometry in cfeature.COASTLINE.geometries()
+    ]
 
 
 def _get_cmap_and_norm(communities, cmap=None):
+    """ Colour map and norm with a colour for each of the communities (or sizes) """
     if cmap is None:
         if len(communities) <= 10:
             cmap = mpl.cm.get_cmap("tab10", len(communities))
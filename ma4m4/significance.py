@@ -0,0 +1,338 @@
+import logging
+import os
+import tempfile
+
+import joblib
+import numpy as np
+import scipy.fft
+import scipy.stats
+
+from ma4m4.compute_correlations import (
+    block_slices,
+    concatenate_edges,
+    correlation_tile,
+    standardise,
+    threshold_tile,
+)
+from ma4m4.constants import (
+    CORRELATION_DTYPE,
+    SIGNIFICANCE_BATCH_SIZE,
+    SIGNIFICANCE_BLOCK_SIZE,
+    SIGNIFICANCE_FDR,
+    SIGNIFICANCE_MIN_CORRELATION,
+    SIGNIFICANCE_N_SURROGATES,
+    SIGNIFICANCE_P_VALUE_METHOD,
+    SIGNIFICANCE_SEED,
+)
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
+
+SIGNIFICANCE_EDGE_KEYS = [
+    "row",
+    "col",
+    "value",
+    "n_exceed",
+    "null_mean",
+    "null_std",
+    "p_value",
+]
+
+
+@log_duration("compute correlation significance")
+def compute_correlation_significance(
+    latitude,
+    longitude,
+    sst_anomaly,
+    n_surrogates=SIGNIFICANCE_N_SURROGATES,
+    min_correlation=SIGNIFICANCE_MIN_CORRELATION,
+    two_sided=True,
+    method=SIGNIFICANCE_P_VALUE_METHOD,
+    seed=SIGNIFICANCE_SEED,
+    block_size=SIGNIFICANCE_BLOCK_SIZE,
+    batch_size=SIGNIFICANCE_BATCH_SIZE,
+    n_jobs=-1,
+):
+    """ Compute a p-value for each correlation against phase-randomised surrogates
+
+    Each surrogate replaces every anomaly series by one with the same power spectrum
+    (and so the same autocorrelation, including that from the low-pass filter) but
+    independently randomised Fourier phases, so that the series are independent under
+    the null hypothesis. See correlation_significance.
+
+    Returns:
+        Tuple: (result, meta) where result contains the "latitude" and "longitude" of
+            each location and the SIGNIFICANCE_EDGE_KEYS arrays for each pair with
+            abs(r) >= min_correlation (or r >= min_correlation if not two_sided).
+    """
+    edges = correlation_significance(
+        sst_anomaly,
+        n_surrogates=n_surrogates,
+        min_correlation=min_correlation,
+        two_sided=two_sided,
+        method=method,
+        seed=seed,
+        block_size=block_size,
+        batch_size=batch_size,
+        n_jobs=n_jobs,
+    )
+
+    n_nodes = sst_anomaly.shape[1]
+    result = {"latitude": latitude, "longitude": longitude, **edges}
+    meta = {
+        "corr_two_sided": two_sided,
+        "significance_n_surrogates": n_surrogates,
+        "significance_min_correlation": min_correlation,
+        "significance_p_value_method": method,
+        "significance_seed": seed,
+        "significance_n_tests": n_nodes * (n_nodes - 1) // 2,
+    }
+
+    return result, meta
+
+
+def correlation_significance(
+    y,
+    n_surrogates=SIGNIFICANCE_N_SURROGATES,
+    min_correlation=SIGNIFICANCE_MIN_CORRELATION,
+    two_sided=True,
+    method=SIGNIFICANCE_P_VALUE_METHOD,
+    seed=SIGNIFICANCE_SEED,
+    block_size=SIGNIFICANCE_BLOCK_SIZE,
+    batch_size=SIGNIFICANCE_BATCH_SIZE,
+    n_jobs=-1,
+    verbose=1,
+):
+    """ Test the correlations between the columns of y against surrogate data
+
+    The correlation matrix is processed in tiles (as in compute_correlation) by a pool
+    of worker processes. The observed correlations of each tile are computed once, to
+    find the candidate pairs, and then compared with those of batches of surrogates,
+    keeping only running statistics of the null distribution for each pair: the number
+    of surrogate correlations at least as extreme and the mean and standard deviation
+    of their Fisher z-transforms. No surrogate correlation matrix is ever stored.
+
+    For each batch, the surrogates of every block of columns are generated once (by
+    FFT, in threads) into a temporary memmap, which the tiles then read. Each block's
+    surrogates are seeded by the seed argument, the surrogate index and the block, so
+    the results do not depend on the number of workers. Only one batch of surrogates
+    (batch_size x t x k) is stored at a time.
+
+    Args:
+        y: A txk matrix with a time series in each column.
+        n_surrogates: Number of surrogates to compare against.
+        min_correlation: Only pairs with correlations beyond this are returned.
+        two_sided: Whether to test abs(r) (rather than r) against the surrogates.
+        method: Either "empirical", for p-values (1 + n_exceed) / (1 + n_surrogates),
+            or "gaussian", for p-values from a normal approximation to the Fisher
+            z-transformed null distribution of each pair. The latter can resolve much
+            smaller p-values, as needed when correcting for many tests.
+        seed: Base seed for the surrogates.
+        block_size: Number of columns along each side of a tile.
+        batch_size: Number of surrogates generated together.
+        n_jobs: Number of worker processes (as interpreted by joblib).
+        verbose: Verbosity passed to joblib.
+
+    Returns:
+        A dict with the SIGNIFICANCE_EDGE_KEYS arrays in COO format, sorted by row and
+        then column, for the pairs above the diagonal with abs(r) >= min_correlation
+        (or r >= min_correlation if not two_sided).
+    """
+    if method not in ("empirical", "gaussian"):
+        raise ValueError(f"Unknown p-value method: {method!r}")
+
+    z = standardise(y, dtype=CORRELATION_DTYPE)
+    n_time, n_cols = z.shape
+
+    blocks = block_slices(n_cols, block_size)
+    tiles = [(rows, cols) for i, rows in enumerate(blocks) for cols in blocks[i:]]
+
+    logger.info(
+        f"Finding candidate pairs in {len(tiles):,} tiles in a joblib process pool"
+    )
+    parallel = joblib.Parallel(n_jobs=n_jobs, prefer="processes", verbose=verbose)
+    candidates = parallel(
+        joblib.delayed(_candidate_tile)(z, rows, cols, min_correlation, two_sided)
+        for rows, cols in tiles
+    )
+    null_stats = [
+        {
+            "n_exceed": np.zeros(len(c["row"]), dtype="int32"),
+            "z_sum": np.zeros(len(c["row"])),
+            "z_sum_sq": np.zeros(len(c["row"])),
+        }
+        for c in candidates
+    ]
+
+    logger.info(
+        f"Comparing with {n_surrogates:,} surrogates in batches of {batch_size}"
+    )
+    spectra = scipy.fft.rfft(z, axis=0)
+    with tempfile.TemporaryDirectory() as scratch:
+        # Each surrogate series is contiguous, so that the tiles read whole blocks
+        surrogates = np.lib.format.open_memmap(
+            os.path.join(scratch, "surrogates.npy"),
+            mode="w+",
+            dtype=z.dtype,
+            shape=(min(batch_size, n_surrogates), n_cols, n_time),
+        )
+        for start in range(0, n_surrogates, batch_size):
+            batch = range(start, min(start + batch_size, n_surrogates))
+            _generate_surrogates(
+                spectra, n_time, blocks, batch, seed, surrogates, n_jobs=n_jobs
+            )
+            surrogates.flush()
+
+            results = parallel(
+                joblib.delayed(_surrogate_tile)(
+                    surrogates[: len(batch)], rows, cols, c, two_sided
+                )
+                for (rows, cols), c in zip(tiles, candidates)
+            )
+            for stats, result in zip(null_stats, results):
+                for key in stats:
+                    stats[key] += result[key]
+        del surrogates
+
+    results = []
+    for c, stats in zip(candidates, null_stats):
+        null_mean = stats["z_sum"] / n_surrogates
+        null_var = np.maximum(stats["z_sum_sq"] / n_surrogates - null_mean ** 2, 0)
+        results.append(
+            {
+                **c,
+                "n_exceed": stats["n_exceed"],
+                "null_mean": null_mean.astype("float32"),
+                "null_std": np.sqrt(null_var).astype("float32"),
+            }
+        )
+
+    edges = concatenate_edges(results, keys=SIGNIFICANCE_EDGE_KEYS[:-1])
+    edges["p_value"] = _p_values(edges, n_surrogates, two_sided, method)
+
+    return edges
+
+
+def fdr_edges(edges, n_tests, fdr=SIGNIFICANCE_FDR):
+    """ Select the edges which are significant at a false discovery rate
+
+    This uses the Benjamini-Hochberg procedure. The pairs whose correlations were too
+    weak to be tested (see correlation_significance) are counted in n_tests but are
+    never selected, which can only make the procedure more conservative.
+
+    Args:
+        edges: Dict of COO arrays, including "p_value".
+        n_tests: Total number of pairs tested (including those not in edges).
+        fdr: False discovery rate.
+
+    Returns:
+        A dict with the same keys as edges, containing only the significant edges.
+    """
+    order = np.argsort(edges["p_value"], kind="stable")
+    critical = fdr * np.arange(1, len(order) + 1) / n_tests
+    [passed] = np.nonzero(edges["p_value"][order] <= critical)
+    n_significant = passed[-1] + 1 if len(passed) else 0
+
+    keep = np.sort(order[:n_significant])
+    logger.info(
+        f"Selected {n_significant:,} of {len(order):,} candidate edges at a false "
+        f"discovery rate of {fdr}"
+    )
+    return {key: arr[keep] for key, arr in edges.items()}
+
+
+def phase_randomised_surrogates(spectra, n_time, rngs):
+    """ Generate surrogate series with the given spectra and random Fourier phases
+
+    The phases of each column (except at zero and Nyquist frequencies, which must stay
+    real) are randomised independently, which preserves the power spectrum (and so the
+    mean, variance and autocorrelation) of each series.
+
+    Args:
+        spectra: Real FFT (along axis 0) of the txk series.
+        n_time: Length of the series.
+        rngs: A random number generator for each surrogate.
+
+    Returns:
+        An array of shape (len(rngs), t, k) holding the surrogates.
+    """
+    n_freq, n_cols = spectra.shape
+    phases = np.zeros((len(rngs), n_freq, n_cols))
+    n_random = n_freq - 1 - (n_time % 2 == 0)
+    for phase, rng in zip(phases, rngs):
+        phase[1:1 + n_random] = rng.uniform(0, 2 * np.pi, size=(n_random, n_cols))
+
+    return scipy.fft.irfft(spectra * np.exp(1j * phases), n=n_time, axis=1)
+
+
+def _candidate_tile(z, rows, cols, min_correlation, two_sided):
+    """ The pairs in a tile whose observed correlations are to be tested
+
+    Returns:
+        A dict with the "row", "col" and "value" COO arrays (see threshold_tile), and
+        the "target" that surrogate correlations are compared with, which is the
+        observed correlation (or its absolute value, if two_sided) before rounding.
+    """
+    observed = correlation_tile(z, rows, cols)
+    candidates = threshold_tile(rows, cols, observed, min_correlation, two_sided)
+    target = observed[candidates["row"] - rows.start, candidates["col"] - cols.start]
+    candidates["target"] = np.abs(target) if two_sided else target
+    return candidates
+
+
+def _generate_surrogates(spectra, n_time, blocks, batch, seed, out, n_jobs=-1):
+    """ Write the surrogates in the batch for every block of columns into out """
+
+    def generate_block(block_index, cols):
+        rngs = [_surrogate_rng(seed, s, block_index) for s in batch]
+        block = phase_randomised_surrogates(spectra[:, cols], n_time, rngs)
+        out[: len(batch), cols] = block.transpose(0, 2, 1)
+
+    joblib.Parallel(n_jobs=n_jobs, prefer="threads")(
+        joblib.delayed(generate_block)(b, cols) for b, cols in enumerate(blocks)
+    )
+
+
+def _surrogate_tile(surrogates, rows, cols, candidates, two_sided):
+    """ Compare the candidate pairs in a tile with a batch of surrogates
+
+    Returns:
+        A dict with the number of surrogate correlations at least as extreme as the
+        observed one ("n_exceed"), and the sum of their Fisher z-transforms and of
+        their squares ("z_sum" and "z_sum_sq"), for each candidate pair.
+    """
+    i = candidates["row"] - rows.start
+    j = candidates["col"] - cols.start
+
+    # The surrogates have the same (zero) mean and (unit) norm as z, so their
+    # correlations are also given by products
+    row_surrogates = np.asarray(surrogates[:, rows])
+    col_surrogates = row_surrogates if rows == cols else np.asarray(surrogates[:, cols])
+    null = (row_surrogates @ col_surrogates.transpose(0, 2, 1))[:, i, j]
+    null = np.clip(null, -1, 1, out=null)
+
+    fisher = np.arctanh(np.clip(null, -1 + 1e-12, 1 - 1e-12))
+    return {
+        "n_exceed": np.sum(
+            (np.abs(null) if two_sided else null) >= candidates["target"], axis=0
+        ),
+        "z_sum": fisher.sum(axis=0),
+        "z_sum_sq": (fisher ** 2).sum(axis=0),
+    }
+
+
+def _surrogate_rng(seed, surrogate, block):
+    return np.random.default_rng([seed, surrogate, block])
+
+
+def _p_values(edges, n_surrogates, two_sided, method):
+    if method == "empirical":
+        return (1 + edges["n_exceed"]) / (1 + n_surrogates)
+
+    observed = np.arctanh(np.clip(edges["value"], -1 + 1e-7, 1 - 1e-7))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = (observed - edges["null_mean"]) / edges["null_std"]
+    if two_sided:
+        return 2 * scipy.stats.norm.sf(np.abs(score))
+    return scipy.stats.norm.sf(score)
@@ -0,0 +1,198 @@
+import numpy as np
+
+from ma4m4.build_network import graph_statistics
+from ma4m4.compute_correlations import (
+    concatenate_edges,
+    map_tile_slices,
+    standardise,
+    threshold_tile,
+)
+from ma4m4.constants import (
+    CORRELATION_BLOCK_SIZE,
+    CORRELATION_DTYPE,
+    CORRELATION_THRESHOLD,
+    WINDOW_LENGTH_MONTHS,
+    WINDOW_STEP_MONTHS,
+)
+from ma4m4.csr_graph import CSRGraph
+from ma4m4.utils import log_duration
+
+
+WINDOW_STATISTICS = ["n_nodes", "n_edges", "mean_degree", "density"]
+
+
+@log_duration("compute sliding window networks")
+def compute_window_networks(
+    latitude,
+    longitude,
+    time,
+    sst_anomaly,
+    window_length=WINDOW_LENGTH_MONTHS,
+    window_step=WINDOW_STEP_MONTHS,
+    threshold=CORRELATION_THRESHOLD,
+    two_sided=True,
+    block_size=CORRELATION_BLOCK_SIZE,
+    dtype=CORRELATION_DTYPE,
+    n_jobs=-1,
+):
+    """ Compute the thresholded correlation network in each of a sequence of windows
+
+    The windows contain window_length consecutive months and start every window_step
+    months. Rather than computing the correlations from scratch in each window, each
+    tile of the correlation matrix keeps running sums of products which are updated
+    with the months entering and leaving the window, so moving to the next window costs
+    O(n^2 window_step) rather than O(n^2 window_length). The per-location sums come
+    from cumulative sums over time.
+
+    Args:
+        latitude: An n-element vector with the latitude of each location.
+        longitude: An n-element vector with the longitude of each location.
+        time: A t-element vector with the datetime64 of each month.
+        sst_anomaly: A txn matrix containing the anomaly series in each column.
+
+    Returns:
+        Tuple: (result, meta) where result contains the "window_start" and
+            "window_end" times (inclusive) of each window, the edges of all windows in
+            COO format ("row", "col" and "value"), with those for window i in
+            edge_ptr[i]:edge_ptr[i+1], and the WINDOW_STATISTICS of each network.
+    """
+    n_time, n_nodes = sst_anomaly.shape
+    starts = window_starts(n_time, window_length, window_step)
+
+    # Standardising over the whole series (which doesn't change the correlations)
+    # keeps the running sums well conditioned
+    z = standardise(sst_anomaly, dtype=dtype)
+    mean, std = _window_moments(z, starts, window_length)
+
+    def process_tile(rows, cols):
+        return [
+            threshold_tile(rows, cols, tile, threshold, two_sided)
+            for tile in _window_correlation_tiles(
+                z, rows, cols, starts, window_length, mean, std
+            )
+        ]
+
+    tiles = map_tile_slices(n_nodes, process_tile, block_size=block_size, n_jobs=n_jobs)
+
+    windows = [concatenate_edges([t[i] for t in tiles]) for i in range(len(starts))]
+    statistics = [
+        graph_statistics(
+            CSRGraph.from_edges(
+                latitude, longitude, w["row"], w["col"], np.abs(w["value"])
+            )
+        )
+        for w in windows
+    ]
+
+    result = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "window_start": time[starts],
+        "window_end": time[starts + window_length - 1],
+        "edge_ptr": np.cumsum([0] + [len(w["value"]) for w in windows]),
+        **concatenate_windows(windows),
+        **{key: np.array([s[key] for s in statistics]) for key in WINDOW_STATISTICS},
+    }
+    meta = {
+        "window_length_months": window_length,
+        "window_step_months": window_step,
+        "corr_threshold": threshold,
+        "corr_two_sided": two_sided,
+    }
+
+    return result, meta
+
+
+def window_starts(n_time, window_length, window_step):
+    """ The index of the first month of each window which fits in the series """
+    if window_length > n_time:
+        raise ValueError(
+            f"Window of {window_length} months is longer than the series ({n_time})"
+        )
+    return np.arange(0, n_time - window_length + 1, window_step)
+
+
+def concatenate_windows(windows):
+    """ Concatenate the COO arrays of several windows, keeping their order """
+    return {
+        key: np.concatenate([w[key] for w in windows])
+        for key in ["row", "col", "value"]
+    }
+
+
+def window_network(windows, index, as_csr=False):
+    """ Build the network for one window from the result of compute_window_networks
+
+    Args:
+        as_csr: If true then return a CSRGraph rather than a networkx graph.
+    """
+    edges = slice(windows["edge_ptr"][index], windows["edge_ptr"][index + 1])
+    graph = CSRGraph.from_edges(
+        windows["latitude"],
+        windows["longitude"],
+        windows["row"][edges],
+        windows["col"][edges],
+        np.abs(windows["value"][edges]),
+    )
+    if not as_csr:
+        graph = graph.to_networkx()
+    return graph
+
+
+def print_window_statistics(windows):
+    """ Print the graph statistics of each window in a table """
+    print("Sliding window graph statistics")
+    print("-------------------------------")
+    print(f"{'Window':<21}{'Nodes':>9}{'Edges':>13}{'Avg degree':>12}{'Density':>9}")
+    for i, start in enumerate(windows["window_start"]):
+        end = windows["window_end"][i]
+        print(
+            f"{str(start)[:7]} to {str(end)[:7]}    "
+            f"{windows['n_nodes'][i]:>8,} "
+            f"{windows['n_edges'][i]:>12,} "
+            f"{windows['mean_degree'][i]:>11.1f} "
+            f"{windows['density'][i]:>8.1%}"
+        )
+
+
+def _window_moments(z, starts, window_length):
+    """ The mean and standard deviation of each column of z in each window """
+    cumsum = np.zeros((z.shape[0] + 1, z.shape[1]))
+    np.cumsum(z, axis=0, out=cumsum[1:])
+    cumsum_sq = np.zeros_like(cumsum)
+    np.cumsum(np.square(z, dtype="float64"), axis=0, out=cumsum_sq[1:])
+
+    ends = starts + window_length
+    mean = (cumsum[ends] - cumsum[starts]) / window_length
+    var = (cumsum_sq[ends] - cumsum_sq[starts]) / window_length - mean ** 2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+
+def _window_correlation_tiles(z, rows, cols, starts, window_length, mean, std):
+    """ Generate the correlation tile for each window from running sums of products """
+    products = None
+    previous = None
+    for i, start in enumerate(starts):
+        if previous is None or start - previous >= window_length:
+            window = slice(start, start + window_length)
+            products = _products(z, window, rows, cols)
+        else:
+            products += _products(
+                z, slice(previous + window_length, start + window_length), rows, cols
+            )
+            products -= _products(z, slice(previous, start), rows, cols)
+        previous = start
+
+        cov = products / window_length - np.outer(mean[i, rows], mean[i, cols])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tile = cov / np.outer(std[i, rows], std[i, cols])
+        if rows == cols:
+            # Make diagonal tiles exactly symmetric
+            tile += tile.T
+            tile /= 2
+        yield np.clip(tile, -1, 1, out=tile)
+
+
+def _products(z, window, rows, cols):
+    # The running sums are accumulated in double precision whatever the dtype of z
+    return (z[window, rows].T @ z[window, cols]).astype("float64", copy=False)
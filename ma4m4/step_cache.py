@@ -0,0 +1,175 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+
+import ma4m4.data_catalog as dc
+from ma4m4.constants import STEP_CACHE_MAX_BYTES
+from ma4m4.figure_export import wait_for_exports
+
+
+logger = logging.getLogger(__name__)
+
+# Cache entries (with their outputs and the futures writing them) still to be stored
+_pending = []
+
+
+def step_key(step, params, upstream=(), code=()):
+    """ Compute the cache key for a step
+
+    Args:
+        step: The name of the step.
+        params: A JSON-serialisable dictionary of parameters (e.g. constants) which
+            affect the outputs of the step.
+        upstream: Keys of the steps this one depends on (see also file_fingerprint).
+        code: Modules or functions whose source code implements the step.
+    """
+    payload = {
+        "step": step,
+        "params": params,
+        "upstream": list(upstream),
+        "code": [_source_hash(obj) for obj in code],
+    }
+    serialised = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode()).hexdigest()
+
+
+def file_fingerprint(path):
+    """ A cheap key for an input file, based on its path, size and modification time """
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def run_cached(step, key, func, outputs, use_cache=True):
+    """ Run func, unless the outputs for this step and key are already in the cache
+
+    Each key hashes together the parameters of a step, the keys of the steps (or files)
+    it depends on and its source code (see step_key), so a step is only rerun when one
+    of these changes. The outputs are hard-linked (where possible) between the cache and
+    their usual location, so they must be replaced rather than modified in place. This
+    function takes care of that by removing the outputs before running func.
+
+    If func returns a list of futures (e.g. from figure_export.export_figure) then its
+    outputs are still being written in the background, so they are only added to the
+    cache by wait_for_pending, once the futures have completed.
+
+    Args:
+        step: The name of the step.
+        key: The key for the step, from step_key.
+        func: Function (with no arguments) which writes the outputs.
+        outputs: The files or directories written by func.
+        use_cache: If false then always run func (the outputs are still cached).
+
+    Returns:
+        True if func was run, or False if the outputs were restored from the cache.
+    """
+    entry = dc.FILE_PATHS["step_cache"].format(step=step, key=key)
+
+    if use_cache and os.path.isdir(entry):
+        logger.info(f"Restoring outputs of {step!r} from cache (key {key[:12]})")
+        for i, path in enumerate(outputs):
+            _remove(path)
+            _link_or_copy(_entry_path(entry, i, path), path)
+        os.utime(entry)  # Mark as recently used
+        return False
+
+    for path in outputs:
+        _remove(path)
+    dc.setup_directory_structure()  # Recreate any output directories we just removed
+    futures = func()
+
+    if futures:
+        _pending.append((entry, outputs, futures))
+    else:
+        _store(entry, outputs)
+        evict(keep=entry)
+
+    return True
+
+
+def wait_for_pending():
+    """ Wait for the outputs still being written by steps, and add them to the cache
+
+    Any error raised while writing the outputs is re-raised here, and the outputs of
+    that step are not cached.
+    """
+    entries = []
+    while _pending:
+        entry, outputs, futures = _pending.pop(0)
+        wait_for_exports(futures)
+        _store(entry, outputs)
+        entries.append(entry)
+
+    if entries:
+        evict(keep=entries[-1])
+
+
+def evict(max_bytes=STEP_CACHE_MAX_BYTES, keep=None):
+    """ Remove the least recently used cache entries until the cache fits in max_bytes
+
+    Args:
+        max_bytes: The maximum total size of the cache.
+        keep: An entry which should never be evicted (e.g. the one just added).
+    """
+    cache_dir = os.path.dirname(dc.FILE_PATHS["step_cache"])
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    entries.sort(key=os.path.getmtime)
+    sizes = {e: _size(e) for e in entries}
+
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if keep and os.path.abspath(entry) == os.path.abspath(keep):
+            continue
+        logger.info(f"Evicting cache entry {os.path.basename(entry)!r}")
+        _remove(entry)
+        total -= sizes[entry]
+
+
+def _store(entry, outputs):
+    """ Link the outputs into a cache entry, replacing it atomically """
+    tmp_entry = entry + ".tmp"
+    _remove(tmp_entry)
+    os.makedirs(tmp_entry)
+    for i, path in enumerate(outputs):
+        _link_or_copy(path, _entry_path(tmp_entry, i, path))
+    _remove(entry)
+    os.rename(tmp_entry, entry)
+
+
+def _source_hash(obj):
+    return hashlib.sha256(inspect.getsource(obj).encode()).hexdigest()
+
+
+def _entry_path(entry, i, path):
+    return os.path.join(entry, f"{i}_{os.path.basename(path)}")
+
+
+def _link_or_copy(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link_or_copy)
+    else:
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
@@ -0,0 +1,304 @@
+import logging
+import time
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.special
+
+from ma4m4.utils import log_duration
+
+
+logger = logging.getLogger(__name__)
+
+
+@log_duration("optimise asymptotic surprise")
+def optimise_surprise(adjacency, seed=None, time_budget=None):
+    """ Find a partition of a graph with high asymptotic surprise, Louvain-style
+
+    Asymptotic surprise (Traag, Aldecoa and Delvenne, 2015) is m D(q || <q>), where m
+    is the total edge weight, q is the fraction of it inside communities, <q> is the
+    fraction of pairs of nodes inside communities and D is the binary Kullback-Leibler
+    divergence. This is the quality function optimised by cdlib's surprise_communities
+    (via leidenalg).
+
+    As in the Louvain algorithm, nodes are repeatedly moved (in a random order) to the
+    neighbouring community which increases the surprise most, until no move helps, and
+    then the communities are aggregated into nodes of a smaller graph and the process
+    repeated. The graph is held as a scipy CSR matrix throughout and aggregation is
+    done by sparse matrix products. Since the surprise depends on only two global
+    totals (the internal weight and the number of internal pairs), the change from
+    moving each node to each of its neighbouring communities is evaluated together,
+    from the sparse matrix of weights between nodes and communities, and the nodes are
+    moved in batches (see _move_nodes).
+
+    Louvain can leave a community disconnected (e.g. when the node joining its parts
+    moves away). In place of the refinement phase of the Leiden algorithm, each
+    community is split into its connected components before aggregation. This never
+    lowers the surprise of a partition better than random (q > <q>), since it removes
+    pairs of nodes but no edges from inside the communities, and it guarantees that
+    every community of the result is connected.
+
+    Args:
+        adjacency: A symmetric nxn scipy sparse adjacency matrix (with weights, if the
+            surprise is to be weighted) and no self-loops.
+        seed: Seed for the random batches in which nodes are moved.
+        time_budget: If given then stop (returning the best partition found so far)
+            after approximately this many seconds.
+
+    Returns:
+        An n-element vector with the community label of each node, numbered from 0
+        in decreasing order of size.
+    """
+    rng = np.random.default_rng(seed)
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    adjacency = scipy.sparse.csr_matrix(adjacency, dtype="float64")
+    n_nodes = adjacency.shape[0]
+    labels = np.arange(n_nodes)
+    node_size = np.ones(n_nodes)
+
+    level = 0
+    while True:
+        community, n_moves = _move_nodes(adjacency, node_size, rng, deadline)
+        community = split_disconnected(adjacency, community)
+        level += 1
+        logger.info(f"Moved {n_moves:,} nodes at surprise optimisation level {level}")
+
+        labels = community[labels]
+        n_communities = community.max() + 1
+        if n_moves == 0 or n_communities == adjacency.shape[0] or _expired(deadline):
+            break
+
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(len(community)), (np.arange(len(community)), community)),
+            shape=(len(community), n_communities),
+        )
+        adjacency = (membership.T @ adjacency @ membership).tocsr()
+        node_size = np.bincount(community, weights=node_size)
+
+    if _expired(deadline):
+        logger.warning("Stopped surprise optimisation as the time budget ran out")
+
+    return _relabel_by_size(labels)
+
+
+def asymptotic_surprise(adjacency, labels):
+    """ The asymptotic surprise of a partition (see optimise_surprise)
+
+    Args:
+        adjacency: A symmetric nxn scipy sparse adjacency matrix.
+        labels: An n-element vector with the community label of each node.
+    """
+    adjacency = scipy.sparse.coo_matrix(adjacency)
+    is_internal = labels[adjacency.row] == labels[adjacency.col]
+    internal_weight = adjacency.data[is_internal].sum() / 2
+    total_weight = adjacency.data.sum() / 2
+
+    sizes = np.bincount(labels).astype("float64")
+    internal_pairs = np.sum(sizes * (sizes - 1) / 2)
+    total_pairs = len(labels) * (len(labels) - 1) / 2
+
+    return float(
+        _surprise(internal_weight, internal_pairs, total_weight, total_pairs)
+    )
+
+
+def split_disconnected(adjacency, labels):
+    """ Split each community into its connected components
+
+    Args:
+        adjacency: A symmetric nxn scipy sparse adjacency matrix.
+        labels: An n-element vector with the community label of each node.
+
+    Returns:
+        An n-element vector labelling the connected components of the communities,
+        numbered from 0.
+    """
+    adjacency = scipy.sparse.coo_matrix(adjacency)
+    is_internal = labels[adjacency.row] == labels[adjacency.col]
+    internal = scipy.sparse.coo_matrix(
+        (
+            np.ones(np.count_nonzero(is_internal)),
+            (adjacency.row[is_internal], adjacency.col[is_internal]),
+        ),
+        shape=adjacency.shape,
+    )
+    _, components = scipy.sparse.csgraph.connected_components(internal, directed=False)
+    return components
+
+
+def _move_nodes(adjacency, node_size, rng, deadline):
+    """ Move nodes between communities while this increases the surprise
+
+    Each node starts in its own community. Node i stands for node_size[i] nodes of
+    the original graph and any self-loop holds the weight inside it.
+
+    Rather than visiting the nodes one at a time, each sweep evaluates the best move of
+    every node at once from the sparse matrix of weights between nodes and communities.
+    A random fraction of the nodes with an improving move then move together. Each
+    move is exact on its own, but moves made together can interfere, so the sweep is
+    only kept if the (recomputed) surprise increases. Otherwise the fraction is halved,
+    down to just the best single move. That should always help, but if rounding makes
+    the recomputed surprise disagree then the node is left out until another move has
+    been made, so the loop always ends. As in parallel Louvain
+    implementations, a node alone in its community only moves to another singleton
+    community with a lower label, so that pairs of singletons don't swap.
+
+    Returns:
+        Tuple: (community, n_moves) with the community of each node and the number of
+            moves made.
+    """
+    n_nodes = adjacency.shape[0]
+    adjacency = adjacency.tocoo()
+    not_self = adjacency.row != adjacency.col
+    row, col, data = (
+        adjacency.row[not_self],
+        adjacency.col[not_self],
+        adjacency.data[not_self],
+    )
+
+    total_weight = adjacency.data.sum() / 2
+    total_pairs = node_size.sum() * (node_size.sum() - 1) / 2
+    self_weight = adjacency.diagonal().sum() / 2
+
+    def internal_totals(community):
+        community_size = np.bincount(community, weights=node_size)
+        is_internal = community[row] == community[col]
+        internal_weight = self_weight + data[is_internal].sum() / 2
+        return internal_weight, np.sum(community_size * (community_size - 1) / 2)
+
+    community = np.arange(n_nodes)
+    internal_weight, internal_pairs = internal_totals(community)
+    current = _surprise(internal_weight, internal_pairs, total_weight, total_pairs)
+
+    n_moves = 0
+    fraction = 1.0
+    stuck = np.zeros(n_nodes, dtype="bool")
+    while not _expired(deadline):
+        target, gain = _best_moves(
+            row,
+            col,
+            data,
+            community,
+            node_size,
+            (internal_weight, internal_pairs, total_weight, total_pairs),
+            current,
+        )
+        [movers] = np.nonzero((target != community) & ~stuck)
+        if len(movers) == 0:
+            break
+
+        n_chosen = int(fraction * len(movers))
+        if n_chosen <= 1:
+            chosen = movers[[np.argmax(gain[movers])]]
+        else:
+            chosen = rng.choice(movers, size=n_chosen, replace=False)
+
+        previous = community[chosen]
+        community[chosen] = target[chosen]
+        weight, pairs = internal_totals(community)
+        surprise = _surprise(weight, pairs, total_weight, total_pairs)
+        if surprise > current * (1 + 1e-12):
+            internal_weight, internal_pairs = weight, pairs
+            current = surprise
+            n_moves += len(chosen)
+            fraction = min(2 * fraction, 1.0)
+            stuck[:] = False
+        elif len(chosen) == 1:
+            community[chosen] = previous
+            stuck[chosen] = True
+        else:
+            community[chosen] = previous
+            fraction /= 2
+
+    return community, n_moves
+
+
+def _best_moves(row, col, data, community, node_size, totals, current):
+    """ The best community for each node to move to (on its own), and the gain
+
+    Args:
+        row, col, data: The edges (excluding self-loops) in COO format.
+        community: The current community of each node.
+        node_size: The number of nodes of the original graph in each node.
+        totals: Tuple of the current (internal_weight, internal_pairs, total_weight,
+            total_pairs).
+        current: The current surprise.
+
+    Returns:
+        Tuple: (target, gain) with the community each node should move to (its own, if
+            no move increases the surprise) and the resulting increase in surprise.
+    """
+    n_nodes = len(community)
+    internal_weight, internal_pairs, total_weight, total_pairs = totals
+    community_size = np.bincount(community, weights=node_size, minlength=n_nodes)
+    n_members = np.bincount(community, minlength=n_nodes)
+    is_internal = community[row] == community[col]
+    own_weight = np.bincount(
+        row[is_internal], weights=data[is_internal], minlength=n_nodes
+    )
+
+    # The weight from each node to each neighbouring community, as a CSR matrix
+    weight = scipy.sparse.csr_matrix(
+        (data, (row, community[col])), shape=(n_nodes, n_nodes)
+    )
+    weight.sum_duplicates()
+    node = np.repeat(np.arange(n_nodes), np.diff(weight.indptr))
+    candidate = weight.indices
+    own = community[node]
+
+    # Totals with each node removed from its community, and then added to each
+    # candidate
+    size = node_size[node]
+    base_weight = internal_weight - own_weight[node]
+    base_pairs = internal_pairs - size * (community_size[own] - size)
+    candidate_size = community_size[candidate] - np.where(candidate == own, size, 0)
+    surprise = _surprise(
+        base_weight + weight.data,
+        base_pairs + size * candidate_size,
+        total_weight,
+        total_pairs,
+    )
+
+    swap = (n_members[own] == 1) & (n_members[candidate] == 1) & (candidate > own)
+    allowed = (candidate != own) & ~swap & (surprise > current * (1 + 1e-12))
+
+    target = community.copy()
+    gain = np.zeros(n_nodes)
+    if np.any(allowed):
+        node, candidate, surprise = node[allowed], candidate[allowed], surprise[allowed]
+        # The candidate with the highest surprise for each node
+        order = np.lexsort((-surprise, node))
+        first = order[np.r_[True, node[order][1:] != node[order][:-1]]]
+        target[node[first]] = candidate[first]
+        gain[node[first]] = surprise[first] - current
+
+    return target, gain
+
+
+def _surprise(internal_weight, internal_pairs, total_weight, total_pairs):
+    """ m D(q || <q>), vectorised over arrays of internal totals """
+    if total_weight == 0 or total_pairs == 0:
+        return np.zeros_like(np.asarray(internal_weight, dtype="float64"))
+
+    q = np.clip(internal_weight / total_weight, 0, 1)
+    expected_q = np.clip(internal_pairs / total_pairs, 0, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        divergence = scipy.special.rel_entr(q, expected_q) + scipy.special.rel_entr(
+            1 - q, 1 - expected_q
+        )
+    return total_weight * divergence
+
+
+def _relabel_by_size(labels):
+    """ Renumber the labels from 0 in decreasing order of community size """
+    sizes = np.bincount(labels)
+    order = np.argsort(-sizes, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[labels]
+
+
+def _expired(deadline):
+    return deadline is not None and time.monotonic() > deadline
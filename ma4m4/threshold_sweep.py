@@ -0,0 +1,147 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from ma4m4.build_network import edge_count_statistics, scan_correlation_edges
+from ma4m4.csr_graph import CSRGraph
+from ma4m4.utils import log_duration
+
+
+THRESHOLD_SWEEP_COLUMNS = [
+    "threshold",
+    "n_nodes",
+    "n_edges",
+    "mean_degree",
+    "density",
+    "n_components",
+    "largest_component",
+]
+
+
+@log_duration("sort correlations")
+def sort_correlation_edges(correlation, min_threshold, two_sided=True):
+    """ Extract the correlations beyond min_threshold, strongest first
+
+    The dense matrix (or CorrelationStore) is scanned once (see scan_correlation_edges).
+    Since the edges are sorted, the network at any threshold no lower than
+    min_threshold is given by a prefix of the result.
+
+    Returns:
+        A dict with the "row", "col" and "value" arrays of the edges in COO format,
+        sorted in descending order of abs(value) (or value, if not two_sided).
+    """
+    edges = scan_correlation_edges(correlation, min_threshold, two_sided)
+    order = np.argsort(-_edge_strength(edges["value"], two_sided), kind="stable")
+    return {key: arr[order] for key, arr in edges.items()}
+
+
+@log_duration("sweep thresholds")
+def sweep_thresholds(n_nodes, sorted_edges, thresholds, two_sided=True):
+    """ Compute the graph statistics of the network at each of a list of thresholds
+
+    The thresholds are visited in descending order, so that each adds a batch of
+    edges to the network at the previous one. Connected components are tracked by
+    labelling each node with its component, and merging the components joined by each
+    batch of edges with a connected components search on the (much smaller) graph
+    between the existing components.
+
+    Args:
+        n_nodes: Number of nodes in the network.
+        sorted_edges: Edges from sort_correlation_edges, which must have been computed
+            with a threshold no greater than any of the thresholds here.
+        thresholds: Correlation thresholds to evaluate.
+        two_sided: Whether the edges are selected by abs(value) or value.
+
+    Returns:
+        A list with a dictionary for each threshold (in ascending order) containing the
+        THRESHOLD_SWEEP_COLUMNS.
+    """
+    labels = np.arange(n_nodes)
+    n_components = n_nodes
+    n_added = 0
+    table = []
+    for threshold in sorted(thresholds, reverse=True):
+        n_edges = _count_edges(sorted_edges, threshold, two_sided)
+
+        new = slice(n_added, n_edges)
+        row = labels[sorted_edges["row"][new]]
+        col = labels[sorted_edges["col"][new]]
+        merges = row != col
+        if np.any(merges):
+            n_components, components = scipy.sparse.csgraph.connected_components(
+                scipy.sparse.coo_matrix(
+                    (np.ones(np.count_nonzero(merges)), (row[merges], col[merges])),
+                    shape=(n_components, n_components),
+                ),
+                directed=False,
+            )
+            labels = components[labels]
+        n_added = n_edges
+
+        table.append(
+            {
+                "threshold": threshold,
+                **edge_count_statistics(n_nodes, n_edges),
+                "n_components": n_components,
+                "largest_component": int(np.bincount(labels).max()),
+            }
+        )
+
+    return table[::-1]
+
+
+def network_at_threshold(
+    latitude, longitude, sorted_edges, threshold, two_sided=True, as_csr=False
+):
+    """ Build the network at a threshold from the edges from sort_correlation_edges
+
+    Args:
+        as_csr: If true then return a CSRGraph rather than a networkx graph.
+    """
+    n_edges = _count_edges(sorted_edges, threshold, two_sided)
+    graph = CSRGraph.from_edges(
+        latitude,
+        longitude,
+        sorted_edges["row"][:n_edges],
+        sorted_edges["col"][:n_edges],
+        np.abs(sorted_edges["value"][:n_edges]),
+    )
+    if not as_csr:
+        graph = graph.to_networkx()
+
+    meta = {"corr_threshold": threshold, "corr_two_sided": two_sided}
+
+    return graph, meta
+
+
+def print_threshold_sweep(table):
+    """ Print the graph statistics for each threshold in a table """
+    print("Threshold sweep graph statistics")
+    print("--------------------------------")
+    print(
+        f"{'Threshold':>9}{'Edges':>13}{'Avg degree':>12}{'Density':>9}"
+        f"{'Components':>12}{'Largest':>9}"
+    )
+    for row in table:
+        print(
+            f"{row['threshold']:>9.3g}"
+            f"{row['n_edges']:>13,}"
+            f"{row['mean_degree']:>12.1f}"
+            f"{row['density']:>9.1%}"
+            f"{row['n_components']:>12,}"
+            f"{row['largest_component']:>9,}"
+        )
+
+
+def _count_edges(sorted_edges, threshold, two_sided):
+    """ Number of edges (a prefix of sorted_edges) at or beyond the threshold
+
+    As in beyond_threshold, the threshold is rounded to the dtype of the values.
+    """
+    strength = _edge_strength(sorted_edges["value"], two_sided)
+    threshold = strength.dtype.type(threshold)
+    return int(np.searchsorted(-strength, -threshold, side="right"))
+
+
+def _edge_strength(value, two_sided):
+    return np.abs(value) if two_sided else value
@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+
+import networkx as nx
+import numpy as np
+
+import ma4m4.surprise
+from ma4m4.community_detection import benchmark_asymptotic_surprise
+from ma4m4.csr_graph import CSRGraph
+from ma4m4.surprise import asymptotic_surprise, optimise_surprise
+
+
+def planted_partition_graph(n_groups=5, group_size=40, seed=1):
+    """ A CSRGraph with dense groups of nodes, and the group of each node """
+    graph = nx.planted_partition_graph(n_groups, group_size, 0.3, 0.01, seed=seed)
+    row, col = np.array(list(graph.edges()), dtype="int32").T
+    abs_corr = np.random.default_rng(seed).uniform(0.5, 1, len(row))
+    n_nodes = graph.number_of_nodes()
+    csr_graph = CSRGraph.from_edges(
+        np.zeros(n_nodes), np.zeros(n_nodes), row, col, abs_corr
+    )
+    return csr_graph, np.repeat(np.arange(n_groups), group_size)
+
+
+def same_partition(labels1, labels2):
+    pairs = np.unique(np.stack([labels1, labels2]), axis=1)
+    return pairs.shape[1] == len(np.unique(labels1)) == len(np.unique(labels2))
+
+
+class TestOptimiseSurprise(unittest.TestCase):
+    def test_recovers_planted_partition(self):
+        graph, groups = planted_partition_graph()
+        for weight in [None, "abs_corr"]:
+            labels = optimise_surprise(graph.adjacency(weight), seed=0)
+            self.assertTrue(same_partition(labels, groups))
+
+    def test_is_deterministic_for_a_seed(self):
+        graph, _ = planted_partition_graph()
+        adjacency = graph.adjacency()
+        np.testing.assert_array_equal(
+            optimise_surprise(adjacency, seed=0), optimise_surprise(adjacency, seed=0)
+        )
+
+    def test_stops_when_the_best_move_is_rejected(self):
+        # A move which _best_moves reports as the best, but which lowers the surprise,
+        # stands in for the two evaluations of a move disagreeing because of rounding
+        best_moves = ma4m4.surprise._best_moves
+
+        def best_moves_with_bad_move(row, col, data, community, *args):
+            target, gain = best_moves(row, col, data, community, *args)
+            other = community[1] if community[1] != community[0] else community[-1]
+            target[0], gain[0] = other, np.inf
+            return target, gain
+
+        graph, groups = planted_partition_graph()
+        with mock.patch.object(
+            ma4m4.surprise, "_best_moves", best_moves_with_bad_move
+        ):
+            labels = optimise_surprise(graph.adjacency(), seed=0, time_budget=None)
+        self.assertTrue(same_partition(labels, groups))
+
+
+class TestBenchmarkAsymptoticSurprise(unittest.TestCase):
+    def test_native(self):
+        graph, groups = planted_partition_graph()
+        results = benchmark_asymptotic_surprise(graph, optimisers=["native"])
+
+        self.assertEqual(list(results), ["native"])
+        self.assertEqual(results["native"]["n_communities"], 5)
+        self.assertAlmostEqual(
+            results["native"]["surprise"],
+            asymptotic_surprise(graph.adjacency(), groups),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()